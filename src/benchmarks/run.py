@@ -0,0 +1,235 @@
+#!/usr/bin/env python3.4
+'''
+Times ImageService operations and every Transformation on synthetic boards of several widths.
+Usage (from src): python -m benchmarks.run [--widths 640 1280 2560] [--repeat 5] [-o FILE] [--baseline FILE]
+Results are written as JSON, --baseline compares medians with earlier results and exits with 1 on regression.
+'''
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import cv2
+import numpy as np
+from settings import *
+from services.image_service import ImageService
+from image_processors import avaliable_image_processes
+from image_processors.abc.transformation import Transformation
+from image_processors.grid import Grid
+from models.pattern import Pattern
+from models.pattern_index import PatternIndex
+from models.settings import Settings
+from benchmarks import synthetic
+
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    '''
+    Registers benchmark, decorated function takes (image_service, fixture) and returns
+    function without arguments which is timed
+    '''
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def fixture(image_service, width):
+    ''' Images shared by all benchmarks of one width '''
+    data = synthetic.board(width)
+    board = data['board']
+    gray = image_service.bgr_to_gray(board)
+    binary = image_service.otsu_binarization(gray)
+    pattern_keypoints, pattern_descriptors = image_service.extract_key_points_and_descriptors(data['pattern'], KEYPOINT_TILES)
+    pattern = Pattern('benchmark', image_service.otsu_binarization(data['pattern']), pattern_keypoints, pattern_descriptors, keypoint_tiles=KEYPOINT_TILES)
+    settings = Settings('benchmark', [Grid(True, **data['grid'])])
+    y1, y2, x1, x2 = settings.selected_split().split({GRAY_IMAGE: gray, OUT_IMAGE: GRAY_IMAGE})[0]
+    panel_keypoints, panel_descriptors = image_service.extract_key_points_and_descriptors(gray[y1:y2, x1:x2], KEYPOINT_TILES)
+    pattern_indexes, panel_indexes = image_service.match_pattern(pattern, panel_descriptors)
+    return {
+        'scene': data['scene'],
+        'board': board,
+        'gray': gray,
+        'bin': binary,
+        'pattern': pattern,
+        'settings': settings,
+        'panel_descriptors': panel_descriptors,
+        'panel_keypoint_points': np.float32([kp.pt for kp in panel_keypoints]).reshape(-1, 2),
+        'panel_points': np.float32([panel_keypoints[i].pt for i in panel_indexes]).reshape(-1, 2),
+        'pattern_points': pattern.points()[pattern_indexes],
+        'images': {COLOR_IMAGE: board, CLIPPED_IMAGE: board, GRAY_IMAGE: gray, BIN_IMAGE: binary, OUT_IMAGE: COLOR_IMAGE},
+    }
+
+
+@benchmark('ImageService.clip_and_rotate')
+def clip_and_rotate(image_service, f):
+    return lambda: image_service.clip_and_rotate(f['scene'])
+
+@benchmark('ImageService.brightness_equalizer')
+def brightness_equalizer(image_service, f):
+    return lambda: image_service.brightness_equalizer(f['board'])
+
+@benchmark('ImageService.linear_scaling')
+def linear_scaling(image_service, f):
+    return lambda: image_service.linear_scaling(f['board'], 1.5, 50)
+
+@benchmark('ImageService.otsu_binarization')
+def otsu_binarization(image_service, f):
+    return lambda: image_service.otsu_binarization(f['gray'])
+
+@benchmark('ImageService.morphology_opening')
+def morphology_opening(image_service, f):
+    return lambda: image_service.morphology_opening(f['bin'], (10, 10))
+
+@benchmark('ImageService.morphology_closing')
+def morphology_closing(image_service, f):
+    return lambda: image_service.morphology_closing(f['bin'], (10, 10))
+
+@benchmark('ImageService.extract_key_points_and_descriptors')
+def extract_key_points_and_descriptors(image_service, f):
+    return lambda: image_service.extract_key_points_and_descriptors(f['gray'])
+
+@benchmark('ImageService.extract_matches')
+def extract_matches(image_service, f):
+    return lambda: image_service.extract_matches(f['pattern'].descriptors, f['panel_descriptors'])
+
+@benchmark('ImageService.match_pattern')
+def match_pattern(image_service, f):
+    return lambda: image_service.match_pattern(f['pattern'], f['panel_descriptors'])
+
+@benchmark('ImageService.match_pattern_guided')
+def match_pattern_guided(image_service, f):
+    prior = np.float64([[1, 0, 0], [0, 1, 0]])
+    prior[:, 2] = np.median(f['pattern_points'] - f['panel_points'], axis=0)
+    return lambda: image_service.match_pattern_guided(f['pattern'], f['panel_keypoint_points'], f['panel_descriptors'], prior)
+
+@benchmark('ImageService.recognize_pattern')
+def recognize_pattern(image_service, f):
+    index = PatternIndex([f['pattern']])
+    return lambda: image_service.recognize_pattern(index, f['gray'])
+
+@benchmark('ImageService.ransac')
+def ransac(image_service, f):
+    return lambda: image_service.ransac(f['panel_points'], f['pattern_points'], iters=1000, maxerror=2,
+                                        confidence=RANSAC_CONFIDENCE, random_state=np.random.RandomState(0))
+
+@benchmark('ImageService.compare')
+def compare(image_service, f):
+    return lambda: image_service.compare(f['pattern'], dict(f['images']), f['settings'], guided=False)
+
+@benchmark('ImageService.compare_guided')
+def compare_guided(image_service, f):
+    return lambda: image_service.compare(f['pattern'], dict(f['images']), f['settings'], guided=True)
+
+@benchmark('ImageService.mark_errors')
+def mark_errors(image_service, f):
+    images = image_service.compare(f['pattern'], dict(f['images']), f['settings'], guided=False)
+    return lambda: image_service.mark_errors(dict(images), (0, 0, 255))
+
+
+def transformation_setup(cls):
+    def setup(image_service, f):
+        transformation = cls(True)
+        images = dict(f['images'])
+        if cls.process_type == CLIP:
+            images[COLOR_IMAGE] = images[CLIPPED_IMAGE] = f['scene']
+        return lambda: transformation.transform(dict(images))
+    return setup
+
+for cls in avaliable_image_processes:
+    if issubclass(cls, Transformation):
+        benchmark('{0}.transform'.format(cls.__name__))(transformation_setup(cls))
+
+
+def measure(function, repeat):
+    function() # warm up, first call builds indexes and allocates buffers
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run(widths, repeat, names=None):
+    image_service = ImageService()
+    results = []
+    for width in widths:
+        np.random.seed(0)
+        f = fixture(image_service, width)
+        height = f['board'].shape[0]
+        for name, setup in BENCHMARKS:
+            if names and not any(n in name for n in names):
+                continue
+            times = measure(setup(image_service, f), repeat)
+            results.append({
+                'name': name,
+                'width': width,
+                'height': height,
+                'times': times,
+                'min': min(times),
+                'median': statistics.median(times),
+                'mean': statistics.mean(times),
+            })
+            print("{0:<50} {1:>5}x{2:<5} {3:9.2f} ms".format(name, width, height, results[-1]['median'] * 1000), file=sys.stderr)
+    image_service.close()
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    ''' Results with median slower than baseline median by more than tolerance (0.2 = 20 %) '''
+    previous = {(r['name'], r['width']): r for r in baseline['results']}
+    slower = []
+    for result in results:
+        old = previous.get((result['name'], result['width']))
+        if old and result['median'] > old['median'] * (1 + tolerance):
+            slower.append((result, old))
+    return slower
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark image operations on synthetic boards")
+    parser.add_argument('--widths', type=int, nargs='+', default=[640, 1280, 2560], help="board widths in pixels")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs of every benchmark")
+    parser.add_argument('--only', nargs='+', help="run benchmarks whose names contain any of given strings")
+    parser.add_argument('-o', '--output', help="JSON file for results, printed to stdout when missing")
+    parser.add_argument('--baseline', help="JSON file with earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown of median, 0.2 = 20 %%")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'repeat': args.repeat,
+        },
+        'results': run(args.widths, args.repeat, args.only),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(report['results'], json.load(f), args.tolerance)
+        for result, old in slower:
+            print("REGRESSION {0} at {1}: {2:.2f} ms -> {3:.2f} ms".format(
+                result['name'], result['width'], old['median'] * 1000, result['median'] * 1000), file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
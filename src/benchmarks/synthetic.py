@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+SUBSTRATE_BGR = (35, 110, 35)
+COPPER_BGR = (170, 190, 200)
+BACKGROUND_BGR = (30, 30, 200) # red, removed by Clip default hue range
+
+
+def panel(height, width, rng):
+    ''' Gray pcb panel: pads, vias and traces (200) on substrate (60) '''
+    image = np.full((height, width), 60, np.uint8)
+    scale = max(width // 160, 1)
+    for _ in range(height * width // (250 * scale * scale)):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        kind = rng.randint(3)
+        if kind == 0:
+            cv2.rectangle(image, (x, y), (x + rng.randint(3, 12) * scale, y + rng.randint(3, 12) * scale), 200, -1)
+        elif kind == 1:
+            cv2.circle(image, (x, y), rng.randint(2, 6) * scale, 200, -1)
+        else:
+            cv2.line(image, (x, y), (x + rng.randint(-30, 30) * scale, y + rng.randint(-30, 30) * scale), 200, scale)
+    return image
+
+
+def board(width, rows=3, cols=4, defects=3, angle=3, seed=0):
+    '''
+    Synthetic board of rows x cols identical panels with defects, width in pixels.
+    Returns dict with:
+        scene - color board rotated by angle on red background, input for Clip
+        board - color board, axis aligned, as after Clip
+        pattern - gray panel without defects
+        grid - Grid keyword arguments matching board
+    '''
+    rng = np.random.RandomState(seed)
+    margin, gap = max(width // 40, 1), max(width // 60, 1)
+    pcb_width = (width - 2 * margin - (cols - 1) * gap) // cols
+    pcb_height = pcb_width * 3 // 4
+    height = 2 * margin + rows * pcb_height + (rows - 1) * gap
+    pattern = panel(pcb_height, pcb_width, rng)
+
+    gray = np.full((height, width), 60, np.uint8)
+    for r in range(rows):
+        for c in range(cols):
+            y, x = margin + r * (pcb_height + gap), margin + c * (pcb_width + gap)
+            gray[y:y + pcb_height, x:x + pcb_width] = pattern
+    for _ in range(defects):
+        r, c = rng.randint(rows), rng.randint(cols)
+        y = margin + r * (pcb_height + gap) + rng.randint(pcb_height)
+        x = margin + c * (pcb_width + gap) + rng.randint(pcb_width)
+        radius = max(pcb_width // 12, 2)
+        gray[max(y - radius, 0):y + radius, max(x - radius, 0):x + radius] ^= 0xc0 # swaps copper and substrate
+
+    color = np.where(gray[:, :, None] > 128, np.uint8(COPPER_BGR), np.uint8(SUBSTRATE_BGR))
+
+    border = width // 10
+    scene = cv2.copyMakeBorder(color, border, border, border, border, cv2.BORDER_CONSTANT, value=BACKGROUND_BGR)
+    M = cv2.getRotationMatrix2D((scene.shape[1] / 2, scene.shape[0] / 2), angle, 1.0)
+    scene = cv2.warpAffine(scene, M, (scene.shape[1], scene.shape[0]), borderValue=BACKGROUND_BGR)
+
+    grid = dict(
+        x_offset=margin, y_offset=margin, x_between=gap, y_between=gap,
+        pcb_width=pcb_width, pcb_height=pcb_height, n_rows=rows, n_cols=cols
+    )
+    return {'scene': scene, 'board': color, 'pattern': pattern, 'grid': grid}
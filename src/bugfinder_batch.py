@@ -0,0 +1,82 @@
+#!/usr/bin/env python3.4
+'''
+Headless inspection, processes every image waiting in processed_images_path without GUI.
+Usage: bugfinder_batch.py PATTERN SETTINGS [--output DIR] [--store DIR]
+Defects of every image are appended to results store, see ResultsService.
+'''
+import os
+import sys
+import time
+import json
+import argparse
+import cv2
+from settings import *
+from services.image_service import ImageService
+from services.storage_service import StorageService
+from services.pipeline_service import PipelineService
+from services.results_service import ResultsService
+from models.defects import defects_to_json
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Inspect all images waiting in processed images directory")
+    parser.add_argument('pattern', help="name of saved pattern")
+    parser.add_argument('settings', help="name of saved settings")
+    parser.add_argument('-o', '--output', default=RESULTS_DIR, help="directory for marked images and {0}".format(SUMMARY_FILENAME))
+    parser.add_argument('--store', default=RESULTS_STORE_DIR, help="directory of results store")
+    parser.add_argument('--color', default='0,0,255', help="errors marker color as B,G,R")
+    parser.add_argument('--workers', type=int, default=COMPARE_WORKERS, help="number of panels compared at once")
+    parser.add_argument('--executor', choices=['thread', 'process'], default=COMPARE_EXECUTOR)
+    parser.add_argument('--queue-depth', type=int, nargs='+', default=PIPELINE_QUEUE_DEPTHS,
+                        help="images waiting before transform, compare, render and output, one value sets all")
+    parser.add_argument('--profile', action='store_true', help="add time and memory of every step to {0}".format(SUMMARY_FILENAME))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    color = [int(c) for c in args.color.split(',')]
+    storage_service = StorageService()
+    image_service = ImageService()
+
+    if args.pattern not in storage_service.get_avaliable_pattern_names():
+        print("Pattern {0} does not exist".format(args.pattern), file=sys.stderr)
+        return 1
+    settings = storage_service.load_settings(args.settings)
+    if settings is None:
+        print("Settings {0} do not exist".format(args.settings), file=sys.stderr)
+        return 1
+    pattern = storage_service.load_pattern(args.pattern)
+    os.makedirs(args.output, exist_ok=True)
+
+    queue_depths = args.queue_depth[0] if len(args.queue_depth) == 1 else args.queue_depth
+    pipeline = PipelineService(storage_service, image_service, pattern, settings, color, queue_depths, args.workers, args.executor, args.profile)
+    processed = 0
+    start = time.time()
+    with open(os.path.join(args.output, SUMMARY_FILENAME), 'a') as summary, ResultsService(args.store) as store:
+        # images coming during processing are inspected too, images still written are waited for
+        for result in pipeline.run(iter(lambda: storage_service.next_image_filename(wait=True), None)):
+            if result.error is not None:
+                print("{0}: skipped, {1}".format(result.filename, result.error), file=sys.stderr)
+                continue
+            images = result.images
+            defects = result.defects
+            cv2.imwrite(os.path.join(args.output, result.filename), images[images[OUT_IMAGE]])
+            store.append(result.filename, defects, args.pattern, result.seconds())
+            record = {'filename': result.filename, 'defects': defects_to_json(defects), 'seconds': result.seconds()}
+            if args.profile:
+                record['profile'] = result.profiler.record()
+            summary.write(json.dumps(record) + '\n')
+            summary.flush()
+            processed += 1
+            print("{0}: {1} defects, {2:.2f} s".format(result.filename, len(defects), result.seconds()))
+    image_service.close()
+    storage_service.ingestion_service.close()
+
+    total = time.time() - start
+    print("Processed {0} images in {1:.2f} s ({2:.2f} images/s)".format(processed, total, processed / total if total else 0))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+import threading
+from PyQt5.QtCore import QThread, pyqtSignal
+from services.pipeline_service import PipelineService
+from settings import *
+
+
+class InspectionWorker(QThread):
+    '''
+    Inspects images waiting in processed images directory with PipelineService outside of Qt event thread.
+    Takes no more than ready_results images from directory which were not shown yet, every taken result frees one place.
+    New files in directory are picked up while running, worker waits for them when there are none.
+    Source files of results are not archived by worker, receiver archives shown ones and releases discarded ones.
+    Signals are delivered in thread of receiver, so slots of widgets may update them.
+    '''
+    result = pyqtSignal(object) # InspectionResult with images to show
+    error = pyqtSignal(object) # InspectionResult with error
+    progress = pyqtSignal(int, int) # inspected images, images in directory not started yet
+
+    def __init__(self, storage_service, image_service, pattern, settings, color, ready_results=INSPECTION_READY_RESULTS, generation=None):
+        '''
+        pattern, settings, color - passed to PipelineService, pattern may be function recognizing it
+        ready_results - maximal number of images taken from directory and not shown yet, inspected or not
+        generation - stored in every result, so results of replaced worker are recognized
+        '''
+        super().__init__()
+        self.storage_service = storage_service
+        self.pipeline = PipelineService(storage_service, image_service, pattern, settings, color, archive=False)
+        self.generation = generation
+        self._ready = threading.Semaphore(ready_results)
+        self._stop = threading.Event()
+        self._given = set() # taken from directory and not emitted yet
+        self.inspected = 0
+        self.waiting = 0
+
+    def run(self):
+        results = self.pipeline.run(self._filenames())
+        try:
+            for result in results:
+                if result.error is not None: # source file was moved to failed images, nothing to show
+                    self._given.discard(result.filename)
+                    self._ready.release()
+                if self._stop.is_set():
+                    return # not emitted, released below
+                self._given.discard(result.filename)
+                result.generation = self.generation
+                self.inspected += 1
+                self.progress.emit(self.inspected, self.waiting)
+                if result.error is None:
+                    self.result.emit(result)
+                else:
+                    self.error.emit(result)
+        finally:
+            self._stop.set() # unblocks _filenames before pipeline joins its threads
+            results.close()
+            for filename in self._given: # stopped in pipeline, inspected again by next worker
+                self.storage_service.release_image(filename)
+
+    def taken(self):
+        ''' Called when ready result was shown or discarded, worker takes one more image '''
+        self._ready.release()
+
+    def stop(self):
+        '''
+        Asks worker to stop without waiting for it, images not emitted yet stay in directory.
+        Stage which is running is finished first, connect finished signal to know when worker is done.
+        '''
+        self._stop.set()
+
+    def _filenames(self):
+        ''' Files of directory in order while there is place for them, waits for new ones when there are none '''
+        while not self._stop.is_set():
+            if not self._ready.acquire(timeout=PIPELINE_POLL_INTERVAL):
+                continue
+            filename = self.storage_service.next_image_filename()
+            while filename is None:
+                if self._stop.wait(INGESTION_POLL_INTERVAL):
+                    return
+                filename = self.storage_service.next_image_filename()
+            self._given.add(filename)
+            self.waiting = len(self.storage_service.ingestion_service)
+            yield filename
@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 import os
 import cv2
+import threading
+from collections import deque
 from views.widgets import MainWidget, SettingsWidget, PatternWidget
+from controllers.inspection_worker import InspectionWorker
 from services.image_service import ImageService
 from services.storage_service import StorageService
 from settings import *
 from models.settings import Settings
 from models.pattern import Pattern
 from decorators import wait_cursor
+from errors import RecognitionError
 
-from PyQt5.QtWidgets import QMainWindow, QWidget, QMenuBar, QMenu, QAction, QToolBar, QStackedWidget, QFileDialog, QComboBox, QColorDialog, QLabel
+from PyQt5.QtWidgets import QMainWindow, QWidget, QMenuBar, QMenu, QAction, QToolBar, QStackedWidget, QFileDialog, QComboBox, QColorDialog, QLabel, QMessageBox
 from PyQt5.QtGui import QIcon, QColor
 
 class MainWindow(QMainWindow):
@@ -36,10 +40,22 @@ class MainWindow(QMainWindow):
         self.selected_settings_name = None
         self.pattern = None
         self.settings = None
+        self.recognized_patterns = {} # name -> Pattern loaded for PATTERN_AUTO_NAME
+        self.patterns_lock = threading.Lock() # recognized_patterns is used by inspection worker too
+        self.inspection_worker = None
+        self.inspection_generation = 0 # of current worker, results of other workers are not shown
+        self.stopping_workers = set() # stopped workers which have not finished yet
+        self.ready_results = deque() # InspectionResult inspected but not shown yet, source files are still in directory
+        self.waiting_for_result = False # next image was requested and nothing was ready
+        self.inspected = 0 # images inspected by current worker
+        self.waiting = 0 # images in directory it has not started yet
         self._create_actions()
         self._set_menu_bar()
         self._set_tool_bar()
+        self.inspection_label = QLabel(self)
+        self.statusBar().addPermanentWidget(self.inspection_label)
         self.errors_color = QColor(255,0,0)
+        self.app.aboutToQuit.connect(self._quit_inspection)
 
     def _create_actions(self):
         self.new_pattern_action = QAction(QIcon(os.path.join(ICONS_DIR, 'add.png')), "New pattern", self)
@@ -52,6 +68,11 @@ class MainWindow(QMainWindow):
         self.next_image_action.triggered.connect(self._next_image_action_handler)
         self.next_image_action.setEnabled(False)
 
+        self.auto_advance_action = QAction("Auto advance", self)
+        self.auto_advance_action.setCheckable(True)
+        self.auto_advance_action.toggled.connect(self._auto_advance_action_handler)
+        self.auto_advance_action.setEnabled(False)
+
         self.errors_color_action = QAction(QIcon(os.path.join(ICONS_DIR, 'color.png')), "Errors marker", self)
         self.errors_color_action.triggered.connect(self._errors_color_action_handler)
 
@@ -61,8 +82,7 @@ class MainWindow(QMainWindow):
 
     def _create_pattern_combo(self):
         self.pattern_combo = QComboBox(self)
-        avaliable_pcbs = self.storage_service.get_avaliable_pattern_names()
-        for name in avaliable_pcbs:
+        for name in self._pattern_combo_names():
             self.pattern_combo.addItem(name)
 
         self.pattern_combo.activated[str].connect(self._selected_pattern_action_handler)
@@ -75,6 +95,10 @@ class MainWindow(QMainWindow):
 
         self.settings_combo.activated[str].connect(self._selected_settings_action_handler)
 
+    def _pattern_combo_names(self):
+        names = self.storage_service.get_avaliable_pattern_names()
+        return names[:1] + [PATTERN_AUTO_NAME] + names[1:]
+
     def _set_menu_bar(self):
         menu_bar = self.menuBar()
         menu_file = menu_bar.addMenu('File')
@@ -97,6 +121,7 @@ class MainWindow(QMainWindow):
         self.tool_bar.addSeparator()
 
         self.tool_bar.addAction(self.next_image_action)
+        self.tool_bar.addAction(self.auto_advance_action)
 
     def _new_pattern_action_handler(self):
         file_dialog = QFileDialog(self)
@@ -130,52 +155,166 @@ class MainWindow(QMainWindow):
 
     def _next_image_action_handler(self):
         #all requirements met, don't check again
-        image_orig = self.storage_service.next_image()
-        if image_orig != None:
-            with wait_cursor():
-                images = self.image_service.transform_image(image_orig, self.settings)
-                images = self.image_service.compare(self.pattern, images, self.settings)
-                bgr = [
-                    self.errors_color.blue(),
-                    self.errors_color.green(),
-                    self.errors_color.red()
-                ]
-                images = self.image_service.mark_errors(images, bgr)
-                self.stacked_widget.removeWidget(self.main_widget)
-                self.main_widget = MainWidget(self)
-                self.stacked_widget.addWidget(self.main_widget)
-                self.stacked_widget.setCurrentWidget(self.main_widget)
-                self.main_widget.setImage(images)
+        if self.ready_results:
+            self._show_next_result()
+        else:
+            self.waiting_for_result = True
+            self.statusBar().showMessage("Inspecting next image...")
+            self._start_inspection()
+
+    def _auto_advance_action_handler(self, checked):
+        if checked:
+            self._start_inspection()
+            if self.ready_results:
+                self._show_next_result()
+
+    def _start_inspection(self):
+        ''' Starts worker inspecting images with selected pattern, settings and errors color, unless it is running '''
+        if self.inspection_worker is not None:
+            return
+        bgr = [
+            self.errors_color.blue(),
+            self.errors_color.green(),
+            self.errors_color.red()
+        ]
+        pattern = self._image_pattern if self.selected_pattern_name == PATTERN_AUTO_NAME else self.pattern
+        self.inspection_generation += 1
+        self.inspection_worker = InspectionWorker(self.storage_service, self.image_service, pattern, self.settings, bgr, generation=self.inspection_generation)
+        self.inspection_worker.finished.connect(self._inspection_finished_handler)
+        self.inspection_worker.result.connect(self._inspection_result_handler)
+        self.inspection_worker.error.connect(self._inspection_error_handler)
+        self.inspection_worker.progress.connect(self._inspection_progress_handler)
+        self.inspection_worker.start()
+
+    def _stop_inspection(self):
+        ''' Asks worker to stop without waiting for it, results it has already emitted stay ready to be shown '''
+        if self.inspection_worker is not None:
+            self.inspection_worker.stop()
+            self.stopping_workers.add(self.inspection_worker)
+            self.inspection_worker = None
+
+    def _quit_inspection(self):
+        ''' Stops worker and waits for all workers, so they release images they have not inspected '''
+        self._stop_inspection()
+        for worker in list(self.stopping_workers):
+            worker.wait()
+
+    def _restart_inspection(self):
+        ''' Inspects next images with changed pattern, settings or errors color, ready results are inspected again '''
+        running = self.inspection_worker is not None
+        self._stop_inspection()
+        while self.ready_results:
+            self.storage_service.release_image(self.ready_results.popleft().filename)
+        self._update_inspection_label()
+        if running and self.next_image_action.isEnabled():
+            self._start_inspection()
+
+    def _inspection_finished_handler(self):
+        worker = self.sender()
+        self.stopping_workers.discard(worker)
+        if worker is self.inspection_worker: # failed
+            self.inspection_worker = None
+        worker.deleteLater()
+
+    def _inspection_result_handler(self, result):
+        if self.inspection_worker is None or result.generation != self.inspection_generation:
+            self.storage_service.release_image(result.filename) # emitted before its worker was stopped
+            return
+        self.ready_results.append(result)
+        self._update_inspection_label()
+        if self.waiting_for_result or self.auto_advance_action.isChecked():
+            self._show_next_result()
+
+    def _inspection_error_handler(self, result):
+        if result.generation != self.inspection_generation:
+            return
+        message = "{0}: {1}".format(result.filename, result.error)
+        if isinstance(result.error, RecognitionError) and self.waiting_for_result and not self.auto_advance_action.isChecked():
+            QMessageBox.warning(self, "Pattern", message)
+        else:
+            self.statusBar().showMessage(message)
+
+    def _inspection_progress_handler(self, inspected, waiting):
+        self.inspected, self.waiting = inspected, waiting
+        self._update_inspection_label()
+
+    def _update_inspection_label(self):
+        self.inspection_label.setText("Inspected: {0}, ready: {1}, waiting: {2}".format(self.inspected, len(self.ready_results), self.waiting))
+
+    def _show_next_result(self):
+        result = self.ready_results.popleft()
+        try:
+            self.storage_service.archive_image(result.filename)
+        except OSError: # removed by someone else, result is shown anyway
+            pass
+        if self.inspection_worker is not None and result.generation == self.inspection_generation:
+            self.inspection_worker.taken()
+        self.waiting_for_result = False
+        self._update_inspection_label()
+        if self.selected_pattern_name == PATTERN_AUTO_NAME:
+            self.statusBar().showMessage("Recognized pattern: {0}".format(result.pattern.name))
+        else:
+            self.statusBar().clearMessage()
+        self.stacked_widget.removeWidget(self.main_widget)
+        self.main_widget = MainWidget(self)
+        self.stacked_widget.addWidget(self.main_widget)
+        self.stacked_widget.setCurrentWidget(self.main_widget)
+        self.main_widget.setImage(result.images)
+
+    def _image_pattern(self, images):
+        '''
+        Pattern recognized on gray image when PATTERN_AUTO_NAME is selected, None when not recognized.
+        Called by inspection worker.
+        '''
+        name = self.image_service.recognize_pattern(self.storage_service.pattern_index(), images[GRAY_IMAGE])
+        if name is None:
+            return None
+        with self.patterns_lock:
+            if name not in self.recognized_patterns:
+                self.recognized_patterns[name] = self.storage_service.load_pattern(name)
+            return self.recognized_patterns[name]
 
     def _errors_color_action_handler(self):
         color = QColorDialog.getColor()
         if color.isValid():
             self.errors_color = color
+            self._restart_inspection()
 
     def _selected_pattern_action_handler(self, name):
         self.selected_pattern_name = name
-        self.pattern = self.storage_service.load_pattern(self.selected_pattern_name)
+        if name == PATTERN_AUTO_NAME:
+            with wait_cursor():
+                self.storage_service.pattern_index()
+            self.pattern = None
+        else:
+            self.pattern = self.storage_service.load_pattern(self.selected_pattern_name)
         self._toggle_next_image_action()
+        self._restart_inspection()
     
     def _selected_settings_action_handler(self, name):
         self.selected_settings_name = name
         self.settings = self.storage_service.load_settings(self.selected_settings_name)    
         self._toggle_next_image_action()
+        self._restart_inspection()
 
     def _toggle_next_image_action(self):
         if self.selected_pattern_name and self.selected_pattern_name != PATTERN_COMBO_NAME and self.selected_settings_name and self.selected_settings_name != SETTINGS_COMBO_NAME:
             self.next_image_action.setEnabled(True)
+            self.auto_advance_action.setEnabled(True)
         else:
             self.next_image_action.setEnabled(False)
+            self.auto_advance_action.setEnabled(False)
+            self._stop_inspection()
 
     ### PUBLIC METHODS ###
 
     def pattern_finished(self, pattern_name):
         if pattern_name:
             self.pattern_combo.clear()
-            avaliable_pattern_names = self.storage_service.get_avaliable_pattern_names()
-            for name in avaliable_pattern_names:
+            for name in self._pattern_combo_names():
                 self.pattern_combo.addItem(name)
+            with self.patterns_lock:
+                self.recognized_patterns.pop(pattern_name, None)
             index = self.pattern_combo.findText(pattern_name);
             self.pattern_combo.setCurrentIndex(index)
             self.selected_pattern_name = pattern_name
@@ -1,2 +1,8 @@
 class TransformationError(Exception):
     pass
+
+class RecognitionError(Exception):
+    pass
+
+class RegistrationError(Exception):
+    pass
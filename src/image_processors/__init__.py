@@ -1,21 +1,52 @@
-import pkgutil
+'''
+Image processes are imported only when needed, classes register themselves in ImageProcess.registry
+when their module is imported. avaliable_image_processes imports all of them on first use.
+'''
 import importlib
-import image_processors
-import inspect
-import image_processors.abc
-
-
-abc_classes = set()
-abstract_modules = list(pkgutil.iter_modules(image_processors.abc.__path__))
-for _, name, _ in abstract_modules:
-    module = importlib.import_module('image_processors.abc.{0}'.format(name))
-    classes = [getattr(module, c) for c in dir(module) if inspect.isclass(getattr(module, c))]
-    abc_classes |= set(c for c in classes if issubclass(c, image_processors.abc.image_process.ImageProcess))
-
-image_process_classes = set()
-for importer, name, ispkg in pkgutil.iter_modules(image_processors.__path__):
-    if not ispkg:
-        module = importlib.import_module('image_processors.{0}'.format(name))
-        classes = [getattr(module, c) for c in dir(module) if inspect.isclass(getattr(module, c))]
-        image_process_classes |= set(c for c in classes if issubclass(c, image_processors.abc.image_process.ImageProcess))
-avaliable_image_processes = sorted([c for c in (image_process_classes - abc_classes)], key=lambda c: (c.process_type, c.priority))
+
+
+# class name -> module of image_processors, processes missing here are found by importing every module
+PROCESS_MODULES = {
+    'BgrToGray': 'bgr_to_gray',
+    'BrightnessEqualizer': 'brightness_equalizer',
+    'Clip': 'clip',
+    'GaussianBlur': 'gaussian_blur',
+    'Grid': 'grid',
+    'LinearScaling': 'liner_scaling',
+    'MorphologyOpening': 'morphology',
+    'MorphologyClosing': 'morphology',
+    'OtsuBinarization': 'otsu',
+}
+
+_all_imported = False
+
+
+def image_process_class(name):
+    ''' Class of image process called name, imports only its module, None for unknown name '''
+    from image_processors.abc.image_process import ImageProcess
+    if name not in ImageProcess.registry:
+        if name in PROCESS_MODULES:
+            importlib.import_module('image_processors.{0}'.format(PROCESS_MODULES[name]))
+        else:
+            _import_all()
+    return ImageProcess.registry.get(name)
+
+
+def _import_all():
+    global _all_imported
+    if not _all_imported:
+        import pkgutil # imports typing, not needed when every process is in PROCESS_MODULES
+        for _, name, ispkg in pkgutil.iter_modules(__path__):
+            if not ispkg:
+                importlib.import_module('image_processors.{0}'.format(name))
+        _all_imported = True
+
+
+def __getattr__(name):
+    if name == 'avaliable_image_processes':
+        from image_processors.abc.image_process import ImageProcess
+        _import_all()
+        processes = sorted(ImageProcess.registry.values(), key=lambda c: (c.process_type, c.priority))
+        globals()[name] = processes
+        return processes
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
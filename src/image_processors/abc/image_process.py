@@ -1,9 +1,7 @@
 from settings import *
-import importlib 
-import pkgutil
-from services.image_service import ImageService
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
-import image_processors
+import copy
+from services.service_context import ServiceContext
+from image_processors import image_process_class
 
 TYPES = [CLIP, COLOR, GRAY, BINARY, SPLIT]
 
@@ -11,21 +9,32 @@ TYPES = [CLIP, COLOR, GRAY, BINARY, SPLIT]
 
 class ImageProcess(object):
     SELECTED = 'selected'
+    registry = {} # class name -> class of every image process outside abc package, filled when its module is imported
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not cls.__module__.startswith('image_processors.abc'):
+            ImageProcess.registry[cls.__name__] = cls
+
+    context = ServiceContext() # shared by all processes, instance or subclass may set its own
+
     def __init__(self, selected):
-        self.image_service = ImageService()
         self.selected = selected
 
+    @property
+    def image_service(self):
+        return self.context.image_service
+
     def __eq__(self, other):
         return self.selected == other.selected
 
     @classmethod
     def from_json(cls, json):
-        for importer, name, ispkg in pkgutil.iter_modules(image_processors.__path__):
-            module = importlib.import_module('image_processors.{0}'.format(name))
-            image_process_class = getattr(module, json['name'], None)
-            if image_process_class:
-                return image_process_class.from_json(json)
-                                                                                                      
+        ''' Image process of class json['name'] from registry, None for unknown name '''
+        process_class = image_process_class(json['name'])
+        if process_class:
+            return process_class.from_json(json)
+
     def process(self, images, *args, **kwargs):
         ''' 
         Images is a dict of images, override it's content only if necesary, might be usefull for other functions later.
@@ -37,13 +46,38 @@ class ImageProcess(object):
     def serialize(self):
         raise NotImplementedError("serialize method must be implemented")
 
+    def scaled(self, factor):
+        '''
+        Process for image resized by factor, used by proxy preview.
+        Processes with parameters given in pixels return copy with these parameters scaled.
+        '''
+        return self
+
+    def _scaled_copy(self, **attributes):
+        process = copy.copy(self)
+        process.__dict__.update(attributes)
+        return process
+
+    @staticmethod
+    def _scaled_kernel(kernel, factor, odd=False):
+        ''' Kernel dimensions multiplied by factor, at least 1, rounded up to odd when odd is set '''
+        scaled = []
+        for size in kernel:
+            size = max(int(round(size * factor)), 1)
+            if odd and size % 2 == 0:
+                size += 1
+            scaled.append(size)
+        return tuple(scaled)
+
     def gui(self, image_widget):
+        ''' Qt widgets are imported inside gui methods, so processing works without PyQt5 '''
         self.image_widget = image_widget
 
     def _checked_action_handler(self, checked):
         self.selected = checked
 
     def _create_double_spin_box(self, minimum, maximum, value, handler, step=1, suffix=''):
+        from PyQt5.QtWidgets import QDoubleSpinBox
         spin_box = QDoubleSpinBox()
         spin_box.setMinimum(minimum)
         spin_box.setMaximum(maximum)
@@ -54,6 +88,7 @@ class ImageProcess(object):
         return spin_box
 
     def _create_spin_box(self, minimum, maximum, value, handler, step=1, suffix=''):
+        from PyQt5.QtWidgets import QSpinBox
         spin_box = QSpinBox()
         spin_box.setMinimum(minimum)
         spin_box.setMaximum(maximum)
@@ -64,6 +99,7 @@ class ImageProcess(object):
         return spin_box
 
     def _set_grid_row(self, grid_layout, row, col, label, tooltip, widget):
+        from PyQt5.QtWidgets import QLabel
         qlabel = QLabel(label)
         qlabel.setToolTip(tooltip)
         grid_layout.addWidget(QLabel(label), row, col)
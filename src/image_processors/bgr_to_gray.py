@@ -1,7 +1,6 @@
 from settings import *
 from errors import TransformationError
 from image_processors.abc.transformation import Transformation
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 class BgrToGray(Transformation):
     priority = 1
@@ -31,6 +30,7 @@ class BgrToGray(Transformation):
         }
     
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QWidget, QHBoxLayout, QCheckBox
         super().gui(image_widget)
         self.widget = QWidget()
         self.hbox = QHBoxLayout()
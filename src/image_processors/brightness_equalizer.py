@@ -1,7 +1,6 @@
 from settings import *
 from errors import TransformationError
 from image_processors.abc.transformation import Transformation
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 class BrightnessEqualizer(Transformation):
     priority = 2
@@ -40,6 +39,7 @@ class BrightnessEqualizer(Transformation):
         }
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QHBoxLayout, QLabel
         super().gui(image_widget)
         self.group_box = QGroupBox()
         self.hbox = QHBoxLayout()
@@ -1,12 +1,11 @@
 from settings import *
 from image_processors.abc.transformation import Transformation
 from errors import TransformationError
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 class Clip(Transformation):
     priority = 1
     process_type = CLIP
-    def __init__(self, selected=False, gaussian_blur=(15, 15), lower_h=15, lower_s=0, lower_v=0, upper_h=165, upper_s=255, upper_v=255, canny_min=100, canny_max=100):
+    def __init__(self, selected=False, gaussian_blur=(15, 15), lower_h=15, lower_s=0, lower_v=0, upper_h=165, upper_s=255, upper_v=255, canny_min=100, canny_max=100, scale=1.0):
         super().__init__(selected)
         self.gaussian_blur = gaussian_blur
         self.lower_h = lower_h
@@ -17,6 +16,7 @@ class Clip(Transformation):
         self.upper_v = upper_v
         self.canny_min = canny_min
         self.canny_max = canny_max
+        self.scale = scale # below 1 board is searched on image resized by scale
 
     def __eq__(self, other):
         return (super().__eq__(other) 
@@ -29,6 +29,7 @@ class Clip(Transformation):
             and self.upper_v == other.upper_v
             and self.canny_min == other.canny_min
             and self.canny_max == other.canny_max
+            and self.scale == other.scale
         )
         
     @classmethod
@@ -44,6 +45,7 @@ class Clip(Transformation):
             json['upper_v'],
             json['canny_min'],
             json['canny_max'],
+            json.get('scale', 1.0),
         )
 
     def transform(self, images, *args, **kwargs):
@@ -55,7 +57,8 @@ class Clip(Transformation):
                     (self.lower_h, self.lower_s, self.lower_v),
                     (self.upper_h, self.upper_s, self.upper_v),
                     self.canny_min,
-                    self.canny_max
+                    self.canny_max,
+                    self.scale
                 )
                 images[OUT_IMAGE] = COLOR_IMAGE
                 images[CLIPPED_IMAGE] = images[COLOR_IMAGE]
@@ -64,6 +67,12 @@ class Clip(Transformation):
         return images
    
 
+    def scaled(self, factor):
+        return self._scaled_copy(
+            gaussian_blur=self._scaled_kernel(self.gaussian_blur, factor, odd=True),
+            scale=min(self.scale / factor, 1.0) # board is searched at the same resolution
+        )
+
     def serialize(self):
         return {
             'name': 'Clip',
@@ -77,9 +86,11 @@ class Clip(Transformation):
             'upper_v': self.upper_v,
             'canny_min': self.canny_min,
             'canny_max': self.canny_max,
+            'scale': self.scale,
         }
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QGridLayout
         super().gui(image_widget)
         self.group_box = QGroupBox()
         self.grid_layout = QGridLayout()
@@ -100,6 +111,7 @@ class Clip(Transformation):
 
         self.canny_min_spin_box = self._create_spin_box(0, 1000, self.canny_min, self._canny_min_value_changed_handler)
         self.canny_max_spin_box = self._create_spin_box(0, 1000, self.canny_max, self._canny_max_value_changed_handler)
+        self.scale_spin_box = self._create_double_spin_box(0.05, 1, self.scale, self._scale_value_changed_handler, step=0.05)
 
         self._set_grid_row(self.grid_layout, 0, 0, "Gaussian blur", "Higher value means more blurred effect", self.gaussian_blur_spin_box)
         self._set_grid_row(self.grid_layout, 0, 2, "Canny min", "Canny lower threshold value", self.canny_min_spin_box)
@@ -110,6 +122,7 @@ class Clip(Transformation):
         self._set_grid_row(self.grid_layout, 2, 0, "Upper hue", "Upper hue for image filtering", self.upper_h_spin_box)
         self._set_grid_row(self.grid_layout, 2, 2, "Upper saturation", "Upper saturation for image filtering", self.upper_s_spin_box)
         self._set_grid_row(self.grid_layout, 2, 4, "Upper value", "Upper value for image filtering", self.upper_v_spin_box)
+        self._set_grid_row(self.grid_layout, 3, 0, "Search scale", "Board is searched on image resized by this scale, 1 searches full resolution", self.scale_spin_box)
 
         return self.group_box
 
@@ -139,3 +152,6 @@ class Clip(Transformation):
 
     def _canny_max_value_changed_handler(self, value):
         self.canny_max = value
+
+    def _scale_value_changed_handler(self, value):
+        self.scale = value
@@ -1,7 +1,6 @@
 from settings import *
 from image_processors.abc.transformation import Transformation
 from errors import TransformationError
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 class GaussianBlur(Transformation):
     priority = 2
@@ -31,6 +30,9 @@ class GaussianBlur(Transformation):
                 
         return images
 
+    def scaled(self, factor):
+        return self._scaled_copy(kernel=self._scaled_kernel(self.kernel, factor, odd=True))
+
     def serialize(self):
         return {
             'name': 'GaussianBlur',
@@ -39,6 +41,7 @@ class GaussianBlur(Transformation):
         }
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QHBoxLayout, QLabel
         super().gui(image_widget)
         self.group_box = QGroupBox()
         self.hbox = QHBoxLayout()
@@ -1,7 +1,6 @@
 from settings import *
 from image_processors.abc.split import Split
 from errors import TransformationError
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 class Grid(Split):
     priority = 1
@@ -48,7 +47,7 @@ class Grid(Split):
         height, width = images[images[OUT_IMAGE]].shape[:2]
         y_margin = self.pcb_height / 10
         x_margin = self.pcb_width / 10
-        margin = min(x_margin, y_margin)
+        margin = int(min(x_margin, y_margin))
         slices = []
         for r in range(self.n_rows):
             y1 = self.y_offset + r*(self.pcb_height + self.y_between)
@@ -59,6 +58,12 @@ class Grid(Split):
                 slices.append((max(y1-margin, 0), min(y2+margin,height), max(x1-margin, 0), min(x2+margin, width)))
         return slices
 
+    def scaled(self, factor):
+        return self._scaled_copy(**dict(
+            (name, int(round(getattr(self, name) * factor)))
+            for name in ['x_offset', 'y_offset', 'x_between', 'y_between', 'pcb_width', 'pcb_height']
+        ))
+
     def serialize(self):
         return {
             'name': 'Grid',
@@ -88,6 +93,7 @@ class Grid(Split):
         return lines
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QGridLayout
         super().gui(image_widget)
         self.group_box = QGroupBox(GRID)
         grid_layout = QGridLayout()
@@ -1,7 +1,6 @@
 from settings import *
 from image_processors.abc.transformation import Transformation
 from errors import TransformationError
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 class LinearScaling(Transformation):
     priority = 3
@@ -44,6 +43,7 @@ class LinearScaling(Transformation):
         }
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QHBoxLayout, QLabel
         super().gui(image_widget)
         self.group_box = QGroupBox()
         self.hbox = QHBoxLayout()
@@ -1,7 +1,6 @@
 from settings import *
 from image_processors.abc.transformation import Transformation
 from errors import TransformationError
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QGroupBox, QGridLayout, QLabel, QMessageBox
 
 
 class MorphologyOpening(Transformation):
@@ -31,6 +30,9 @@ class MorphologyOpening(Transformation):
                 raise TransformationError("Morphology - opening transformation requires binary image")
         return images
 
+    def scaled(self, factor):
+        return self._scaled_copy(kernel=self._scaled_kernel(self.kernel, factor))
+
     def serialize(self):
         return {
             'name': 'MorphologyOpening',
@@ -39,6 +41,7 @@ class MorphologyOpening(Transformation):
         }
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QHBoxLayout, QLabel
         super().gui(image_widget)
         self.group_box = QGroupBox()
         self.hbox = QHBoxLayout()
@@ -85,6 +88,9 @@ class MorphologyClosing(Transformation):
                 raise TransformationError("Morphology - closing transformation requires binary image")
         return images
 
+    def scaled(self, factor):
+        return self._scaled_copy(kernel=self._scaled_kernel(self.kernel, factor))
+
     def serialize(self):
         return {
             'name': 'MorphologyClosing',
@@ -93,6 +99,7 @@ class MorphologyClosing(Transformation):
         }
 
     def gui(self, image_widget):
+        from PyQt5.QtWidgets import QGroupBox, QHBoxLayout, QLabel
         super().gui(image_widget)
         self.group_box = QGroupBox()
         self.hbox = QHBoxLayout()
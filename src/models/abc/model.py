@@ -1,6 +1,6 @@
 from image_processors.abc.transformation import Transformation
 from image_processors.abc.split import Split
-from image_processors import avaliable_image_processes
+import image_processors
 
 class Model(object):
     def __init__(self, name = None, image_processes=None):
@@ -9,8 +9,9 @@ class Model(object):
             self.transformations = [t for t in image_processes if isinstance(t, Transformation)]
             self.splits = [s for s in image_processes if isinstance(s, Split)]
         else:
-            self.transformations = [t() for t in avaliable_image_processes if issubclass(t, Transformation)]
-            self.splits = [s() for s in avaliable_image_processes if issubclass(s, Split)]
+            processes = image_processors.avaliable_image_processes
+            self.transformations = [t() for t in processes if issubclass(t, Transformation)]
+            self.splits = [s() for s in processes if issubclass(s, Split)]
 
     def __eq__(self, other):
         return self.name == other.name and self.image_processes() == other.image_processes()
@@ -25,3 +26,9 @@ class Model(object):
     def image_processes(self):
         return self.transformations + self.splits
 
+    def scaled(self, factor):
+        ''' Model for image resized by factor, see ImageProcess.scaled '''
+        if factor == 1:
+            return self
+        return Model(self.name, [p.scaled(factor) for p in self.image_processes()])
+
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+DEFECT_DTYPE = np.dtype([
+    ('x', '<i4'), # bounding box in frame pixels
+    ('y', '<i4'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('area', '<i4'),
+    ('cx', '<f4'), # centroid
+    ('cy', '<f4'),
+    ('panel', '<i4'), # index of panel of split containing centroid, -1 outside all panels
+])
+
+
+def scaled_defects(defects, factor):
+    ''' Defects of image resized by factor, boxes are rounded outwards '''
+    if factor == 1:
+        return defects
+    scaled = defects.copy()
+    x2 = np.ceil((defects['x'] + defects['width']) * factor)
+    y2 = np.ceil((defects['y'] + defects['height']) * factor)
+    scaled['x'] = np.floor(defects['x'] * factor)
+    scaled['y'] = np.floor(defects['y'] * factor)
+    scaled['width'] = x2 - scaled['x']
+    scaled['height'] = y2 - scaled['y']
+    scaled['area'] = np.round(defects['area'] * factor * factor)
+    scaled['cx'] = (defects['cx'] + 0.5) * factor - 0.5 # pixel centers
+    scaled['cy'] = (defects['cy'] + 0.5) * factor - 0.5
+    return scaled
+
+
+def defects_to_json(defects):
+    ''' Structured array of DEFECT_DTYPE as list of dicts for JSON '''
+    return [
+        {
+            'box': [int(d['x']), int(d['y']), int(d['width']), int(d['height'])],
+            'area': int(d['area']),
+            'centroid': [round(float(d['cx']), 2), round(float(d['cy']), 2)],
+            'panel': int(d['panel']),
+        }
+        for d in defects
+    ]
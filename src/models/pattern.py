@@ -1,14 +1,76 @@
 from models.abc.model import Model
 import numpy as np
+import cv2
+import threading
+from settings import *
+
+
+KEYPOINT_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('size', '<f4'),
+    ('angle', '<f4'),
+    ('response', '<f4'),
+    ('octave', '<i4'),
+    ('class_id', '<i4'),
+])
 
 
 class Pattern(Model):
-    def __init__(self, name=None, image=None, keypoints=[], descriptors=None, image_processes=[]):
+    def __init__(self, name=None, image=None, keypoints=[], descriptors=None, image_processes=[], keypoint_tiles=(1, 1)):
         super().__init__(name, image_processes)
+        self._index_lock = threading.Lock()
+        self.keypoint_tiles = tuple(keypoint_tiles) # keypoints were detected in these tiles, images are detected the same way
         self.image = image
         self.keypoints = keypoints
         self.descriptors = descriptors
 
+    @property
+    def keypoints(self):
+        ''' List of cv2.KeyPoint, created from keypoint_array on first use '''
+        if self._keypoints is None:
+            self._keypoints = [
+                cv2.KeyPoint(float(kp['x']), float(kp['y']), float(kp['size']), float(kp['angle']), float(kp['response']), int(kp['octave']), int(kp['class_id']))
+                for kp in self._keypoint_array
+            ]
+        return self._keypoints
+
+    @keypoints.setter
+    def keypoints(self, keypoints):
+        self._keypoints = keypoints
+        self._keypoint_array = None
+        self._points = None
+        self._point_grid = None
+        self._scaled = None
+
+    @property
+    def keypoint_array(self):
+        ''' Keypoints as structured array of KEYPOINT_DTYPE '''
+        if self._keypoint_array is None:
+            self._keypoint_array = np.array(
+                [(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id) for kp in self._keypoints],
+                dtype=KEYPOINT_DTYPE
+            )
+        return self._keypoint_array
+
+    @keypoint_array.setter
+    def keypoint_array(self, keypoint_array):
+        self._keypoint_array = keypoint_array
+        self._keypoints = None
+        self._points = None
+        self._point_grid = None
+        self._scaled = None
+
+    @property
+    def descriptors(self):
+        return self._descriptors
+
+    @descriptors.setter
+    def descriptors(self, descriptors):
+        self._descriptors = descriptors
+        self._matcher_index = None
+        self._scaled = None
+
     def __eq__(self, other):
         def keypoints_equal(kp1, kp2):
             return (
@@ -32,5 +94,72 @@ class Pattern(Model):
             return super().__eq__(other) and True
         return False
 
-    
+    def __getstate__(self):
+        ''' Only data needed for comparison is pickled, memory mapped arrays are pickled as plain arrays '''
+        return {
+            'name': self.name,
+            'image': np.asarray(self.image),
+            'keypoint_array': np.asarray(self.keypoint_array),
+            'descriptors': np.asarray(self.descriptors),
+            'keypoint_tiles': self.keypoint_tiles,
+        }
+
+    def __setstate__(self, state):
+        self._index_lock = threading.Lock()
+        self.name = state['name']
+        self.image = state['image']
+        self.keypoint_array = state['keypoint_array']
+        self.descriptors = state['descriptors']
+        self.keypoint_tiles = state['keypoint_tiles']
+        self.transformations = []
+        self.splits = []
+
+    def points(self):
+        ''' Keypoint coordinates as Nx2 float32 array '''
+        if self._points is None:
+            self._points = np.column_stack((self.keypoint_array['x'], self.keypoint_array['y'])).astype(np.float32)
+        return self._points
+
+    def point_grid(self, cell_size):
+        '''
+        Keypoints bucketed into square cells of cell_size, returns (order, starts, n_cols, n_rows).
+        Keypoints of cell (row, col) are order[starts[i]:starts[i + 1]], i = row * n_cols + col.
+        '''
+        if self._point_grid is None or self._point_grid[0] != cell_size:
+            cells = np.floor(self.points() / cell_size).astype(np.int64)
+            n_cols, n_rows = (cells.max(axis=0) + 1) if len(cells) else (0, 0)
+            keys = cells[:, 1] * n_cols + cells[:, 0]
+            order = np.argsort(keys, kind='stable')
+            starts = np.searchsorted(keys[order], np.arange(n_cols * n_rows + 1))
+            self._point_grid = (cell_size, (order, starts, int(n_cols), int(n_rows)))
+        return self._point_grid[1]
+
+    def scaled(self, factor):
+        '''
+        Pattern for frames resized by factor: binary image resized and thresholded again, keypoint coordinates
+        and sizes multiplied by factor, descriptors shared. Kept until next call with other factor,
+        so the same scaled pattern is compared with every image.
+        '''
+        if factor == 1:
+            return self
+        if self._scaled is None or self._scaled[0] != factor:
+            height, width = self.image.shape[:2]
+            size = (max(int(round(width * factor)), 1), max(int(round(height * factor)), 1))
+            _, image = cv2.threshold(cv2.resize(np.asarray(self.image), size, interpolation=cv2.INTER_AREA), 127, 255, cv2.THRESH_BINARY)
+            keypoint_array = np.array(self.keypoint_array)
+            for name in ['x', 'y']: # pixel centers are scaled, as by resize
+                keypoint_array[name] = (keypoint_array[name] + 0.5) * factor - 0.5
+            keypoint_array['size'] *= factor
+            pattern = Pattern(self.name, image, descriptors=self.descriptors, keypoint_tiles=self.keypoint_tiles)
+            pattern.keypoint_array = keypoint_array
+            self._scaled = (factor, pattern)
+        return self._scaled[1]
 
+    def matcher_index(self):
+        ''' FLANN LSH index over descriptors, built on first use and shared by every match against the pattern '''
+        with self._index_lock:
+            if self._matcher_index is None:
+                self._index_features = np.ascontiguousarray(self.descriptors, np.uint8)
+                cv2.setRNGSeed(LSH_INDEX_SEED) # same hash tables in every thread and process
+                self._matcher_index = cv2.flann_Index(self._index_features, LSH_INDEX_PARAMS)
+            return self._matcher_index
@@ -0,0 +1,72 @@
+import numpy as np
+import cv2
+import threading
+from settings import *
+
+
+class PatternIndex(object):
+    '''
+    Descriptors of many patterns in FLANN LSH indexes, every descriptor labelled with index of its pattern in names.
+    Added pattern gets a segment of its own which is merged with previous segments not larger than it,
+    so there are about log2 of descriptors segments and adding a pattern rebuilds only small indexes.
+    Pattern saved again under the same name gets a new label, descriptors of the old one are dropped on next merge.
+    '''
+    def __init__(self, patterns=()):
+        self.names = [] # label -> pattern name, None for replaced patterns
+        self._labels = {} # pattern name -> label
+        self._segments = [] # (flann index, descriptors, labels), largest first
+        self._lock = threading.Lock()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        with self._lock:
+            if pattern.name in self._labels:
+                self.names[self._labels[pattern.name]] = None
+            label = len(self.names)
+            self.names.append(pattern.name)
+            self._labels[pattern.name] = label
+            if pattern.descriptors is None or not len(pattern.descriptors):
+                return
+            descriptors = np.ascontiguousarray(pattern.descriptors, np.uint8)
+            labels = np.full(len(descriptors), label, np.int32)
+            while self._segments and len(self._segments[-1][2]) <= len(labels):
+                _, segment_descriptors, segment_labels = self._segments.pop()
+                descriptors = np.vstack((segment_descriptors, descriptors))
+                labels = np.concatenate((segment_labels, labels))
+            alive = self._alive()[labels]
+            descriptors, labels = np.ascontiguousarray(descriptors[alive]), labels[alive]
+            if len(labels):
+                cv2.setRNGSeed(LSH_INDEX_SEED)
+                self._segments.append((cv2.flann_Index(descriptors, LSH_INDEX_PARAMS), descriptors, labels))
+
+    def search(self, descriptors, k=2):
+        '''
+        k nearest descriptors of all patterns for every row of descriptors.
+        Returns (labels, distances), both of shape (len(descriptors), k), label is -1 where fewer than k were found.
+        '''
+        with self._lock:
+            alive = self._alive()
+            found_labels, found_distances = [], []
+            for index, _, labels in self._segments:
+                indexes, distances = index.knnSearch(descriptors, min(k, len(labels)), params=LSH_SEARCH_PARAMS)
+                segment_labels = np.where(indexes >= 0, labels[np.maximum(indexes, 0)], -1)
+                segment_labels[~alive[segment_labels]] = -1 # alive[-1] is some label, already -1 anyway
+                found_labels.append(segment_labels)
+                found_distances.append(np.where(segment_labels >= 0, distances, np.iinfo(np.int32).max))
+        n = len(descriptors)
+        found_labels.append(np.full((n, k), -1, np.int32))
+        found_distances.append(np.full((n, k), np.iinfo(np.int32).max, np.int64))
+        labels, distances = np.hstack(found_labels), np.hstack(found_distances)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(labels, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def segments(self):
+        ''' Number of descriptors in every segment '''
+        return [len(labels) for _, _, labels in self._segments]
+
+    def _alive(self):
+        return np.array([name is not None for name in self.names], bool)
+
+    def __len__(self):
+        return len(self._labels)
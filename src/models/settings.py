@@ -4,7 +4,15 @@ from settings import *
 
 
 class Settings(Model):
-    def __init__(self, name=None, image_processes=[]):
+    def __init__(self, name=None, image_processes=[], working_scale=1.0):
         super().__init__(name, image_processes)
+        self.working_scale = working_scale # images are inspected resized by it, parameters are in source pixels
+
+    def __eq__(self, other):
+        return super().__eq__(other) and self.working_scale == getattr(other, 'working_scale', 1.0)
+
+    def working_settings(self):
+        ''' Settings with parameters in pixels of image resized by working_scale '''
+        return self.scaled(self.working_scale)
 
 
@@ -0,0 +1,130 @@
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+_memory_lock = threading.Lock()
+_memory_frames = [] # memory frames of stages running in any thread of any profiler
+_memory_users = 0 # open profilers tracing memory
+_memory_started = False # tracing was started by profiler, not by someone else
+
+
+def _fold_peak(peak):
+    ''' Every running stage gets peak since last reset_peak, called with _memory_lock held '''
+    for frame in _memory_frames:
+        frame['peak'] = max(frame['peak'], peak - frame['base'])
+
+
+class Profiler(object):
+    '''
+    Records wall time, cpu time and peak of memory allocated during named stages.
+    Stages can be nested, peak of outer stage includes peaks of its inner stages.
+    Values are per-process approximations when stages run in parallel:
+    cpu is time of the calling thread only, work of thread and process pools it waits for is missing,
+    process_cpu is time of all threads of the process, so it includes stages running at the same time.
+    Memory is measured with tracemalloc, which is global for the process, so peak of a stage includes
+    allocations of stages running in other threads at the same time, it is never under-reported.
+    Tracing is stopped when the last profiler tracing memory is closed.
+    '''
+    enabled = True
+
+    def __init__(self, trace_memory=True):
+        global _memory_users, _memory_started
+        self.trace_memory = trace_memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if trace_memory:
+            with _memory_lock:
+                _memory_users += 1
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _memory_started = True
+
+    def close(self):
+        ''' Stops memory tracing unless another profiler still uses it, records are kept '''
+        global _memory_users, _memory_started
+        if self.trace_memory:
+            self.trace_memory = False
+            with _memory_lock:
+                _memory_users -= 1
+                if _memory_users == 0 and _memory_started:
+                    tracemalloc.stop()
+                    _memory_started = False
+
+    @contextmanager
+    def stage(self, name, panel=None):
+        stack = self._stack()
+        frame = {'base': 0, 'peak': 0}
+        trace_memory = self.trace_memory
+        if trace_memory:
+            with _memory_lock:
+                current, peak = tracemalloc.get_traced_memory()
+                _fold_peak(peak) # reset below must not lose peaks of running stages
+                tracemalloc.reset_peak()
+                frame['base'] = current
+                _memory_frames.append(frame)
+        depth = len(stack)
+        stack.append(frame)
+        wall, cpu, process_cpu = time.perf_counter(), time.thread_time(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu, process_cpu = time.perf_counter() - wall, time.thread_time() - cpu, time.process_time() - process_cpu
+            stack.pop()
+            if trace_memory:
+                with _memory_lock:
+                    _, peak = tracemalloc.get_traced_memory()
+                    _fold_peak(peak)
+                    del _memory_frames[next(i for i, f in enumerate(_memory_frames) if f is frame)] # equal dicts are other frames
+            self.add([{
+                'name': name, 'panel': panel, 'depth': depth, 'wall': wall, 'cpu': cpu, 'process_cpu': process_cpu,
+                'peak': frame['peak'],
+            }])
+
+    def add(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def record(self):
+        ''' Stages recorded so far, inner stages come before the stage containing them '''
+        with self._lock:
+            return {'stages': list(self.records)}
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class NullProfiler(object):
+    ''' Disabled profiler, stage() returns shared no-op context manager '''
+    enabled = False
+    trace_memory = False
+    records = ()
+    _null_stage = _NullStage()
+
+    def stage(self, name, panel=None):
+        return self._null_stage
+
+    def close(self):
+        pass
+
+    def add(self, records):
+        pass
+
+    def record(self):
+        return None
+
+
+NULL_PROFILER = NullProfiler()
@@ -1,26 +1,41 @@
 import cv2
 import numpy as np
-from matplotlib import pyplot as plt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
 from math import sqrt
 from settings import *
 
-from errors import TransformationError
+from errors import TransformationError, RegistrationError
+from profiler import Profiler, NULL_PROFILER
+from services.service_context import ThreadLocalPool
+from models.defects import DEFECT_DTYPE
 
 
 class ImageService:
+    '''
+    Can be shared by threads, every thread gets its own OpenCV detectors and CLAHE objects from pools.
+    '''
     def __init__(self):
-        self.detector = cv2.ORB_create(nfeatures=10000)
-        #self.detector = cv2.xfeatures2d.SIFT_create()
+        self._detectors = ThreadLocalPool(cv2.ORB_create)
+        #self._detectors = ThreadLocalPool(cv2.xfeatures2d.SIFT_create)
+        self._clahes = ThreadLocalPool(cv2.createCLAHE)
+        self._executor = None
+        self._executor_key = None
+        self._executor_pattern = None # pattern of process pool workers, kept alive so it is compared by identity
+        self._tile_executor = None
+        self._executor_lock = threading.RLock() # executors are created lazily, also from compare threads
+        self._priors = {} # (pattern name, panel index) -> (pattern, (panel to pattern model, inliers)) of previous compare
 
     def bgr_to_gray(self, image):
         return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     def brightness_equalizer(self, bgr_image, clip_limit=0.7, tile_grid_size=(10,10)):
+        ''' CLAHE on L channel of LAB, only L is copied out and equalized in place '''
         lab_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab_image)
-        clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
-        l = clahe.apply(l)
-        lab_image = cv2.merge((l,a,b))
+        l = cv2.extractChannel(lab_image, 0)
+        self._clahes.get(clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size)).apply(l, dst=l)
+        cv2.insertChannel(l, lab_image, 0)
         return cv2.cvtColor(lab_image, cv2.COLOR_LAB2BGR)
 
     def linear_scaling(self, image, alpha, beta):
@@ -28,12 +43,15 @@ class ImageService:
         Alpha - contrast controll, set 1.0 to 2.0 
         Beta - brightnewss control, set 0 to 100
         '''
-        img = image.astype(np.float32, copy=False)
-        img *= alpha
-        img += beta
-        np.clip(img, 0, 255, out=img)
-        img = img.astype(np.uint8, copy=False)
-        return img
+        return cv2.LUT(image, self.linear_scaling_lut(alpha, beta))
+
+    def linear_scaling_lut(self, alpha, beta):
+        ''' Table of linear_scaling for every uint8 value, computed in float32 like scaling of whole image would be '''
+        table = np.arange(256, dtype=np.float32)
+        table *= alpha
+        table += beta
+        np.clip(table, 0, 255, out=table)
+        return table.astype(np.uint8)
 
     def gaussian_blur(self, image, kernel=(5,5)):
         if kernel[0] % 2 == 0 or kernel[1] % 2 == 0:
@@ -45,11 +63,69 @@ class ImageService:
         _, img = cv2.threshold(image, 0, 255, thresh + cv2.THRESH_OTSU)
         return img
 
-    def extract_key_points_and_descriptors(self, image):
+    @property
+    def detector(self):
+        ''' Keypoint detector of calling thread '''
+        return self._detectors.get(nfeatures=KEYPOINT_FEATURES)
+
+    @property
+    def recognition_detector(self):
+        return self._detectors.get(nfeatures=RECOGNITION_FEATURES)
+
+    def pyramid_down(self, image, level=1):
+        ''' Image halved level times with gaussian pyramid '''
+        for _ in range(level):
+            image = cv2.pyrDown(image)
+        return image
+
+    def extract_key_points_and_descriptors(self, image, tiles=(1, 1)):
+        '''
+        tiles - (rows, cols), above (1, 1) see extract_key_points_and_descriptors_tiled
+        '''
+        if tuple(tiles) != (1, 1):
+            return self.extract_key_points_and_descriptors_tiled(image, tiles)
         kp, des = self.detector.detectAndCompute(image, None)
         return kp, des
 
-    def clip_and_rotate(self, image, gaussian_blur=(15,15), lower=(15,0,0), upper=(165,255,255), canny_min=100, canny_max=100):
+    def extract_key_points_and_descriptors_tiled(self, image, tiles=KEYPOINT_TILES, features=KEYPOINT_FEATURES,
+                                                 overlap=KEYPOINT_TILE_OVERLAP, workers=KEYPOINT_WORKERS):
+        '''
+        Image is split into tiles (rows, cols) and each tile gets the same part of features, so keypoints
+        are spread over whole image instead of crowding in the most textured areas.
+        Tile is detected with overlap pixels of its neighbours, so descriptors near tile edges see the same
+        surroundings as on whole image, keypoints are kept only in the tile itself.
+        Tiles run on workers threads, keypoints are moved back to image coordinates.
+        '''
+        rows, cols = tiles
+        height, width = image.shape[:2]
+        budget = max(features // (rows * cols), 1)
+        ys = np.linspace(0, height, rows + 1).astype(int)
+        xs = np.linspace(0, width, cols + 1).astype(int)
+        boxes = [(ys[r], ys[r + 1], xs[c], xs[c + 1]) for r in range(rows) for c in range(cols)]
+        detect = partial(_detect_tile, self._detectors, image, budget, overlap)
+        if workers > 1 and len(boxes) > 1:
+            results = list(self._keypoint_executor(workers).map(detect, boxes))
+        else:
+            results = [detect(box) for box in boxes]
+
+        keypoints = [kp for tile_keypoints, _ in results for kp in tile_keypoints]
+        descriptors = [des for _, des in results if des is not None]
+        return keypoints, np.vstack(descriptors) if descriptors else None
+
+    def _keypoint_executor(self, workers):
+        with self._executor_lock:
+            if self._tile_executor is None or self._tile_executor._max_workers != workers:
+                if self._tile_executor:
+                    self._tile_executor.shutdown()
+                self._tile_executor = ThreadPoolExecutor(workers)
+            return self._tile_executor
+
+    def clip_and_rotate(self, image, gaussian_blur=(15,15), lower=(15,0,0), upper=(165,255,255), canny_min=100, canny_max=100, scale=1.0):
+        '''
+        scale - below 1 board rectangle is searched on image resized by scale, see clip_and_rotate_coarse
+        '''
+        if scale < 1:
+            return self.clip_and_rotate_coarse(image, scale, gaussian_blur, lower, upper, canny_min, canny_max)
         img = self.remove_background(image, lower, upper)
         gray = self.bgr_to_gray(img)
         gray_blurred = self.gaussian_blur(gray, gaussian_blur)
@@ -62,6 +138,35 @@ class ImageService:
         return image
         
 
+    def clip_and_rotate_coarse(self, image, scale, gaussian_blur=(15,15), lower=(15,0,0), upper=(165,255,255), canny_min=100, canny_max=100):
+        '''
+        Finds board rectangle on image resized by scale, gaussian_blur is given for full resolution and scaled too.
+        Rectangle is refined at full resolution in strips along its sides, so it is the same as clip_and_rotate finds
+        when the coarse one is within a few resized pixels.
+        Clipped board is cut out of full resolution image with one warp straight into its size,
+        oriented the same way as by clip_and_rotate.
+        '''
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        mask = cv2.inRange(cv2.cvtColor(small, cv2.COLOR_BGR2HSV), np.array([lower]), np.array([upper]))
+        gray = self.bgr_to_gray(small)
+        gray = cv2.bitwise_and(gray, gray, mask=mask)
+        kernel = tuple(max(int(round((k * scale - 1) / 2)), 0) * 2 + 1 for k in gaussian_blur) # nearest odd size
+        (cx, cy), (w, h), angle = self.find_rectangle(self.gaussian_blur(gray, kernel), canny_min, canny_max)
+
+        fx, fy = small.shape[1] / image.shape[1], small.shape[0] / image.shape[0]
+        coarse = (((cx + 0.5) / fx - 0.5, (cy + 0.5) / fy - 0.5), (w / fx, h / fy), angle)
+        padding = int(np.ceil(4 / min(fx, fy))) + max(gaussian_blur) # error of coarse rectangle and reach of blur
+        rectangle = self._refine_rectangle(image, cv2.boxPoints(coarse), padding, gaussian_blur, lower, upper, canny_min, canny_max)
+        M, _, _ = self.rotate_and_translate_affine(image, rectangle[2])
+        box = cv2.transform(np.array([cv2.boxPoints(rectangle)]), M)[0]
+        xs, ys = box[:,0], box[:,1]
+        x1, x2, y1, y2 = min(xs), max(xs), min(ys), max(ys)
+        size = (int(x2 - x1), int(y2 - y1))
+        # same window as clip_to_frame takes with getRectSubPix from rotated image
+        M[0, 2] -= x1 + size[0] / 2 - (size[0] - 1) / 2
+        M[1, 2] -= y1 + size[1] / 2 - (size[1] - 1) / 2
+        return cv2.warpAffine(image, M, size)
+
     def remove_background(self, image, lower, upper):
         img = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
         lower = np.array([lower])
@@ -72,11 +177,33 @@ class ImageService:
 
 
     def find_rectangle(self, gray, cannyMinValue, cannyMaxValue):
-        edges = cv2.Canny(gray,cannyMinValue, cannyMaxValue)
-        hull = cv2.convexHull(np.column_stack((np.nonzero(edges)[::-1])).reshape(-1,1,2).astype(np.int32)) # get x, y vectors of non zero points, stack them into array
+        hull = cv2.convexHull(self._edge_points(gray, cannyMinValue, cannyMaxValue))
         rect = cv2.minAreaRect(hull) 
         return rect
 
+    def _edge_points(self, gray, canny_min, canny_max):
+        ''' Canny edge pixels as Nx1x2 int32 array of x, y '''
+        edges = cv2.Canny(gray, canny_min, canny_max)
+        return np.column_stack((np.nonzero(edges)[::-1])).reshape(-1,1,2).astype(np.int32) # get x, y vectors of non zero points, stack them into array
+
+    def _refine_rectangle(self, image, box, padding, gaussian_blur, lower, upper, canny_min, canny_max):
+        '''
+        Rectangle of edges found at full resolution in strips padded by padding around sides of box.
+        Edges inside the board do not change the convex hull, so only the strips are searched.
+        '''
+        height, width = image.shape[:2]
+        points = []
+        for p, q in zip(box, np.roll(box, -1, axis=0)):
+            x1, y1 = np.maximum(np.floor(np.minimum(p, q)).astype(int) - padding, 0)
+            x2, y2 = np.ceil(np.maximum(p, q)).astype(int) + padding + 1
+            x2, y2 = min(x2, width), min(y2, height)
+            if x2 <= x1 or y2 <= y1:
+                continue
+            strip = self.remove_background(image[y1:y2, x1:x2], lower, upper)
+            strip = self.gaussian_blur(self.bgr_to_gray(strip), gaussian_blur)
+            points.append(self._edge_points(strip, canny_min, canny_max) + np.int32([[[x1, y1]]]))
+        return cv2.minAreaRect(cv2.convexHull(np.vstack(points)))
+
     def rotate_and_translate_affine(self, image, angle):
         h,w = image.shape[:2]
         if h > w and abs(angle) < 45:
@@ -95,67 +222,63 @@ class ImageService:
     def clip_to_frame(self, image, box):
         xs, ys = box[:,0], box[:,1]
         x1, x2, y1, y2 = min(xs), max(xs), min(ys), max(ys)
-        size = (x2 - x1, y2 - y1)
+        size = (int(x2 - x1), int(y2 - y1))
         center = x1 + size[0] /2, y1 + size[1]/2
         return cv2.getRectSubPix(image, size, center)
 
 
-    def ransac(self, pts1, pts2, iters=100, maxerror=5):
+    def ransac(self, pts1, pts2, iters=100, maxerror=5, confidence=None, batch_size=RANSAC_BATCH_SIZE, random_state=None):
         '''
         pts1 - source image points, Nx1x2
         pts2 - destination image points, Nx1x2
-        iters - number of ransac iterations
+        iters - maximal number of ransac iterations
         maxerror - max distance in pixels between points
+        confidence - when set, stop as soon as probability of having drawn an all-inlier sample reaches it
+        batch_size - number of hypotheses fitted and scored together
+        random_state - np.random.RandomState used for sampling, global numpy generator by default
+
+        Samples are drawn in the same order as one-by-one fitting would draw them, degenerate (collinear)
+        samples are redrawn, so without confidence the result for a fixed seed does not depend on batch_size.
         '''
+        return self._ransac(pts1, pts2, iters, maxerror, confidence, batch_size, random_state)[0]
 
-        def calculate_model(s_indexes):
-            result = None
-            try:
-                s_index_1, s_index_2, s_index_3 = s_indexes
-                x1,y1 = pts1[s_index_1]
-                u1,v1 = pts2[s_index_1]
-                x2,y2 = pts1[s_index_2]
-                u2,v2 = pts2[s_index_2]
-                x3,y3 = pts1[s_index_3]
-                u3,v3 = pts2[s_index_3]
-                tmp = np.matrix([[x1,y1,1,0,0,0],
-                                 [x2,y2,1,0,0,0],
-                                 [x3,y3,1,0,0,0],
-                                 [0,0,0,x1,y1,1],
-                                 [0,0,0,x2,y2,1],
-                                 [0,0,0,x3,y3,1]]).I
-                tmp = tmp * np.matrix([u1,u2,u3,v1,v2,v3]).T
-                result = np.array([[tmp.item(0), tmp.item(1), tmp.item(2)],
-                                  [tmp.item(3), tmp.item(4), tmp.item(5)]])
-            except np.linalg.LinAlgError:
-                pass
-            return result
-
-        def model_error(model, i):
-            x1,y1 = pts1[i]
-            x2,y2 = pts2[i] 
-            p1 = model.dot(np.array([[x1],[y1],[1]]))
-            p2 = np.array([[x2],[y2]])
-            return np.linalg.norm(p1-p2)
-
-        #RANSAC
+    def _ransac(self, pts1, pts2, iters=100, maxerror=5, confidence=None, batch_size=RANSAC_BATCH_SIZE, random_state=None):
+        ''' ransac returning also number of inliers of the model '''
+        pts1 = np.asarray(pts1, np.float64).reshape(-1, 2)
+        pts2 = np.asarray(pts2, np.float64).reshape(-1, 2)
         pts_size = pts1.shape[0]
+        random = random_state if random_state is not None else np.random
+        src = np.hstack([pts1, np.ones((pts_size, 1))]) # homogeneous coordinates, Nx3
+
         bestmodel = None
         bestscore = 0
-        for i in range(iters):
-            model = None
-            while model is None:
-                s_indexes = np.random.choice(pts_size, 3, replace=False)
-                model = calculate_model(s_indexes)
-            score = 0
-            for p in range(pts_size):
-                error = model_error(model, p)
-                if error < maxerror:
-                    score += 1
-            if score > bestscore:
-                bestscore = score
-                bestmodel = model
-        return bestmodel
+        done = 0
+        while done < iters:
+            samples = np.array([random.choice(pts_size, 3, replace=False) for _ in range(min(batch_size, iters - done))])
+            A = src[samples]                    # Bx3x3, rows [x, y, 1]
+            valid = np.linalg.det(A) != 0
+            if not np.any(valid):
+                continue
+            # each row of affine model solves A * [a, b, c] = u (or v)
+            models = np.linalg.solve(A[valid], pts2[samples[valid]]).transpose(0, 2, 1) # Bx2x3
+            errors = np.linalg.norm(np.einsum('bij,nj->bni', models, src) - pts2, axis=2)
+            scores = np.count_nonzero(errors < maxerror, axis=1)
+            best = np.argmax(scores)
+            if scores[best] > bestscore:
+                bestscore = scores[best]
+                bestmodel = models[best]
+            done += models.shape[0]
+            if confidence is not None and done < iters and bestscore > 0:
+                if done >= self._ransac_iterations(bestscore / pts_size, confidence):
+                    break
+        return bestmodel, bestscore
+
+    def _ransac_iterations(self, inlier_ratio, confidence, sample_size=3):
+        ''' Number of iterations needed to draw at least one all-inlier sample with given confidence '''
+        p_good = inlier_ratio ** sample_size
+        if p_good >= 1:
+            return 0
+        return np.log(1 - confidence) / np.log(1 - p_good)
 
 
 
@@ -172,16 +295,7 @@ class ImageService:
 
 
     def extract_matches(self, des1, des2):
-        index_params= dict(
-            algorithm = 6, # FLANN_INDEX_LSH
-            table_number = 12, # 6
-            key_size = 20,     # 12
-            multi_probe_level = 2 # 1
-        )
-
-        search_params = dict(checks=50)  
-
-        flann = cv2.FlannBasedMatcher(index_params,search_params)
+        flann = cv2.FlannBasedMatcher(LSH_INDEX_PARAMS, LSH_SEARCH_PARAMS)
         all_matches = flann.knnMatch(des1, des2, k=2)
 
         all_matches = filter(lambda pair: len(pair) == 2, all_matches)
@@ -191,104 +305,447 @@ class ImageService:
                 matches.append(m)
         return matches
 
-    def transform_image(self, image, model):
+    def match_pattern(self, pattern, descriptors, ratio=0.7):
+        '''
+        Matches descriptors against pattern's prebuilt index.
+        Returns arrays of pattern and descriptors indexes of matches passing ratio test.
+        '''
+        indexes, distances = pattern.matcher_index().knnSearch(descriptors, 2, params=LSH_SEARCH_PARAMS)
+        good = np.all(indexes >= 0, axis=1) & (distances[:, 0] < ratio * distances[:, 1])
+        return indexes[good, 0], np.flatnonzero(good)
+
+    def recognize_pattern(self, pattern_index, image, ratio=0.7, min_votes=RECOGNITION_MIN_VOTES, margin=RECOGNITION_MARGIN, level=RECOGNITION_LEVEL):
+        '''
+        Name of pattern of PatternIndex which image shows or None.
+        Only RECOGNITION_FEATURES strongest keypoints of image halved level times are described, every one passing ratio test
+        votes for pattern of its nearest descriptor. Second nearest of the same pattern is not ambiguous.
+        Best pattern needs min_votes and margin times the votes of the second best.
+        '''
+        if not len(pattern_index):
+            return None
+        _, descriptors = self.recognition_detector.detectAndCompute(self.pyramid_down(image, level), None)
+        if descriptors is None:
+            return None
+        labels, distances = pattern_index.search(descriptors, 2)
+        good = (labels[:, 0] >= 0) & ((labels[:, 0] == labels[:, 1]) | (distances[:, 0] < ratio * distances[:, 1]))
+        votes = np.bincount(labels[good, 0], minlength=len(pattern_index.names))
+        second, best = np.argsort(votes, kind='stable')[-2:] if len(votes) > 1 else (None, 0)
+        if votes[best] < min_votes or (second is not None and votes[best] < margin * votes[second]):
+            return None
+        return pattern_index.names[best]
+
+    def match_pattern_guided(self, pattern, points, descriptors, prior, radius=GUIDED_MATCH_RADIUS, ratio=0.7):
+        '''
+        Matches descriptors only with pattern keypoints closer than radius to where prior,
+        the panel to pattern affine model, puts their points.
+        Returns arrays of pattern and descriptors indexes of matches like match_pattern.
+        '''
+        predicted = cv2.transform(np.float32(points).reshape(-1, 1, 2), prior).reshape(-1, 2)
+        order, starts, n_cols, n_rows = pattern.point_grid(radius)
+        cells = np.floor(predicted / radius).astype(np.int64)
+        queries, candidates = [], []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                col, row = cells[:, 0] + dx, cells[:, 1] + dy
+                inside = np.flatnonzero((col >= 0) & (col < n_cols) & (row >= 0) & (row < n_rows))
+                cell = row[inside] * n_cols + col[inside]
+                first, counts = starts[cell], starts[cell + 1] - starts[cell]
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                queries.append(np.repeat(inside, counts))
+                candidates.append(order[np.repeat(first, counts) + offsets])
+        queries, candidates = np.concatenate(queries), np.concatenate(candidates)
+        near = np.sum((pattern.points()[candidates] - predicted[queries]) ** 2, axis=1) <= radius ** 2
+        queries, candidates = queries[near], candidates[near]
+        if not len(queries):
+            return queries, queries
+
+        distances = _POPCOUNT[descriptors[queries] ^ pattern.descriptors[candidates]].sum(axis=1, dtype=np.int32)
+        by_distance = np.lexsort((distances, queries))
+        queries, candidates, distances = queries[by_distance], candidates[by_distance], distances[by_distance]
+        best = np.flatnonzero(np.r_[True, queries[1:] != queries[:-1]])
+        second = np.minimum(best + 1, len(queries) - 1)
+        has_second = (second != best) & (queries[second] == queries[best])
+        good = np.where(has_second, distances[best] < ratio * distances[second], distances[best] < GUIDED_MAX_DISTANCE)
+        return candidates[best[good]], queries[best[good]]
+
+    def reset_priors(self, pattern=None):
+        ''' Forgets panel positions used by guided matching, only those of pattern when given '''
+        if pattern is None:
+            self._priors = {}
+        else:
+            self._priors = dict((key, value) for key, value in self._priors.items() if key[0] != pattern.name)
+
+    def _prior(self, pattern, panel):
+        ''' Prior of panel left by previous compare, None when pattern was replaced since '''
+        previous = self._priors.get((pattern.name, panel))
+        return previous[1] if previous is not None and previous[0] is pattern else None
+
+    def _set_prior(self, pattern, panel, prior):
+        if prior[0] is not None and prior[1] >= 3: # affine model needs 3 points
+            self._priors[(pattern.name, panel)] = (pattern, prior)
+        else:
+            self._priors.pop((pattern.name, panel), None)
+
+    def transform_image(self, image, model, profiler=NULL_PROFILER, cache=None):
+        '''
+        cache - StageCache, outputs of transformations whose parameters and inputs did not change
+                since previous call with the same image are taken from it
+        '''
         images = {
             COLOR_IMAGE: image,
             CLIPPED_IMAGE: image,
             OUT_IMAGE: COLOR_IMAGE
         }
-        for transformation in model.transformations:
-            images = transformation.transform(images) 
+        key = cache.source_key(image) if cache is not None else None
+        with profiler.stage('transform_image'):
+            for transformation in model.transformations:
+                if transformation.selected:
+                    with profiler.stage(transformation.__class__.__name__):
+                        if cache is None:
+                            images = transformation.transform(images)
+                            continue
+                        key = cache.stage_key(key, transformation)
+                        cached = cache.get(key)
+                        if cached is None:
+                            previous, images = images, transformation.transform(dict(images))
+                            cache.put(key, images, previous)
+                        else:
+                            images = cached
+        return dict(images) if cache is not None else images
+
+    def compare(self, pattern, images, settings, workers=COMPARE_WORKERS, executor=COMPARE_EXECUTOR, profiler=NULL_PROFILER, guided=GUIDED_MATCHING, scale=1.0):
+        '''
+        workers - number of panels compared at once, 1 compares them one after another
+        executor - 'thread' or 'process' pool used when workers > 1
+        profiler - records compare sub-steps, for every panel separately
+        guided - match every panel near where previous compare of the same pattern and panel put it
+        scale - images and pattern are resized by it, COMPARE_OPENING_KERNEL is resized too
+        Every panel gets its own seed drawn upfront, so the result does not depend on workers.
+        Panels are merged and opened only inside boxes they cover in frame, not over whole frame.
+        '''
+        with profiler.stage('compare'):
+            frame_height, frame_width = images[COLOR_IMAGE].shape[:2]
+            frame_mask = np.zeros((frame_height, frame_width), np.uint8)
+            with profiler.stage('split'):
+                selected_split = settings.selected_split()
+                points = selected_split.split(images) if selected_split else [(0, frame_height, 0, frame_width)]
+            seeds = np.random.randint(np.iinfo(np.int32).max, size=len(points))
+            panels = [
+                (images[GRAY_IMAGE][y1:y2, x1:x2], images[BIN_IMAGE][y1:y2, x1:x2], (y1, y2, x1, x2), seed, panel,
+                 self._prior(pattern, panel) if guided else None)
+                for panel, ((y1, y2, x1, x2), seed) in enumerate(zip(points, seeds))
+            ]
+            frame_size = (frame_width, frame_height)
+            with profiler.stage('matcher_index'):
+                pattern.matcher_index()
+            if workers > 1 and len(panels) > 1:
+                pool = self._compare_executor(pattern, workers, executor)
+                if executor == 'process':
+                    profile = profiler.trace_memory if profiler.enabled else None
+                    results = pool.map(partial(_compare_panel_in_process, frame_size, profile), panels)
+                    xor_masks = self._add_panel_records(results, profiler)
+                else:
+                    xor_masks = pool.map(lambda panel: self.compare_panel(pattern, frame_size, *panel, profiler=profiler), panels)
+            else:
+                xor_masks = (self.compare_panel(pattern, frame_size, *panel, profiler=profiler) for panel in panels)
+
+            boxes = []
+            try:
+                for panel, (xor_mask, box, prior) in enumerate(xor_masks):
+                    self._set_prior(pattern, panel, prior)
+                    with profiler.stage('merge'):
+                        # value > 127 is bit 7 set, so thresholding before or gives the same as after
+                        _, xor_mask = cv2.threshold(xor_mask, 127, 255, cv2.THRESH_BINARY)
+                        by1, by2, bx1, bx2 = box
+                        np.bitwise_or(frame_mask[by1:by2, bx1:bx2], xor_mask, out=frame_mask[by1:by2, bx1:bx2])
+                        boxes.append(box)
+            except Exception:
+                self.reset_priors(pattern) # failed panel must not guide next image
+                raise
+
+            #plt.title("After xor"), plt.imshow(frame_mask, 'gray', interpolation='none'), plt.show()
+
+            with profiler.stage('opening'):
+                kernel = tuple(max(int(round(size * scale)), 1) for size in COMPARE_OPENING_KERNEL)
+                frame_mask = self._opening_in_boxes(frame_mask, boxes, kernel)
+            #plt.title("After morphology"), plt.imshow(frame_mask, 'gray', interpolation='none'), plt.show()
+
+        images[OUT_IMAGE] = BIN_IMAGE
+        images[BIN_IMAGE] = frame_mask
+        images[PANEL_BOXES] = points
         return images
 
-    def compare(self, pattern, images, settings):
-        frame_height, frame_width = images[COLOR_IMAGE].shape[:2]
-        frame_mask = np.zeros((frame_height, frame_width), np.uint8)
+    def compare_panel(self, pattern, frame_size, gray, binary, slice_points, seed, panel=None, prior=None, profiler=NULL_PROFILER):
+        '''
+        Compares single panel with pattern.
+        gray, binary - panel cut out of frame images
+        slice_points - (y1, y2, x1, x2) position of the panel in frame
+        panel - index of the panel, used in profiler records
+        prior - (panel to pattern model, inliers) of previous image, when given keypoints are matched only near
+                where the model puts them, whole pattern is matched when inliers drop below GUIDED_MIN_INLIERS_RATIO of previous
+        Returns xor of panel and pattern warped to frame and (y1, y2, x1, x2) box of frame of frame_size (width, height)
+        it covers, box is the bounding box of warped pattern, and prior for the next image.
+        Raises RegistrationError when panel can not be registered with pattern, guided or not.
+        '''
+        y1, y2, x1, x2 = slice_points
         pattern_height, pattern_width = pattern.image.shape[0:2]
-        selected_split = settings.selected_split()
-        points = selected_split.split(images) if selected_split else [(0, frame_height, 0, frame_width)]
-        for y1, y2, x1, x2 in points:
-            pcb_gray =  np.array(images[GRAY_IMAGE][y1:y2, x1:x2])
-            pcb_bin =  np.array(images[BIN_IMAGE][y1:y2, x1:x2])
-            pcb_height, pcb_width = pcb_gray.shape[0:2]
-
-            
-
-            pcb_keypoints, pcb_descriptors = self.extract_key_points_and_descriptors(pcb_gray)
-            matches = self.extract_matches(pattern.descriptors, pcb_descriptors)
-            #img3 = cv2.drawMatches(pattern.image,pattern.keypoints,pcb_bin,pcb_keypoints,matches, flags=2, outImg = None)
-            #plt.imshow(img3), plt.show()
-            pattern_points = np.float32([pattern.keypoints[m.queryIdx].pt for m in matches]).reshape(-1,2)
-            pcb_points = np.float32([pcb_keypoints[m.trainIdx].pt for m in matches]).reshape(-1,2)
-
-            M_pcb_translate = np.float32([[1,0,x1], [0,1,y1]])
-            M_pcb_to_pattern = self.ransac(pcb_points, pattern_points, iters=1000, maxerror=2)
-            M_pattern_to_pcb = cv2.invertAffineTransform(M_pcb_to_pattern)
-            M_xor_to_frame = self.add_affine_transform(M_pattern_to_pcb, M_pcb_translate)
-
+        pcb_gray =  np.array(gray)
+        pcb_bin =  np.array(binary)
+
+        with profiler.stage('keypoints', panel):
+            pcb_keypoints, pcb_descriptors = self.extract_key_points_and_descriptors(pcb_gray, pattern.keypoint_tiles)
+            pcb_points = np.float32([kp.pt for kp in pcb_keypoints]).reshape(-1,2)
+        if pcb_descriptors is None or len(pcb_descriptors) < 3:
+            raise RegistrationError("Panel {0} has too few keypoints to be registered with pattern {1}".format(panel, pattern.name))
+
+        M_pcb_to_pattern, inliers = None, 0
+        if prior is not None:
+            with profiler.stage('match_guided', panel):
+                pattern_indexes, pcb_indexes = self.match_pattern_guided(pattern, pcb_points, pcb_descriptors, prior[0])
+            with profiler.stage('ransac_guided', panel):
+                M_pcb_to_pattern, inliers = self._register(pattern, pcb_points, pattern_indexes, pcb_indexes, seed, refine=True)
+        if not inliers or inliers < GUIDED_MIN_INLIERS_RATIO * (prior[1] if prior else 0):
+            with profiler.stage('match', panel):
+                pattern_indexes, pcb_indexes = self.match_pattern(pattern, pcb_descriptors)
+            with profiler.stage('ransac', panel):
+                M_pcb_to_pattern, inliers = self._register(pattern, pcb_points, pattern_indexes, pcb_indexes, seed)
+        if M_pcb_to_pattern is None:
+            raise RegistrationError("Panel {0} could not be registered with pattern {1}, too few matches".format(panel, pattern.name))
+
+        M_pcb_translate = np.float32([[1,0,x1], [0,1,y1]])
+        M_pattern_to_pcb = cv2.invertAffineTransform(M_pcb_to_pattern)
+        M_xor_to_frame = self.add_affine_transform(M_pattern_to_pcb, M_pcb_translate)
+
+        with profiler.stage('warp', panel):
             transformed_pcb = cv2.warpAffine(pcb_bin, M_pcb_to_pattern, (pattern_width, pattern_height))
             _, transformed_pcb = cv2.threshold(transformed_pcb, 127, 255, cv2.THRESH_BINARY)
-            #plt.subplot(1,3,1)
-            #plt.title("Orig"), plt.imshow(pcb_bin, 'gray', interpolation='none')
-            #plt.subplot(1,3,2)
-            #plt.title("transformed_pcb"), plt.imshow(transformed_pcb, 'gray', interpolation='none')
-            #plt.subplot(1,3,3)
-            #plt.title("pattern"), plt.imshow(pattern.image, 'gray', interpolation='none'), plt.show()
-
+        #plt.subplot(1,3,1)
+        #plt.title("Orig"), plt.imshow(pcb_bin, 'gray', interpolation='none')
+        #plt.subplot(1,3,2)
+        #plt.title("transformed_pcb"), plt.imshow(transformed_pcb, 'gray', interpolation='none')
+        #plt.subplot(1,3,3)
+        #plt.title("pattern"), plt.imshow(pattern.image, 'gray', interpolation='none'), plt.show()
+
+        with profiler.stage('xor', panel):
             xor_img = cv2.bitwise_xor(transformed_pcb, pattern.image)
-            frame_mask = cv2.bitwise_or(cv2.warpAffine(xor_img, M_xor_to_frame, (frame_width, frame_height)), frame_mask)
+        with profiler.stage('warp_to_frame', panel):
+            box = self._warped_box(M_xor_to_frame, pattern_width, pattern_height, frame_size)
+            by1, by2, bx1, bx2 = box
+            M_xor_to_box = self.add_affine_transform(M_xor_to_frame, np.float64([[1, 0, -bx1], [0, 1, -by1]]))
+            return cv2.warpAffine(xor_img, M_xor_to_box, (bx2 - bx1, by2 - by1)), box, (M_pcb_to_pattern, inliers)
 
-        _, frame_mask = cv2.threshold(frame_mask, 127, 255, cv2.THRESH_BINARY)
-
-        #plt.title("After xor"), plt.imshow(frame_mask, 'gray', interpolation='none'), plt.show()
-
-        frame_mask = self.morphology_opening(frame_mask, (20, 20))
-        #plt.title("After morphology"), plt.imshow(frame_mask, 'gray', interpolation='none'), plt.show()
+    def _register(self, pattern, pcb_points, pattern_indexes, pcb_indexes, seed, refine=False):
+        '''
+        Panel to pattern model from matches and number of its inliers, (None, 0) for less than 3 matches.
+        refine - fit model to all inliers with least squares. Guided matches are nearly all inliers, so ransac
+                 stops after few samples with a model of just three noisy points.
+        '''
+        if len(pcb_indexes) < 3:
+            return None, 0
+        pts1, pts2 = pcb_points[pcb_indexes], pattern.points()[pattern_indexes]
+        model, inliers = self._ransac(pts1, pts2, iters=1000, maxerror=2, confidence=RANSAC_CONFIDENCE, random_state=np.random.RandomState(seed))
+        if refine and inliers >= 3:
+            src = np.hstack([pts1, np.ones((len(pts1), 1), np.float32)]).astype(np.float64)
+            good = np.linalg.norm(src.dot(model.T) - pts2, axis=1) < 2
+            model = np.linalg.lstsq(src[good], pts2[good].astype(np.float64), rcond=None)[0].T
+        return model, inliers
+
+    def _warped_box(self, M, width, height, frame_size):
+        ''' Box (y1, y2, x1, x2) of frame containing image of width, height warped with M, 2 px margin covers interpolation '''
+        corners = cv2.transform(np.float64([[[0, 0], [width, 0], [0, height], [width, height]]]), M)[0]
+        x1, y1 = np.floor(corners.min(axis=0)).astype(int) - 2
+        x2, y2 = np.ceil(corners.max(axis=0)).astype(int) + 2
+        frame_width, frame_height = frame_size
+        return max(y1, 0), max(min(y2, frame_height), 0), max(x1, 0), max(min(x2, frame_width), 0)
+
+    def _opening_in_boxes(self, mask, boxes, kernel):
+        '''
+        Same as morphology_opening of whole mask when mask is zero outside boxes.
+        Every box is opened in a window padded by twice the kernel, reach of erosion and dilation.
+        '''
+        opened = np.zeros_like(mask)
+        height, width = mask.shape[:2]
+        padding = 2 * max(kernel)
+        for y1, y2, x1, x2 in boxes:
+            wy1, wy2, wx1, wx2 = _padded_box((y1, y2, x1, x2), padding, height, width)
+            window = self.morphology_opening(mask[wy1:wy2, wx1:wx2], kernel)
+            opened[y1:y2, x1:x2] = window[y1 - wy1:y2 - wy1, x1 - wx1:x2 - wx1]
+        return opened
+
+    def _add_panel_records(self, results, profiler):
+        for xor_mask, box, prior, records in results:
+            profiler.add(records)
+            yield xor_mask, box, prior
+
+    def _compare_executor(self, pattern, workers, executor):
+        '''
+        Pool is kept between images, process pool is recreated when pattern changes.
+        Pattern of process pool is kept and compared by identity, id of collected pattern may be reused by another one.
+        '''
+        with self._executor_lock:
+            key = (executor, workers, pattern.name if executor == 'process' else None)
+            if self._executor_key != key or (executor == 'process' and self._executor_pattern is not pattern):
+                self.close()
+                if executor == 'process':
+                    from concurrent.futures import ProcessPoolExecutor # imports multiprocessing, only needed here
+                    self._executor = ProcessPoolExecutor(workers, initializer=_init_process_worker, initargs=(pattern,))
+                    self._executor_pattern = pattern
+                elif executor == 'thread':
+                    self._executor = ThreadPoolExecutor(workers)
+                else:
+                    raise ValueError("Unknown executor: {0}".format(executor))
+                self._executor_key = key
+            return self._executor
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor:
+                self._executor.shutdown()
+            if self._tile_executor:
+                self._tile_executor.shutdown()
+            self._executor = None
+            self._executor_key = None
+            self._executor_pattern = None
+            self._tile_executor = None
+
+    def extract_defects(self, mask, panels=(), profiler=NULL_PROFILER):
+        '''
+        Connected components of compare mask as structured array of DEFECT_DTYPE.
+        panels - (y1, y2, x1, x2) boxes of split, images[PANEL_BOXES] after compare, defect gets index of
+                 first box containing its centroid
+        '''
+        with profiler.stage('extract_defects'):
+            n, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            stats, centroids = stats[1:], centroids[1:] # 0 is background
+            defects = np.empty(n - 1, DEFECT_DTYPE)
+            for i, name in enumerate(['x', 'y', 'width', 'height', 'area']):
+                defects[name] = stats[:, i]
+            defects['cx'], defects['cy'] = centroids[:, 0], centroids[:, 1]
+            defects['panel'] = -1
+            if len(panels) and len(defects):
+                y1, y2, x1, x2 = np.array(panels).T[:, None, :]
+                cx, cy = centroids[:, 0:1], centroids[:, 1:2]
+                inside = (cy >= y1) & (cy < y2) & (cx >= x1) & (cx < x2)
+                defects['panel'] = np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+            return defects
+
+    def mark_errors(self, images, color, profiler=NULL_PROFILER, roi=MARK_ERRORS_ROI, scale=1.0):
+        '''
+        Draws outlines around defects from BIN_IMAGE on CLIPPED_IMAGE.
+        roi - process only windows around defects, result is the same as for the whole frame
+        scale - images are resized by it, MARK_ERRORS_DILATE and MARK_ERRORS_OUTLINE are resized too
+        '''
+        kernels = (_scaled_circle_size(MARK_ERRORS_DILATE, scale), _scaled_circle_size(MARK_ERRORS_OUTLINE, scale))
+        with profiler.stage('mark_errors'):
+            if roi:
+                return self._mark_errors_roi(images, color, kernels)
+            return self._mark_errors(images, color, kernels)
 
-        images[OUT_IMAGE] = BIN_IMAGE
-        images[BIN_IMAGE] = frame_mask
+    def _mark_errors(self, images, color, kernels):
+        # plt.title("Bin image"), plt.imshow(images[BIN_IMAGE], 'gray', interpolation='none'), plt.show()
+        outlines = self._outlines(images[BIN_IMAGE], kernels)
+        images[OUT_IMAGE] = COLOR_IMAGE
+        images[COLOR_IMAGE] = self._draw_outlines(images[CLIPPED_IMAGE], outlines, color)
+        # plt.title("Final"), plt.imshow(cv2.cvtColor(images[COLOR_IMAGE], cv2.COLOR_BGR2RGB)), plt.show()
         return images
 
+    def _mark_errors_roi(self, images, color, kernels):
+        '''
+        Outline pixel depends only on defects closer than reach, so outlines are drawn in defect
+        bounding boxes padded by reach, computed from windows padded by reach once more.
+        '''
+        mask = images[BIN_IMAGE]
+        color_image = images[CLIPPED_IMAGE]
+        images[OUT_IMAGE] = COLOR_IMAGE
+        if not cv2.countNonZero(mask):
+            images[COLOR_IMAGE] = color_image
+            return images
+
+        height, width = mask.shape[:2]
+        dilate, outline = kernels
+        reach = dilate // 2 + outline // 2
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        boxes = []
+        for x, y, w, h, _ in stats[1:]: # 0 is background
+            region = _padded_box((y, y + h, x, x + w), reach, height, width)
+            boxes.append((region, _padded_box(region, reach, height, width)))
+        if sum((wy2 - wy1) * (wx2 - wx1) for _, (wy1, wy2, wx1, wx2) in boxes) >= height * width:
+            return self._mark_errors(images, color, kernels)
+
+        result = color_image.copy()
+        for (y1, y2, x1, x2), (wy1, wy2, wx1, wx2) in boxes:
+            outlines = self._outlines(mask[wy1:wy2, wx1:wx2], kernels)[y1 - wy1:y2 - wy1, x1 - wx1:x2 - wx1]
+            result[y1:y2, x1:x2] = self._draw_outlines(color_image[y1:y2, x1:x2], outlines, color)
+        images[COLOR_IMAGE] = result
+        return images
 
-    def mark_errors(self, images, color):
-
-        def circle(kernel_size):
-            assert kernel_size % 2 == 1
-            circle_kernel = np.zeros((kernel_size, kernel_size), np.uint8)
-            center = kernel_size / 2
-            y, x = np.ogrid[-center:center+1, -center:center+1]
-            index = x**2 + y**2 <= center**2
-            circle_kernel[:,:][index] = 255
-            return circle_kernel
-
-        # plt.title("Bin image"), plt.imshow(images[BIN_IMAGE], 'gray', interpolation='none'), plt.show()
-        outlines = cv2.dilate(images[BIN_IMAGE], circle(101), iterations=1)
+    def _outlines(self, mask, kernels):
+        dilate, outline = kernels
+        outlines = cv2.dilate(mask, _circle(dilate), iterations=1)
         # plt.title("Dialate"), plt.imshow(outlines, 'gray', interpolation='none'), plt.show()
-        outlines = cv2.morphologyEx(outlines, cv2.MORPH_GRADIENT, circle(41)) #difference between dialation and erosion
+        return cv2.morphologyEx(outlines, cv2.MORPH_GRADIENT, _circle(outline)) #difference between dialation and erosion
+
+    def _draw_outlines(self, color_image, outlines, color):
         outlines_inv = cv2.bitwise_not(outlines)
         # plt.title("Outlines_inv"), plt.imshow(outlines_inv, 'gray', interpolation='none'), plt.show()
-        color_image = images[CLIPPED_IMAGE]
         color_image = cv2.bitwise_and(color_image, color_image, mask=outlines_inv)
         # plt.title("Color image"), plt.imshow(cv2.cvtColor(color_image, cv2.COLOR_BGR2RGB)), plt.show()
         red_outlines = cv2.cvtColor(outlines, cv2.COLOR_GRAY2BGR)
         # plt.title("Red outlines 1"), plt.imshow(cv2.cvtColor(red_outlines, cv2.COLOR_BGR2RGB)), plt.show()
         red_outlines[np.where(outlines==255)] = color
         # plt.title("Red outlines 2"), plt.imshow(cv2.cvtColor(red_outlines, cv2.COLOR_BGR2RGB)), plt.show()
-        images[OUT_IMAGE] = COLOR_IMAGE
-        images[COLOR_IMAGE] = cv2.add(color_image, red_outlines)
-        # plt.title("Final"), plt.imshow(cv2.cvtColor(images[COLOR_IMAGE], cv2.COLOR_BGR2RGB)), plt.show()
-        return images
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        return cv2.add(color_image, red_outlines)
+
+
+@lru_cache(maxsize=None)
+def _circle(kernel_size):
+    assert kernel_size % 2 == 1
+    circle_kernel = np.zeros((kernel_size, kernel_size), np.uint8)
+    center = kernel_size // 2
+    y, x = np.ogrid[-center:center+1, -center:center+1]
+    index = x**2 + y**2 <= center**2
+    circle_kernel[:,:][index] = 255
+    return circle_kernel
+
+def _scaled_circle_size(kernel_size, scale):
+    ''' Odd kernel size nearest to kernel_size resized by scale '''
+    return max(int(round((kernel_size * scale - 1) / 2)), 0) * 2 + 1
+
+def _padded_box(box, padding, height, width):
+    y1, y2, x1, x2 = box
+    return max(y1 - padding, 0), min(y2 + padding, height), max(x1 - padding, 0), min(x2 + padding, width)
+
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8) # set bits of every byte value, hamming distance
+
+def _detect_tile(detectors, image, features, overlap, box):
+    '''
+    Keypoints inside box (y1, y2, x1, x2) of image in image coordinates and their descriptors,
+    detectors - ThreadLocalPool of ORB detectors, every thread uses its own
+    '''
+    y1, y2, x1, x2 = box
+    wy1, wy2, wx1, wx2 = _padded_box(box, overlap, image.shape[0], image.shape[1])
+    mask = np.zeros((wy2 - wy1, wx2 - wx1), np.uint8)
+    mask[y1 - wy1:y2 - wy1, x1 - wx1:x2 - wx1] = 255
+    keypoints, descriptors = detectors.get(nfeatures=features).detectAndCompute(image[wy1:wy2, wx1:wx2], mask)
+    for kp in keypoints:
+        kp.pt = (kp.pt[0] + wx1, kp.pt[1] + wy1)
+    return keypoints, descriptors
+
+# Parallel compare in processes: every worker process has its own ImageService and copy of pattern.
+# Threads share the ImageService which called compare.
+_process_pattern = None
+_process_image_service = None
+
+def _init_process_worker(pattern):
+    global _process_pattern, _process_image_service
+    _process_pattern = pattern
+    _process_image_service = ImageService()
+
+def _compare_panel_in_process(frame_size, profile, panel):
+    ''' profile - None when profiling is disabled, otherwise whether to trace memory; records are sent back with the mask '''
+    profiler = Profiler(trace_memory=profile) if profile is not None else NULL_PROFILER
+    try:
+        return _process_image_service.compare_panel(_process_pattern, frame_size, *panel, profiler=profiler) + (profiler.records,)
+    finally:
+        profiler.close()
@@ -0,0 +1,230 @@
+import os
+import time
+import bisect
+import threading
+import configparser
+from settings import *
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError: # directory is polled instead
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class IngestionService(object):
+    '''
+    Ordered queue of files waiting in processed images directory.
+    Directory is read from config file, which is parsed again only when its modification time changes.
+    Queue is listed once and then fed by filesystem notifications when watchdog is installed,
+    otherwise directory is listed again when queue is empty or poll_interval passed since last listing.
+    Taking next file is O(1), new files are inserted in order, usually at the end.
+    Taken file is not offered again until it is released, e.g. when its inspection was stopped.
+    New file is offered only after its size and modification time stayed the same for settle_time,
+    or when it was closed after writing or moved into directory, so partially written files are not taken.
+    Files not modified for settle_time when they are found, e.g. waiting before the service started, are offered at once.
+    '''
+    def __init__(self, config_path=WORKDIR_PATH, poll_interval=INGESTION_POLL_INTERVAL, watch=INGESTION_WATCH, settle_time=INGESTION_SETTLE_TIME):
+        self.config_path = config_path
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.watch = watch and Observer is not None
+        self._lock = threading.RLock()
+        self._config_mtime = None
+        self._directory = None
+        self._observer = None
+        self._reset()
+
+    def directory(self):
+        ''' Processed images directory from config file '''
+        with self._lock:
+            mtime = os.stat(self.config_path).st_mtime
+            if mtime != self._config_mtime:
+                config_parser = configparser.RawConfigParser()
+                config_parser.read(self.config_path)
+                directory = config_parser.get('bugfinder-config', 'processed_images_path')
+                self._config_mtime = mtime
+                if directory != self._directory:
+                    self._directory = directory
+                    self._reset()
+            return self._directory
+
+    def next_filename(self, wait=False):
+        '''
+        First waiting file, None when there is none.
+        wait - when no file is waiting, wait for new files which have not settled yet instead of returning None
+        '''
+        while True:
+            with self._lock:
+                filename = self._take()
+                if filename is not None or not wait or not self._settling:
+                    return filename
+                delay = min(since for _, since in self._settling.values()) + self.settle_time - time.time()
+            time.sleep(max(delay, 0)) # until the first of them may settle
+
+    def pending(self):
+        ''' Waiting files in order '''
+        with self._lock:
+            self._refresh()
+            return self._names[self._head:]
+
+    def settling(self):
+        ''' New files in order which are not offered yet, they may still be written '''
+        with self._lock:
+            self._refresh()
+            return sorted(self._settling)
+
+    def done(self, filename):
+        ''' Taken file left directory '''
+        with self._lock:
+            self._taken.discard(filename)
+
+    def release(self, filename):
+        ''' Taken file is still in directory and waits again '''
+        with self._lock:
+            if filename in self._taken:
+                self._taken.remove(filename)
+                self._add(filename)
+
+    def close(self):
+        with self._lock:
+            self._stop_observer()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names) - self._head
+
+    def _reset(self):
+        self._names = [] # sorted, files before _head were taken
+        self._head = 0
+        self._queued = set()
+        self._taken = set()
+        self._settling = {} # new files not offered yet, filename -> (size and mtime, time they were seen first)
+        self._listed = None # time of last listing
+        self._stop_observer()
+
+    def _take(self):
+        self._refresh()
+        if self._head == len(self._names):
+            return None
+        filename = self._names[self._head]
+        self._names[self._head] = None
+        self._head += 1
+        if self._head > len(self._names) // 2: # drop taken part, O(1) amortized
+            del self._names[:self._head]
+            self._head = 0
+        self._queued.remove(filename)
+        self._taken.add(filename)
+        return filename
+
+    def _refresh(self):
+        directory = self.directory()
+        if self._listed is None or self._observer is None and (
+                len(self._names) == self._head or time.time() - self._listed >= self.poll_interval):
+            if self.watch and self._observer is None and os.path.isdir(directory):
+                self._start_observer(directory) # before listing, so no file is missed
+            self._list(directory)
+        self._settle()
+
+    def _list(self, directory):
+        self._listed = time.time()
+        filenames = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        filenames -= self._taken
+        for filename in set(self._settling) - filenames:
+            del self._settling[filename]
+        if self._queued - filenames: # some were removed by someone else
+            self._queued &= filenames
+            self._names = sorted(self._queued)
+            self._head = 0
+        for filename in sorted(filenames - self._queued):
+            self._arrived(filename)
+
+    def _arrived(self, filename, complete=False):
+        ''' New file waits until it settles, complete one is offered at once '''
+        if filename in self._queued or filename in self._taken:
+            return
+        if complete:
+            self._settling.pop(filename, None)
+            self._add(filename)
+        elif filename not in self._settling:
+            signature = self._signature(filename)
+            if signature is not None and time.time() - signature[1] / 1e9 >= self.settle_time: # not modified for long
+                self._add(filename)
+            else:
+                self._settling[filename] = (signature, time.time())
+
+    def _settle(self):
+        ''' Offers new files which were not changed for settle_time '''
+        now = time.time()
+        for filename, (signature, since) in sorted(self._settling.items()):
+            current = self._signature(filename)
+            if current is None: # removed before it settled
+                del self._settling[filename]
+            elif current != signature:
+                self._settling[filename] = (current, now)
+            elif now - since >= self.settle_time:
+                del self._settling[filename]
+                self._add(filename)
+
+    def _signature(self, filename):
+        try:
+            stat = os.stat(os.path.join(self._directory, filename))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _add(self, filename):
+        if filename in self._queued or filename in self._taken:
+            return
+        self._queued.add(filename)
+        if self._head == len(self._names) or filename > self._names[-1]:
+            self._names.append(filename)
+        else:
+            bisect.insort(self._names, filename, lo=self._head)
+
+    def _remove(self, filename):
+        if filename in self._queued:
+            self._queued.remove(filename)
+            index = bisect.bisect_left(self._names, filename, lo=self._head)
+            del self._names[index]
+
+    def _start_observer(self, directory):
+        self._observer = Observer()
+        self._observer.schedule(_DirectoryHandler(self), directory, recursive=False)
+        self._observer.daemon = True
+        self._observer.start()
+
+    def _stop_observer(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def _notified(self, added=None, removed=None, complete=False):
+        with self._lock:
+            if removed is not None:
+                self._settling.pop(os.path.basename(removed), None)
+                self._remove(os.path.basename(removed))
+            if added is not None and os.path.dirname(os.path.abspath(added)) == os.path.abspath(self._directory):
+                self._arrived(os.path.basename(added), complete)
+
+
+class _DirectoryHandler(FileSystemEventHandler):
+    def __init__(self, ingestion_service):
+        super().__init__()
+        self.ingestion_service = ingestion_service
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.ingestion_service._notified(added=event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.ingestion_service._notified(added=event.dest_path, removed=event.src_path, complete=True)
+
+    def on_closed(self, event): # file written by other process is complete
+        if not event.is_directory:
+            self.ingestion_service._notified(added=event.src_path, complete=True)
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.ingestion_service._notified(removed=event.src_path)
@@ -0,0 +1,172 @@
+import time
+import queue
+import threading
+from settings import *
+from profiler import Profiler, NULL_PROFILER
+from errors import RecognitionError
+from models.defects import scaled_defects
+
+
+class InspectionResult(object):
+    def __init__(self, filename, profiler=NULL_PROFILER):
+        self.filename = filename
+        self.profiler = profiler
+        self.image = None
+        self.images = None
+        self.pattern = None # pattern the image was compared with
+        self.defects = None # structured array of DEFECT_DTYPE, in pixels of source image
+        self.error = None
+        self.generation = None # inspection worker which produced the result
+        self.started = time.time()
+        self.finished = None
+
+    def seconds(self):
+        return self.finished - self.started
+
+
+class PipelineService(object):
+    '''
+    Inspects stream of images with overlapping stages: decode -> transform -> compare -> render and extract defects.
+    Every stage runs in its own thread, so image N+1 is decoded and transformed while image N is compared.
+    Stages are connected with bounded queues, a stage blocks when the queue after it is full (backpressure).
+    Every stage takes images in order, so results come out in the same order as filenames.
+    Images are decoded resized by working_scale of settings and inspected with settings, pattern
+    and pixel sized constants scaled to match, result images stay at that scale, defects are mapped back to source pixels.
+    '''
+    _DONE = object()
+
+    def __init__(self, storage_service, image_service, pattern, settings, color, queue_depths=PIPELINE_QUEUE_DEPTHS,
+                 workers=COMPARE_WORKERS, executor=COMPARE_EXECUTOR, profile=False, trace_memory=True, archive=True):
+        '''
+        pattern - Pattern, or function of transformed images returning their Pattern or None when not recognized
+        queue_depths - maximal number of images waiting before transform, compare, render and output,
+                       single number sets all of them
+        workers, executor - passed to ImageService.compare
+        profile - give every result its own Profiler with stages of all steps
+        trace_memory - record peak allocation of profiled stages
+        archive - archive source files of inspected images, otherwise caller archives or releases them,
+                  source files of failed images are always moved to failed images
+        '''
+        self.storage_service = storage_service
+        self.image_service = image_service
+        self.pattern = pattern
+        self.settings = settings
+        self.working_scale = getattr(settings, 'working_scale', 1.0)
+        self.working_settings = settings.working_settings() if self.working_scale != 1 else settings
+        self.color = color
+        self.queue_depths = queue_depths if isinstance(queue_depths, (tuple, list)) else (queue_depths,) * 4
+        self.workers = workers
+        self.executor = executor
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.archive = archive
+
+    def run(self, filenames):
+        '''
+        Generator of InspectionResult, one for each filename.
+        Source file is archived when its result comes out (unless archive is False), failed stage is stored
+        in result.error and its source file is moved to failed images instead.
+        Closing generator early stops all stages. Exception raised by filenames is raised after results before it.
+        '''
+        stop = threading.Event()
+        failures = []
+        queues = [queue.Queue(maxsize=depth) for depth in self.queue_depths]
+        threads = [threading.Thread(target=self._feed, args=(iter(filenames), queues[0], stop, failures), daemon=True)]
+        for stage, source, target in zip([self._transform, self._compare, self._render], queues, queues[1:]):
+            threads.append(threading.Thread(target=self._stage, args=(stage, source, target, stop), daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                result = queues[-1].get()
+                if result is self._DONE:
+                    if failures:
+                        raise failures[0]
+                    break
+                if self.archive or result.error is not None:
+                    self._run_stage(self._archive, result)
+                result.profiler.close() # all stages are done, memory tracing stops with the last profiler
+                yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            for source in queues: # results left when stopped early
+                while not source.empty():
+                    item = source.get_nowait()
+                    if item is not self._DONE:
+                        item.profiler.close()
+
+    def _feed(self, filenames, target, stop, failures):
+        ''' First stage, decodes files in order '''
+        try:
+            for filename in filenames:
+                result = InspectionResult(filename, Profiler(self.trace_memory) if self.profile else NULL_PROFILER)
+                self._run_stage(self._decode, result)
+                if not self._put(target, result, stop):
+                    return
+        except Exception as e: # e.g. directory can not be listed, stages finish images taken before
+            failures.append(e)
+        self._put(target, self._DONE, stop)
+
+    def _stage(self, stage, source, target, stop):
+        while not stop.is_set():
+            try:
+                result = source.get(timeout=PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if result is not self._DONE and result.error is None:
+                self._run_stage(stage, result)
+            if not self._put(target, result, stop) or result is self._DONE:
+                return
+
+    def _run_stage(self, stage, result):
+        try:
+            stage(result)
+        except Exception as e:
+            if result.error is None:
+                result.error = e
+            result.finished = time.time()
+
+    def _put(self, target, item, stop):
+        ''' Blocks while target is full, returns False when pipeline was stopped '''
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=PIPELINE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        if item is not self._DONE:
+            item.profiler.close() # dropped
+        return False
+
+    def _decode(self, result):
+        with result.profiler.stage('decode'):
+            result.image = self.storage_service.read_image(result.filename, self.working_scale)
+        if result.image is None:
+            raise IOError("{0} is not an image".format(result.filename))
+
+    def _transform(self, result):
+        result.images = self.image_service.transform_image(result.image, self.working_settings, result.profiler)
+        result.image = None
+
+    def _compare(self, result):
+        result.pattern = self.pattern
+        if callable(self.pattern):
+            result.pattern = self.pattern(result.images)
+            if result.pattern is None:
+                raise RecognitionError("Pattern of {0} was not recognized".format(result.filename))
+        pattern = result.pattern.scaled(self.working_scale) if self.working_scale != 1 else result.pattern
+        result.images = self.image_service.compare(pattern, result.images, self.working_settings, self.workers, self.executor, result.profiler, scale=self.working_scale)
+
+    def _render(self, result):
+        defects = self.image_service.extract_defects(result.images[BIN_IMAGE], result.images.get(PANEL_BOXES, ()), result.profiler)
+        result.defects = scaled_defects(defects, 1 / self.working_scale)
+        result.images = self.image_service.mark_errors(result.images, self.color, result.profiler, scale=self.working_scale)
+        result.finished = time.time()
+
+    def _archive(self, result):
+        if result.error is None:
+            self.storage_service.archive_image(result.filename)
+        else:
+            self.storage_service.fail_image(result.filename)
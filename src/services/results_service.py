@@ -0,0 +1,141 @@
+import os
+import time
+import shutil
+import numpy as np
+from settings import *
+from models.defects import DEFECT_DTYPE
+
+
+class _Chunk(dict):
+    ''' Columns of one chunk, every column is memory mapped on first access '''
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def __missing__(self, column):
+        self[column] = np.load(os.path.join(self.directory, column + '.npy'), mmap_mode='r')
+        return self[column]
+
+
+class ResultsService(object):
+    '''
+    Append-only columnar store of inspection results, queried without reading any image.
+    Table images has a row for every inspected image, table defects a row for every defect with
+    image column pointing to row of images.
+    Rows are buffered and written as a chunk once chunk_rows of a table are buffered: directory
+    <table>/<chunk number> with one .npy file per column. Chunk is written under temporary name and renamed,
+    so readers never see a partial chunk, temporary chunks left by a crashed writer are removed when store is opened.
+    Buffered rows are visible after flush or close.
+    One process appends at a time.
+    '''
+    TABLES = {
+        'images': ['image', 'time', 'seconds', 'defects', 'filename', 'pattern'],
+        'defects': ['image'] + list(DEFECT_DTYPE.names),
+    }
+
+    def __init__(self, directory=RESULTS_STORE_DIR, chunk_rows=RESULTS_CHUNK_ROWS):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self._buffers = {}
+        self._buffered = {}
+        self._next_chunk = {}
+        for table in self.TABLES:
+            os.makedirs(os.path.join(directory, table), exist_ok=True)
+            for name in os.listdir(os.path.join(directory, table)):
+                if name.startswith('.'): # chunk not renamed before crash
+                    shutil.rmtree(os.path.join(directory, table, name), ignore_errors=True)
+            self._buffers[table] = dict((column, []) for column in self.TABLES[table])
+            self._buffered[table] = 0
+            chunks = self._chunk_names(table)
+            self._next_chunk[table] = int(chunks[-1]) + 1 if chunks else 0
+        self._next_image = self.count('images')
+        for chunk in list(self.chunks('defects'))[-1:]: # defects written before their images were lost keep their ids
+            self._next_image = max(self._next_image, int(chunk['image'][-1]) + 1)
+
+    def append(self, filename, defects, pattern=None, seconds=0.0):
+        '''
+        Adds image and its defects, structured array of DEFECT_DTYPE from ImageService.extract_defects.
+        Returns id of the image, its row in table images.
+        '''
+        image = self._next_image
+        self._next_image += 1
+        self._add('images', 1, {
+            'image': np.array([image], np.int64),
+            'time': np.array([time.time()], np.float64),
+            'seconds': np.array([seconds], np.float32),
+            'defects': np.array([len(defects)], np.int32),
+            'filename': np.array([filename.encode('utf-8')]),
+            'pattern': np.array([(pattern or '').encode('utf-8')]),
+        })
+        columns = dict((name, np.ascontiguousarray(defects[name])) for name in DEFECT_DTYPE.names)
+        columns['image'] = np.full(len(defects), image, np.int64)
+        self._add('defects', len(defects), columns)
+        return image
+
+    def flush(self):
+        for table in self.TABLES:
+            self._write_chunk(table)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def chunks(self, table):
+        ''' Written chunks of table as dicts of memory mapped columns '''
+        for name in self._chunk_names(table):
+            yield _Chunk(os.path.join(self.directory, table, name))
+
+    def query(self, table, columns=None, where=None):
+        '''
+        Rows of table as dict of column arrays.
+        columns - names of returned columns, all of table when None
+        where - function of chunk returning boolean mask of its rows, e.g. lambda c: c['area'] > 100
+        String columns are bytes.
+        '''
+        columns = columns or self.TABLES[table]
+        parts = dict((column, []) for column in columns)
+        for chunk in self.chunks(table):
+            rows = where(chunk) if where else slice(None)
+            for column in columns:
+                parts[column].append(np.asarray(chunk[column][rows]))
+        return dict(
+            (column, np.concatenate(arrays) if arrays else np.empty(0))
+            for column, arrays in parts.items()
+        )
+
+    def count(self, table, where=None):
+        ''' Number of written rows of table, only where is true when given '''
+        if where is None:
+            return sum(len(chunk['image']) for chunk in self.chunks(table))
+        return sum(int(np.count_nonzero(where(chunk))) for chunk in self.chunks(table))
+
+    def _add(self, table, rows, columns):
+        if not rows:
+            return
+        for column, values in columns.items():
+            self._buffers[table][column].append(values)
+        self._buffered[table] += rows
+        if self._buffered[table] >= self.chunk_rows:
+            self._write_chunk(table)
+
+    def _write_chunk(self, table):
+        if not self._buffered[table]:
+            return
+        name = '{0:08d}'.format(self._next_chunk[table])
+        temporary = os.path.join(self.directory, table, '.' + name)
+        shutil.rmtree(temporary, ignore_errors=True) # left by crashed writer
+        os.makedirs(temporary)
+        for column, arrays in self._buffers[table].items():
+            np.save(os.path.join(temporary, column + '.npy'), np.concatenate(arrays))
+            arrays.clear()
+        os.rename(temporary, os.path.join(self.directory, table, name))
+        self._next_chunk[table] += 1
+        self._buffered[table] = 0
+
+    def _chunk_names(self, table):
+        return sorted(name for name in os.listdir(os.path.join(self.directory, table)) if not name.startswith('.'))
@@ -0,0 +1,39 @@
+import threading
+
+
+class ThreadLocalPool(object):
+    '''
+    OpenCV detectors and CLAHE keep state between calls and are not thread safe.
+    Pool creates object with factory(**kwargs) on first get in every thread and returns the same one
+    to later calls with equal kwargs from that thread.
+    '''
+    def __init__(self, factory):
+        self.factory = factory
+        self._local = threading.local()
+
+    def get(self, **kwargs):
+        objects = getattr(self._local, 'objects', None)
+        if objects is None:
+            objects = self._local.objects = {}
+        key = tuple(sorted(kwargs.items()))
+        if key not in objects:
+            objects[key] = self.factory(**kwargs)
+        return objects[key]
+
+
+class ServiceContext(object):
+    '''
+    Services shared by image processes, created on first use.
+    ImageProcess.context is the default one, process or its class may be given another, e.g. in tests.
+    '''
+    def __init__(self, image_service=None):
+        self._image_service = image_service
+        self._lock = threading.Lock()
+
+    @property
+    def image_service(self):
+        with self._lock:
+            if self._image_service is None:
+                from services.image_service import ImageService
+                self._image_service = ImageService()
+            return self._image_service
@@ -5,41 +5,128 @@ import cv2
 import numpy as np
 import pickle
 import json
+import threading
 from settings import *
 from models.settings import Settings
 from models.pattern import Pattern
+from models.pattern_index import PatternIndex
+from services.ingestion_service import IngestionService
 from image_processors.abc.image_process import *
 import importlib
-import configparser
+
+REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
 
 class StorageService(object):
 
     def __init__(self):
-        self.config_parser = configparser.RawConfigParser()   
+        self.ingestion_service = IngestionService()
+        self._pattern_index = None
+        self._pattern_index_lock = threading.RLock() # index is used by inspection worker too
 
-    def save_pattern(self, pattern, overwrite=False):
-        directory = os.path.join(PATTERNS_DIR, pattern.name)
-        if os.path.exists(directory):
-            if overwrite:
-                shutil.rmtree(directory)
+    def save_pattern(self, pattern, overwrite=False, bundle=True):
+        '''
+        bundle - write pattern as single memory mappable file instead of binary image, keypoints json and descriptors
+        Pattern is added to pattern_index when it was already built.
+        '''
+        with self._pattern_index_lock: # index is never built from half written pattern
+            directory = os.path.join(PATTERNS_DIR, pattern.name)
+            if os.path.exists(directory):
+                if overwrite:
+                    shutil.rmtree(directory)
+                else:
+                    raise IOError("Pattern already exists")
+            os.makedirs(directory)
+            if bundle:
+                self._save_pattern_bundle(pattern, os.path.join(directory, PATTERN_BUNDLE_FILENAME))
             else:
-                raise IOError("Pattern already exists")
-        os.mkdir(directory)
-        cv2.imwrite(os.path.join(directory, BINARY_FILENAME), pattern.image, [cv2.IMWRITE_JPEG_QUALITY, 100])
-        with open(os.path.join(directory, KEYPOINTS_FILENAME), 'w') as f:
-            json.dump(self._keypoints_to_json(pattern.keypoints), f)
-        np.save(os.path.join(directory, DESCRIPTORS_FILENAME), pattern.descriptors)
+                cv2.imwrite(os.path.join(directory, BINARY_FILENAME), pattern.image, [cv2.IMWRITE_JPEG_QUALITY, 100])
+                with open(os.path.join(directory, KEYPOINTS_FILENAME), 'w') as f:
+                    json.dump(self._keypoints_to_json(pattern.keypoints), f)
+                np.save(os.path.join(directory, DESCRIPTORS_FILENAME), pattern.descriptors)
+            if self._pattern_index is not None:
+                self._pattern_index.add(pattern)
+
+    def pattern_index(self):
+        '''
+        PatternIndex of every saved pattern, built on first use and kept up to date by save_pattern.
+        Missing patterns directory has no patterns.
+        '''
+        with self._pattern_index_lock:
+            if self._pattern_index is None:
+                names = sorted(os.listdir(PATTERNS_DIR)) if os.path.isdir(PATTERNS_DIR) else []
+                self._pattern_index = PatternIndex(self.load_pattern(name) for name in names)
+            return self._pattern_index
 
     def load_pattern(self, name):
         directory = os.path.join(PATTERNS_DIR, name)
         pattern = Pattern(name)
-        if os.path.exists(directory):
+        bundle_path = os.path.join(directory, PATTERN_BUNDLE_FILENAME)
+        if os.path.exists(bundle_path):
+            self._load_pattern_bundle(pattern, bundle_path)
+        elif os.path.exists(directory):
             pattern.image = cv2.imread(os.path.join(directory, BINARY_FILENAME), cv2.IMREAD_GRAYSCALE)
             with open(os.path.join(directory, KEYPOINTS_FILENAME), 'r') as f:
                 pattern.keypoints = self._json_to_keypoints(json.load(f))
             pattern.descriptors = np.load(os.path.join(directory, DESCRIPTORS_FILENAME))
         return pattern
 
+    def _save_pattern_bundle(self, pattern, path):
+        '''
+        Bundle layout: magic, header length (uint64), json header, then binary image, keypoint array and descriptors,
+        each starting at offset aligned to PATTERN_BUNDLE_ALIGNMENT. Header holds offset, dtype and shape of every array.
+        '''
+        arrays = [
+            ('image', np.ascontiguousarray(pattern.image)),
+            ('keypoints', np.ascontiguousarray(pattern.keypoint_array)),
+            ('descriptors', np.ascontiguousarray(pattern.descriptors)),
+        ]
+        header = {'name': pattern.name, 'keypoint_tiles': list(pattern.keypoint_tiles), 'arrays': {}}
+        offset = 0
+        for key, array in arrays:
+            dtype = array.dtype.descr if array.dtype.names else array.dtype.str
+            header['arrays'][key] = {'offset': offset, 'dtype': dtype, 'shape': array.shape}
+            offset = self._align(offset + array.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_offset = self._align(len(PATTERN_BUNDLE_MAGIC) + 8 + len(header_bytes))
+        with open(path, 'wb') as f:
+            f.write(PATTERN_BUNDLE_MAGIC)
+            f.write(np.uint64(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            for key, array in arrays:
+                f.seek(data_offset + header['arrays'][key]['offset'])
+                f.write(array.tobytes())
+
+    def _load_pattern_bundle(self, pattern, path):
+        ''' Arrays are memory mapped read only, nothing is decoded '''
+        with open(path, 'rb') as f:
+            if f.read(len(PATTERN_BUNDLE_MAGIC)) != PATTERN_BUNDLE_MAGIC:
+                raise IOError("{0} is not a pattern bundle".format(path))
+            header_length = int(np.frombuffer(f.read(8), np.uint64)[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        data_offset = self._align(len(PATTERN_BUNDLE_MAGIC) + 8 + header_length)
+
+        def memmap(key):
+            info = header['arrays'][key]
+            dtype = np.dtype(info['dtype'] if isinstance(info['dtype'], str) else [tuple(field) for field in info['dtype']])
+            shape = tuple(info['shape'])
+            if not np.prod(shape):
+                return np.empty(shape, dtype)
+            return np.memmap(path, dtype=dtype, mode='r', offset=data_offset + info['offset'], shape=shape)
+
+        pattern.keypoint_tiles = tuple(header.get('keypoint_tiles', (1, 1))) # bundles saved before tiling detected whole image
+        pattern.image = memmap('image')
+        pattern.keypoint_array = memmap('keypoints')
+        pattern.descriptors = memmap('descriptors')
+
+    def _align(self, offset):
+        return -(-offset // PATTERN_BUNDLE_ALIGNMENT) * PATTERN_BUNDLE_ALIGNMENT
+
     def _keypoints_to_json(self, keypoints):
         return [{'class_id': kp.class_id, 'x': kp.pt[0], 'y': kp.pt[1], 'size': kp.size, 'angle': kp.angle, 'octave': kp.octave, 'response': kp.response} for kp in keypoints]
 
@@ -62,6 +149,7 @@ class StorageService(object):
         json_dict = {
             NAME: settings.name,
             IMAGE_PROCESSES: [image_process.serialize() for image_process in settings.image_processes()],
+            WORKING_SCALE: settings.working_scale,
         }
         with open(settings_path, 'w') as f:
             json.dump(json_dict, f)
@@ -73,19 +161,59 @@ class StorageService(object):
             with open(settings_path, 'r') as f:
                 json_dict = json.load(f)
                 image_processes = [ImageProcess.from_json(j) for j in json_dict[IMAGE_PROCESSES]]
-                settings = Settings(settings_name, image_processes)
+                settings = Settings(settings_name, image_processes, json_dict.get(WORKING_SCALE, 1.0))
         return settings
             
-    def next_image(self):
-        self.config_parser.read(WORKDIR_PATH)
-        directory = self.config_parser.get('bugfinder-config', 'processed_images_path')
-        filename = sorted(os.listdir(directory))[0]
-        filepath = os.path.join(directory, filename)
-        img = cv2.imread(filepath, cv2.IMREAD_COLOR)
+    def next_image(self, scale=1.0):
+        filename = self.next_image_filename(wait=True)
+        if filename is None:
+            return None
+        img = self.read_image(filename, scale)
+        self.archive_image(filename)
+        return img
+
+    def images_directory(self):
+        return self.ingestion_service.directory()
+
+    def pending_images(self):
+        ''' Sorted names of files waiting in processed images directory '''
+        return self.ingestion_service.pending()
+
+    def next_image_filename(self, wait=False):
+        '''
+        Takes first waiting file, None when there is none, see IngestionService.
+        wait - wait for files which are still written instead of returning None
+        '''
+        return self.ingestion_service.next_filename(wait)
+
+    def release_image(self, filename):
+        ''' Taken file which was not archived waits again '''
+        self.ingestion_service.release(filename)
+
+    def read_image(self, filename, scale=1.0):
+        '''
+        Color image resized by scale. JPEG is decoded directly at 1/2, 1/4 or 1/8 of its size when scale allows,
+        only the rest of the reduction is done by resize.
+        '''
+        path = os.path.join(self.images_directory(), filename)
+        reduction = 1
+        while reduction < 8 and scale * reduction * 2 <= 1:
+            reduction *= 2
+        image = cv2.imread(path, REDUCED_COLOR_FLAGS[reduction])
+        if image is not None and scale * reduction != 1:
+            image = cv2.resize(image, None, fx=scale * reduction, fy=scale * reduction, interpolation=cv2.INTER_AREA)
+        return image
+
+    def archive_image(self, filename):
+        filepath = os.path.join(self.images_directory(), filename)
         if PROCESSED_IMAGES_PATH:
             os.rename(filepath, os.path.join(PROCESSED_IMAGES_PATH, filename))
         else:
             os.remove(filepath)
-        return img
-
+        self.ingestion_service.done(filename)
 
+    def fail_image(self, filename):
+        ''' Moves image which could not be inspected to FAILED_IMAGES_PATH, so it is neither archived nor lost '''
+        os.makedirs(FAILED_IMAGES_PATH, exist_ok=True)
+        shutil.move(os.path.join(self.images_directory(), filename), os.path.join(FAILED_IMAGES_PATH, filename))
+        self.ingestion_service.done(filename)
@@ -5,11 +5,18 @@ DATA_DIR = os.path.join(ROOT_DIR, 'data')
 ICONS_DIR = os.path.join(ROOT_DIR, 'icons')
 PATTERNS_DIR = os.path.join(DATA_DIR, 'patterns')
 SETTINGS_DIR = os.path.join(DATA_DIR, 'settings')
+RESULTS_DIR = os.path.join(DATA_DIR, 'results')
+RESULTS_STORE_DIR = os.path.join(RESULTS_DIR, 'store')
 BINARY_FILENAME = 'binary.png'
 KEYPOINTS_FILENAME = 'keypoints.pickle'
 DESCRIPTORS_FILENAME = 'descriptors.npy'
+PATTERN_BUNDLE_FILENAME = 'pattern.bundle'
+PATTERN_BUNDLE_MAGIC = b'BUGFINDER-PATTERN-1'
+PATTERN_BUNDLE_ALIGNMENT = 64
+SUMMARY_FILENAME = 'summary.jsonl'
 WORKDIR_PATH = os.path.join(DATA_DIR, 'config.txt')
 PROCESSED_IMAGES_PATH = '/home/leszek/PWR/BugFinder/sample_data/test'
+FAILED_IMAGES_PATH = os.path.join(DATA_DIR, 'failed') # images which could not be inspected, never deleted
 
 CLIP = (1, 'Clip')
 COLOR = (2, 'Color')
@@ -17,14 +24,82 @@ GRAY = (3, 'Gray')
 BINARY = (4, 'Binary')
 SPLIT = (5, 'Split')
 
+#RANSAC
+RANSAC_BATCH_SIZE = 100
+RANSAC_CONFIDENCE = 0.999
+
+#KEYPOINTS
+KEYPOINT_FEATURES = 10000 # ORB features of whole image, split evenly between tiles
+KEYPOINT_TILES = (2, 2) # rows, cols of tiles with separate feature budget for new patterns, stored in pattern and used for images compared with it
+KEYPOINT_TILE_OVERLAP = 111 # pixels of neighbours given to ORB, its edge threshold 31 at the coarsest of 8 levels scaled by 1.2
+KEYPOINT_WORKERS = 4 # threads detecting tiles
+
+#MATCHING
+LSH_INDEX_PARAMS = dict(
+    algorithm = 6, # FLANN_INDEX_LSH
+    table_number = 12, # 6
+    key_size = 20,     # 12
+    multi_probe_level = 2 # 1
+)
+LSH_SEARCH_PARAMS = dict(checks=50)
+LSH_INDEX_SEED = 0
+GUIDED_MATCHING = False # match panels near where previous image of the same panel put pattern keypoints, result depends on image order
+GUIDED_MATCH_RADIUS = 10 # pattern pixels around predicted position searched for a match
+GUIDED_MAX_DISTANCE = 64 # hamming distance accepted when window has only one candidate
+GUIDED_MIN_INLIERS_RATIO = 0.5 # fewer ransac inliers than this part of previous image's fall back to matching whole pattern
+
+#RECOGNITION
+RECOGNITION_FEATURES = 500 # strongest keypoints of image voting for its pattern
+RECOGNITION_LEVEL = 1 # image is halved this many times before detection, ORB pyramid of pattern covers the scale
+RECOGNITION_MIN_VOTES = 20 # fewer votes for the best pattern leave image unrecognized
+RECOGNITION_MARGIN = 2.0 # best pattern needs this many times the votes of the second, wrong patterns get some votes too
+
+#COMPARE
+COMPARE_WORKERS = 1
+COMPARE_EXECUTOR = 'thread' # 'thread' or 'process'
+COMPARE_OPENING_KERNEL = (20, 20) # removes differences thinner than kernel
+
+#PIPELINE
+PIPELINE_QUEUE_DEPTHS = (2, 2, 2, 2) # images waiting before transform, compare, render and output
+PIPELINE_POLL_INTERVAL = 0.1 # seconds
+
+#INGESTION
+INGESTION_POLL_INTERVAL = 1.0 # seconds between listings of processed images directory when it is not watched
+INGESTION_WATCH = True # watch directory with watchdog when installed instead of listing it
+INGESTION_SETTLE_TIME = 1.0 # seconds size and modification time of new file must stay the same before it is taken
+
+#INSPECTION
+INSPECTION_READY_RESULTS = 3 # images taken from directory and not shown yet, inspected or not, worker takes no more
+
+#RESULTS STORE
+RESULTS_CHUNK_ROWS = 65536 # rows of a table buffered before they are written as one chunk
+
+#STAGE CACHE
+STAGE_CACHE_BYTES = 1024 ** 3 # memory for outputs of transformations kept by settings editor
+
+#MARK ERRORS
+MARK_ERRORS_DILATE = 101 # circle kernel joining defects, odd
+MARK_ERRORS_OUTLINE = 41 # circle kernel of outline width, odd
+MARK_ERRORS_ROI = True # draw outlines only around defects instead of whole frame
+
+#PREVIEW
+PREVIEW_PROXY_LEVEL = 2 # settings editor previews image halved this many times, 0 shows full resolution
+PREVIEW_MAX_PROXY_LEVEL = 5
+
+#DISPLAY
+DISPLAY_TILE_SIZE = 512 # pixels of pyramid level in one tile added when zoomed in
+DISPLAY_ZOOM_STEP = 1.25 # zoom of one mouse wheel step
+
 #CONST STRINGS FOR GUI:
 NAME = 'Name'
 GRID = 'Grid'
 PATTERN_COMBO_NAME = '--select pattern--'
+PATTERN_AUTO_NAME = '--recognize pattern--'
 SETTINGS_COMBO_NAME = '--select settings--'
 
 #CONSTS
 IMAGE_PROCESSES = 'image_processes'
+WORKING_SCALE = 'working_scale'
 TRANSFORMATIONS = 'transformations'
 SPLITS = 'splits'
 PATTERN = 'pattern'
@@ -33,3 +108,4 @@ CLIPPED_IMAGE = 'clipped_image'
 GRAY_IMAGE = 'gray_image'
 BIN_IMAGE = 'bin_image'
 OUT_IMAGE = 'out_image'
+PANEL_BOXES = 'panel_boxes'
@@ -0,0 +1,65 @@
+import json
+from collections import OrderedDict
+from settings import *
+
+
+class StageCache(object):
+    '''
+    Outputs of transformations of source images, used by ImageService.transform_image.
+    Output of a stage is keyed by key of the stage before it and by its own serialized parameters,
+    so after a change only the changed stage and stages after it miss the cache.
+    First stage is keyed by identity of source image, so outputs of several sources, e.g. proxy and
+    full resolution preview, are cached together. Every output keeps its source alive, so id of a cached source
+    is never reused by another image.
+    Least recently used outputs are evicted when arrays they added exceed max_bytes.
+    '''
+    def __init__(self, max_bytes=STAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._source = None
+        self._entries = OrderedDict()
+
+    def source_key(self, image):
+        ''' Key of the first stage, outputs put after it keep the image alive '''
+        source = (id(image), image.shape)
+        self._source = (source, image)
+        return (source,)
+
+    @staticmethod
+    def stage_key(key, transformation):
+        return key + ((transformation.__class__.__name__, json.dumps(transformation.serialize(), sort_keys=True)),)
+
+    def get(self, key):
+        ''' Copy of images dict stored under key or None '''
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry[0])
+
+    def put(self, key, images, previous):
+        ''' Stores copy of images, only arrays which are not in previous count to memory used '''
+        previous_ids = set(id(v) for v in previous.values())
+        nbytes = sum(v.nbytes for v in images.values() if hasattr(v, 'nbytes') and id(v) not in previous_ids)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        source = self._source[1] if self._source is not None and key[:1] == (self._source[0],) else None
+        self._entries[key] = (dict(images), nbytes, source)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def clear(self):
+        self._entries.clear()
+        self._source = None
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,49 @@
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+from benchmarks import run
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def main(self, *argv):
+        ''' Exit code, JSON report and stderr of benchmarks run on the smallest board all benchmarks work on '''
+        output = os.path.join(self.directory, 'results.json')
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            code = run.main(['--widths', '640', '--repeat', '1', '-o', output] + list(argv))
+        with open(output) as f:
+            return code, json.load(f), stderr.getvalue()
+
+    def test_report(self):
+        code, report, _ = self.main()
+        self.assertEqual(code, 0)
+        self.assertTrue(set(['created', 'python', 'numpy', 'opencv', 'machine', 'processor', 'repeat']) <= set(report['meta']))
+        self.assertEqual(report['meta']['repeat'], 1)
+        self.assertListEqual([r['name'] for r in report['results']], [name for name, _ in run.BENCHMARKS])
+        for result in report['results']:
+            self.assertEqual(result['width'], 640)
+            self.assertGreater(result['height'], 0)
+            self.assertEqual(len(result['times']), 1)
+            self.assertTrue(0 < result['min'] <= result['median'] <= max(result['times']))
+
+    def test_baseline(self):
+        _, report, _ = self.main('--only', 'MorphologyOpening')
+        self.assertEqual(len(report['results']), 1)
+        baseline = os.path.join(self.directory, 'baseline.json')
+        median = report['results'][0]['median']
+        for factor, expected in [(100, 0), (0.01, 1)]: # baseline much slower, then much faster
+            report['results'][0]['median'] = median * factor
+            with open(baseline, 'w') as f:
+                json.dump(report, f)
+            code, _, stderr = self.main('--only', 'MorphologyOpening', '--baseline', baseline)
+            self.assertEqual(code, expected)
+            self.assertEqual('REGRESSION MorphologyOpening.transform at 640' in stderr, bool(expected))
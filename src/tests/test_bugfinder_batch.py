@@ -0,0 +1,85 @@
+import os
+import io
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+import numpy as np
+import cv2
+import bugfinder_batch
+from services.image_service import ImageService
+from services.ingestion_service import IngestionService
+from services.storage_service import StorageService
+from services.results_service import ResultsService
+from models.pattern import Pattern
+from models.settings import Settings
+from image_processors.grid import Grid
+from image_processors.bgr_to_gray import BgrToGray
+from image_processors.otsu import OtsuBinarization
+from settings import *
+
+
+class BugfinderBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = dict((name, os.path.join(self.directory, name)) for name in ['patterns', 'settings', 'images', 'archive', 'failed', 'results'])
+        for name in ['patterns', 'settings', 'images', 'archive']:
+            os.makedirs(self.path[name])
+        config_path = os.path.join(self.directory, 'config.txt')
+        with open(config_path, 'w') as f:
+            f.write('[bugfinder-config]\nprocessed_images_path = {0}\n'.format(self.path['images']))
+        for constant, name in [('PATTERNS_DIR', 'patterns'), ('SETTINGS_DIR', 'settings'), ('PROCESSED_IMAGES_PATH', 'archive'), ('FAILED_IMAGES_PATH', 'failed')]:
+            patcher = mock.patch('services.storage_service.' + constant, self.path[name])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('services.storage_service.IngestionService', lambda: IngestionService(config_path, watch=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def board(self):
+        ''' Pattern and frame of 2x2 panels with a defect in the first one '''
+        rng = np.random.RandomState(0)
+        pcb = np.full((150, 200), 30, np.uint8)
+        for _ in range(80):
+            x, y = rng.randint(0, 200), rng.randint(0, 150)
+            cv2.rectangle(pcb, (x, y), (x + rng.randint(5, 30), y + rng.randint(5, 30)), int(rng.randint(120, 256)), -1)
+        pcb[40:100, 60:120] = 30
+        frame = np.full((350, 460), 10, np.uint8)
+        for y, x in [(20, 20), (20, 240), (180, 20), (180, 240)]:
+            frame[y:y + 150, x:x + 200] = pcb
+        frame[65:95, 85:115] = 255
+        return pcb, cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+    def test_batch(self):
+        image_service = ImageService()
+        storage_service = StorageService()
+        pcb, frame = self.board()
+        keypoints, descriptors = image_service.extract_key_points_and_descriptors(pcb, KEYPOINT_TILES)
+        storage_service.save_pattern(Pattern('board', image_service.otsu_binarization(pcb), keypoints, descriptors, keypoint_tiles=KEYPOINT_TILES))
+        storage_service.save_settings(Settings('board', [BgrToGray(True), OtsuBinarization(True), Grid(True, 20, 20, 20, 10, 200, 150, 2, 2)]))
+        filenames = ['img{0}.png'.format(i) for i in range(4)]
+        for filename in filenames:
+            cv2.imwrite(os.path.join(self.path['images'], filename), frame)
+        with open(os.path.join(self.path['images'], 'broken.png'), 'w') as f:
+            f.write('not an image')
+        old = time.time() - 3600
+        for filename in os.listdir(self.path['images']): # waiting since before the batch started
+            os.utime(os.path.join(self.path['images'], filename), (old, old))
+
+        output, store = os.path.join(self.path['results'], 'output'), os.path.join(self.path['results'], 'store')
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(bugfinder_batch.main(['board', 'board', '--output', output, '--store', store, '--workers', '1']), 0)
+
+        with open(os.path.join(output, SUMMARY_FILENAME)) as f:
+            records = [json.loads(line) for line in f]
+        self.assertListEqual([r['filename'] for r in records], filenames)
+        self.assertTrue(all(len(r['defects']) == 1 for r in records))
+        self.assertListEqual(sorted(os.listdir(self.path['archive'])), filenames)
+        self.assertListEqual(os.listdir(self.path['failed']), ['broken.png'])
+        self.assertListEqual(os.listdir(self.path['images']), [])
+        self.assertEqual(ResultsService(store).count('images'), 4)
@@ -1,5 +1,14 @@
 import unittest
+import os
+import sys
+import subprocess
 from image_processors.grid import Grid
+from image_processors.gaussian_blur import GaussianBlur
+from image_processors.morphology import MorphologyOpening
+from image_processors.otsu import OtsuBinarization
+from image_processors.abc.image_process import ImageProcess
+from image_processors import avaliable_image_processes, PROCESS_MODULES
+from models.settings import Settings
 import numpy as np
 import cv2
 
@@ -63,6 +72,36 @@ class ImageProcessTest(unittest.TestCase):
         ]
         self.assertListEqual(grid.lines(1000, 1000), lines)
 
+    def test_scaled(self):
+        blur = GaussianBlur(True, (25, 25))
+        opening = MorphologyOpening(True, (10, 10))
+        otsu = OtsuBinarization(True)
+        grid = Grid(True, 10, 20, 30, 40, 400, 300, 2, 3)
+        settings = Settings('settings', [blur, opening, otsu, grid])
+        scaled = settings.scaled(0.25)
+        scaled_blur, scaled_opening, scaled_otsu = scaled.transformations
+        self.assertEqual(scaled_blur.kernel, (7, 7))
+        self.assertEqual(scaled_opening.kernel, (2, 2))
+        self.assertIs(scaled_otsu, otsu)
+        self.assertEqual(scaled.selected_split().serialize(), Grid(True, 2, 5, 8, 10, 100, 75, 2, 3).serialize())
+        self.assertEqual(blur.kernel, (25, 25))
+        self.assertEqual(grid.pcb_width, 400)
+        self.assertIs(settings.scaled(1), settings)
 
+    def test_from_json(self):
+        self.assertSetEqual(set(c.__name__ for c in avaliable_image_processes), set(PROCESS_MODULES))
+        self.assertSetEqual(set(ImageProcess.registry.values()), set(avaliable_image_processes))
+        for cls in avaliable_image_processes:
+            process = cls(True) if cls is not Grid else Grid(True, 10, 20, 30, 40, 400, 300, 2, 3)
+            self.assertEqual(ImageProcess.from_json(process.serialize()).serialize(), process.serialize())
+        self.assertIsNone(ImageProcess.from_json({'name': 'Unknown', 'selected': True}))
 
-
+    def test_headless_import(self):
+        code = (
+            "import sys, bugfinder_batch, models.pattern, models.settings; "
+            "from image_processors import avaliable_image_processes; "
+            "print(','.join(m for m in ('PyQt5', 'matplotlib', 'views.widgets') if m in sys.modules))"
+        )
+        src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=src)
+        self.assertEqual(output.strip(), b'')
@@ -1,5 +1,19 @@
 import unittest
 from services.image_service import ImageService
+from models.pattern import Pattern
+from models.pattern_index import PatternIndex
+from models.settings import Settings
+from image_processors.grid import Grid
+from image_processors.bgr_to_gray import BgrToGray
+from image_processors.otsu import OtsuBinarization
+from image_processors.morphology import MorphologyOpening
+from image_processors.liner_scaling import LinearScaling
+from profiler import Profiler
+from stage_cache import StageCache
+from services.service_context import ServiceContext
+from concurrent.futures import ThreadPoolExecutor
+from errors import RegistrationError
+from settings import *
 import numpy as np
 import cv2
 
@@ -65,19 +79,318 @@ class ImageServiceTest(unittest.TestCase):
 
         np.testing.assert_equal(img, result)
 
+    def test_clip_and_rotate_coarse(self):
+        board = np.zeros((300, 500, 3), np.uint8)
+        board[:] = (40, 120, 40)
+        board[50:250:20, 20:480] = (170, 190, 200)
+        scene = cv2.copyMakeBorder(board, 100, 100, 100, 100, cv2.BORDER_CONSTANT, value=(30, 30, 200))
+        M = cv2.getRotationMatrix2D((350, 250), 5, 1.0)
+        scene = cv2.warpAffine(scene, M, (700, 500), borderValue=(30, 30, 200))
+
+        expected = self.image_service.clip_and_rotate(scene)
+        for scale in [0.5, 0.25, 0.1]:
+            clipped = self.image_service.clip_and_rotate(scene, scale=scale)
+            self.assertEqual(clipped.ndim, 3)
+            np.testing.assert_allclose(clipped.shape[:2], expected.shape[:2], atol=1)
+            height, width = np.minimum(clipped.shape[:2], expected.shape[:2])
+            difference = np.abs(clipped[:height, :width].astype(int) - expected[:height, :width])
+            self.assertLess(difference.mean(), 2, scale)
+
     def test_add_affine_transform(self):
         M1 = np.array([[1,0,10], [0,1,5]])
         M2 = np.array([[1,0,5], [0,1,5]])
         M3 = np.array([[1,0,15], [0,1,10]])
         np.testing.assert_equal(self.image_service.add_affine_transform(M1, M2), M3)
 
+    def test_ransac(self):
+        M = np.array([[0.98, -0.1, 12], [0.1, 0.99, -7]])
+        pts1 = np.random.RandomState(1).rand(100, 2).astype(np.float32) * 500
+        pts2 = (pts1.dot(M[:, :2].T) + M[:, 2]).astype(np.float32)
+        pts2[:30] += 50 # outliers
+        np.random.seed(0)
+        model = self.image_service.ransac(pts1, pts2, iters=50, maxerror=2)
+        np.testing.assert_allclose(model, M, atol=1e-3)
+
+        np.random.seed(0)
+        batched_model = self.image_service.ransac(pts1, pts2, iters=50, maxerror=2, batch_size=7)
+        np.testing.assert_equal(batched_model, model)
+
+        model = self.image_service.ransac(pts1, pts2, iters=1000, maxerror=2, confidence=0.999, random_state=np.random.RandomState(0))
+        np.testing.assert_allclose(model, M, atol=1e-3)
+        np.random.rand(17) # global state left by other calls does not matter
+        same_model = self.image_service.ransac(pts1, pts2, iters=1000, maxerror=2, confidence=0.999, random_state=np.random.RandomState(0))
+        np.testing.assert_equal(same_model, model)
+
 
 
 
         
 
+    def test_transform_image_profiler(self):
+        profiler = Profiler()
+        settings = Settings('settings', [BgrToGray(True)])
+        images = self.image_service.transform_image(self.color_rand_image, settings, profiler)
+        profiler.close()
+        self.assertEqual(images[OUT_IMAGE], GRAY_IMAGE)
+        stages = profiler.record()['stages']
+        self.assertListEqual([(r['name'], r['depth']) for r in stages], [('BgrToGray', 1), ('transform_image', 0)])
+        self.assertGreaterEqual(stages[1]['peak'], stages[0]['peak'])
+        self.assertGreater(stages[0]['peak'], 0)
+
+    def test_transform_image_cache(self):
+        cache = StageCache()
+        opening = MorphologyOpening(True, (3, 3))
+        settings = Settings('settings', [BgrToGray(True), OtsuBinarization(True), opening])
+        images = self.image_service.transform_image(self.color_rand_image, settings, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+        opening.kernel = (5, 5)
+        images = self.image_service.transform_image(self.color_rand_image, settings, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        expected = self.image_service.transform_image(self.color_rand_image, settings)
+        np.testing.assert_equal(images[BIN_IMAGE], expected[BIN_IMAGE])
+
+        self.image_service.transform_image(self.color_rand_image.copy(), settings, cache=cache)
+        self.assertEqual(len(cache), 7) # outputs of first source stay
+
+        cache.max_bytes = 2 * self.gray_rand_image.nbytes
+        cache.put(('other',), {GRAY_IMAGE: self.gray_rand_image}, {})
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        self.assertIsNone(cache.get(cache.stage_key((), BgrToGray(True))))
+
+    def test_transform_image_cache_sources(self):
+        cache = StageCache()
+        settings = Settings('settings', [BgrToGray(True), OtsuBinarization(True)])
+        proxy = self.color_rand_image[::2, ::2].copy()
+        for image in [self.color_rand_image, proxy]:
+            self.image_service.transform_image(image, settings, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+        for i in range(3): # switching between proxy and full resolution
+            for image in [self.color_rand_image, proxy]:
+                images = self.image_service.transform_image(image, settings, cache=cache)
+                np.testing.assert_equal(images[BIN_IMAGE], self.image_service.transform_image(image, settings)[BIN_IMAGE])
+        self.assertEqual((cache.hits, cache.misses), (12, 4))
+
+    def test_transform_image_linear_scaling(self):
+        profiler = Profiler(trace_memory=False)
+        settings = Settings('settings', [LinearScaling(True, 1.3, 20), BgrToGray(True)])
+        images = self.image_service.transform_image(self.color_rand_image, settings, profiler)
+        expected = self.image_service.linear_scaling(self.color_rand_image, 1.3, 20)
+        np.testing.assert_equal(images[COLOR_IMAGE], expected)
+        np.testing.assert_equal(images[GRAY_IMAGE], self.image_service.bgr_to_gray(expected))
+        names = [r['name'] for r in profiler.record()['stages']]
+        self.assertListEqual(names, ['LinearScaling', 'BgrToGray', 'transform_image'])
+
+    def test_mark_errors_roi(self):
+        color_image = np.random.randint(256, size=(400, 500, 3)).astype(np.uint8)
+        mask = np.zeros((400, 500), np.uint8)
+        images = {CLIPPED_IMAGE: color_image, BIN_IMAGE: mask}
+        self.assertIs(self.image_service.mark_errors(dict(images), (0, 0, 255), roi=True)[COLOR_IMAGE], color_image)
+
+        mask[0:5, 0:5] = 255 # touches frame border
+        mask[200:210, 300:330] = 255
+        mask[280:283, 390:392] = 255 # windows overlap previous defect
+        expected = self.image_service.mark_errors(dict(images), (0, 0, 255), roi=False)
+        result = self.image_service.mark_errors(dict(images), (0, 0, 255), roi=True)
+        self.assertEqual(result[OUT_IMAGE], COLOR_IMAGE)
+        np.testing.assert_equal(result[COLOR_IMAGE], expected[COLOR_IMAGE])
+
+    def test_tiled_key_points(self):
+        image = np.full((200, 300), 30, np.uint8)
+        image[20:180, 20:140] = np.random.RandomState(0).randint(256, size=(160, 120)) # texture only on the left
+        image[50:150, 200:280] = 200
+        keypoints, descriptors = self.image_service.extract_key_points_and_descriptors_tiled(image, (2, 2), features=100, workers=1)
+        self.assertEqual(len(keypoints), len(descriptors))
+        points = np.float32([kp.pt for kp in keypoints])
+        self.assertTrue(np.any(points[:, 0] > 150)) # right tiles get their own budget
+        self.assertLessEqual(np.sum((points[:, 0] < 150) & (points[:, 1] < 100)), 25)
+
+        threaded = self.image_service.extract_key_points_and_descriptors_tiled(image, (2, 2), features=100, workers=3)
+        self.image_service.close()
+        np.testing.assert_equal(np.float32([kp.pt for kp in threaded[0]]), points)
+        np.testing.assert_equal(threaded[1], descriptors)
+
+    def test_thread_detectors(self):
+        detector = self.image_service.detector
+        self.assertIs(self.image_service.detector, detector)
+        with ThreadPoolExecutor(1) as pool:
+            other = pool.submit(lambda: self.image_service.detector).result()
+        self.assertIsNot(other, detector)
+
+        settings = Settings()
+        self.assertEqual(len(set(id(p.image_service) for p in settings.image_processes())), 1)
+        grid = settings.splits[0]
+        grid.context = ServiceContext(self.image_service)
+        self.assertIs(grid.image_service, self.image_service)
+
+    def test_extract_defects(self):
+        mask = np.zeros((100, 200), np.uint8)
+        mask[10:20, 30:35] = 255
+        mask[60:90, 150:190] = 255
+        mask[95:100, 95:105] = 255 # centroid outside all panels
+        defects = self.image_service.extract_defects(mask, [(0, 50, 0, 100), (0, 100, 100, 200)])
+        self.assertListEqual(defects[['x', 'y', 'width', 'height', 'area', 'panel']].tolist(),
+                             [(30, 10, 5, 10, 50, 0), (150, 60, 40, 30, 1200, 1), (95, 95, 10, 5, 50, -1)])
+        np.testing.assert_allclose(defects[['cx', 'cy']][1].tolist(), (169.5, 74.5))
+        self.assertEqual(len(self.image_service.extract_defects(np.zeros((10, 10), np.uint8))), 0)
+
+    def test_match_pattern(self):
+        descriptors = np.random.randint(256, size=(200, 32)).astype(np.uint8)
+        pattern = Pattern('pattern', None, [], descriptors)
+        index = pattern.matcher_index()
+        self.assertIs(pattern.matcher_index(), index)
+
+        pattern_indexes, indexes = self.image_service.match_pattern(pattern, descriptors[50:100])
+        self.assertTrue(len(indexes))
+        np.testing.assert_equal(pattern_indexes, indexes + 50)
+
+        pattern.descriptors = descriptors[:10]
+        self.assertIsNot(pattern.matcher_index(), index)
+
+    def test_recognize_pattern(self):
+        def board(seed):
+            rng = np.random.RandomState(seed)
+            image = np.full((240, 320), 30, np.uint8)
+            for _ in range(60):
+                x, y = rng.randint(0, 320), rng.randint(0, 240)
+                cv2.rectangle(image, (x, y), (x + rng.randint(5, 30), y + rng.randint(5, 30)), int(rng.randint(100, 256)), -1)
+            return image
+
+        boards = [board(seed) for seed in range(4)]
+        index = PatternIndex()
+        for name, image in zip('abcd', boards):
+            keypoints, descriptors = self.image_service.extract_key_points_and_descriptors(image)
+            index.add(Pattern(name, None, keypoints, descriptors))
+        segments = index.segments()
+        self.assertLessEqual(len(segments), 3)
+        self.assertListEqual(segments, sorted(set(segments), reverse=True))
+
+        image = cv2.warpAffine(boards[2], cv2.getRotationMatrix2D((160, 120), 4, 1.0), (320, 240), borderValue=30)
+        self.assertEqual(self.image_service.recognize_pattern(index, image), 'c')
+        self.assertIsNone(self.image_service.recognize_pattern(index, np.full((240, 320), 30, np.uint8)))
+
+        replaced = board(4)
+        keypoints, descriptors = self.image_service.extract_key_points_and_descriptors(replaced)
+        index.add(Pattern('c', None, keypoints, descriptors)) # saved again with other image
+        self.assertEqual(len(index), 4)
+        self.assertEqual(self.image_service.recognize_pattern(index, replaced), 'c')
+        self.assertIsNone(self.image_service.recognize_pattern(index, image))
+
+    def _compare_fixture(self):
+        rng = np.random.RandomState(0)
+        pcb = np.full((150, 200), 30, np.uint8)
+        for _ in range(80):
+            x, y = rng.randint(0, 200), rng.randint(0, 150)
+            cv2.rectangle(pcb, (x, y), (x + rng.randint(5, 30), y + rng.randint(5, 30)), int(rng.randint(120, 256)), -1)
+        frame = np.full((350, 460), 10, np.uint8)
+        frame[20:170, 20:220] = pcb
+        frame[20:170, 240:440] = pcb
+        frame[180:330, 20:220] = pcb
+        frame[180:330, 240:440] = pcb
+        frame[60:90, 80:110] = 255 - frame[60:90, 80:110] # defect
+
+        keypoints, descriptors = self.image_service.extract_key_points_and_descriptors(pcb, KEYPOINT_TILES)
+        pattern = Pattern('pattern', self.image_service.otsu_binarization(pcb), keypoints, descriptors, keypoint_tiles=KEYPOINT_TILES)
+        settings = Settings('settings', [Grid(True, 20, 20, 20, 10, 200, 150, 2, 2)])
+        images = {
+            COLOR_IMAGE: cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR),
+            GRAY_IMAGE: frame,
+            BIN_IMAGE: self.image_service.otsu_binarization(frame),
+            OUT_IMAGE: BIN_IMAGE
+        }
+        return pattern, settings, images
+
+    def test_process_executor_pattern(self):
+        pattern = Pattern('pcb', np.zeros((10, 10), np.uint8), [], np.zeros((0, 32), np.uint8))
+        pool = self.image_service._compare_executor(pattern, 2, 'process')
+        self.assertIs(self.image_service._compare_executor(pattern, 2, 'process'), pool)
+        other = Pattern('pcb', np.zeros((10, 10), np.uint8), [], np.zeros((0, 32), np.uint8))
+        self.assertIsNot(self.image_service._compare_executor(other, 2, 'process'), pool) # same name, another pattern
+        self.image_service.close()
+
+    def test_parallel_compare(self):
+        pattern, settings, images = self._compare_fixture()
+        np.random.seed(0)
+        serial_images = self.image_service.compare(pattern, dict(images), settings, guided=False)
+        serial = serial_images[BIN_IMAGE]
+        np.random.seed(0)
+        parallel = self.image_service.compare(pattern, dict(images), settings, workers=3, guided=False)[BIN_IMAGE]
+        self.image_service.close()
+        np.testing.assert_equal(parallel, serial)
+        self.assertTrue(serial[75, 95])
+        defects = self.image_service.extract_defects(serial, serial_images[PANEL_BOXES])
+        self.assertListEqual(defects['panel'].tolist(), [0])
+
+    def test_compare_pattern_keypoint_tiles(self):
+        pattern, settings, images = self._compare_fixture()
+        detect = self.image_service.extract_key_points_and_descriptors
+        tiles = []
+        def record(image, tiles_=(1, 1)):
+            tiles.append(tuple(tiles_))
+            return detect(image, tiles_)
+        self.image_service.extract_key_points_and_descriptors = record
+        self.image_service.compare(pattern, dict(images), settings, guided=False)
+        untiled = Pattern(pattern.name, pattern.image, pattern.keypoints, pattern.descriptors) # saved before tiling
+        self.image_service.compare(untiled, dict(images), settings, guided=False)
+        self.assertListEqual(tiles, [KEYPOINT_TILES] * 4 + [(1, 1)] * 4)
+
+    def test_compare_not_registered(self):
+        pattern, settings, images = self._compare_fixture()
+        np.random.seed(0)
+        self.image_service.compare(pattern, dict(images), settings, guided=True) # priors of every panel
+        blank = dict((key, np.zeros_like(image)) for key, image in images.items() if key != OUT_IMAGE)
+        blank[OUT_IMAGE] = BIN_IMAGE
+        with self.assertRaises(RegistrationError): # guided and then whole pattern matching find nothing
+            self.image_service.compare(pattern, blank, settings, guided=True)
+        self.assertIsNone(self.image_service._prior(pattern, 0))
 
+        rng = np.random.RandomState(1)
+        noise = cv2.GaussianBlur(rng.randint(256, size=(150, 200)).astype(np.uint8), (3, 3), 0)
+        keypoints, descriptors = self.image_service.extract_key_points_and_descriptors(noise)
+        unrelated = Pattern('unrelated', self.image_service.otsu_binarization(noise), keypoints, descriptors)
+        with self.assertRaises(RegistrationError):
+            self.image_service.compare(unrelated, dict(images), settings, guided=False)
+        self.image_service._set_prior(unrelated, 0, (np.float64([[1, 0, 0], [0, 1, 0]]), 100))
+        profiler = Profiler(trace_memory=False)
+        with self.assertRaises(RegistrationError): # no correspondences near prior nor anywhere else
+            self.image_service.compare(unrelated, dict(images), settings, profiler=profiler, guided=True)
+        self.assertIn('match_guided', set(r['name'] for r in profiler.record()['stages']))
 
+    def test_compare_order_independent(self):
+        pattern, settings, images = self._compare_fixture()
+        shifted = dict((key, np.roll(image, 3, axis=1)) for key, image in images.items() if key != OUT_IMAGE)
+        shifted[OUT_IMAGE] = BIN_IMAGE
+        frames = {'a': images, 'b': shifted}
+        def compare_all(order):
+            image_service = ImageService()
+            masks = {}
+            for name in order:
+                np.random.seed(0)
+                masks[name] = image_service.compare(pattern, dict(frames[name]), settings)[BIN_IMAGE]
+            return masks
+        forward, backward = compare_all('ab'), compare_all('ba')
+        np.testing.assert_equal(forward['a'], backward['a'])
+        np.testing.assert_equal(forward['b'], backward['b'])
 
+    def test_guided_compare(self):
+        pattern, settings, images = self._compare_fixture()
+        np.random.seed(0)
+        self.image_service.compare(pattern, dict(images), settings, guided=False)
+        profiler = Profiler(trace_memory=False)
+        guided = self.image_service.compare(pattern, dict(images), settings, profiler=profiler, guided=True)[BIN_IMAGE]
+        names = set(r['name'] for r in profiler.record()['stages'])
+        self.assertIn('match_guided', names)
+        self.assertNotIn('match', names)
+        ys, xs = np.nonzero(guided)
+        self.assertTrue(guided[75, 95])
+        self.assertTrue(58 <= ys.min() and ys.max() < 92 and 78 <= xs.min() and xs.max() < 112) # only the defect
 
+        self.image_service.reset_priors()
+        profiler = Profiler(trace_memory=False)
+        self.image_service.compare(pattern, dict(images), settings, profiler=profiler, guided=True)
+        self.assertIn('match', set(r['name'] for r in profiler.record()['stages']))
 
+        replaced = Pattern(pattern.name, pattern.image, pattern.keypoints, pattern.descriptors, keypoint_tiles=KEYPOINT_TILES) # saved again
+        profiler = Profiler(trace_memory=False)
+        self.image_service.compare(replaced, dict(images), settings, profiler=profiler, guided=True)
+        self.assertNotIn('match_guided', set(r['name'] for r in profiler.record()['stages']))
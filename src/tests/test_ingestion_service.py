@@ -0,0 +1,110 @@
+import os
+import time
+import unittest
+import shutil
+import tempfile
+from services.ingestion_service import IngestionService
+
+
+class IngestionServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.directory, 'config.txt')
+        self.images = self.set_images_directory('images')
+        self.ingestion_service = IngestionService(self.config_path, poll_interval=0, watch=False, settle_time=0)
+
+    def tearDown(self):
+        self.ingestion_service.close()
+        shutil.rmtree(self.directory)
+
+    def set_images_directory(self, name):
+        images = os.path.join(self.directory, name)
+        os.makedirs(images, exist_ok=True)
+        with open(self.config_path, 'w') as f:
+            f.write('[bugfinder-config]\nprocessed_images_path = {0}\n'.format(images))
+        return images
+
+    def add_images(self, *filenames, directory=None):
+        for filename in filenames:
+            open(os.path.join(directory or self.images, filename), 'w').close()
+
+    def test_order(self):
+        self.add_images('b', 'c', 'a')
+        self.assertEqual(self.ingestion_service.next_filename(), 'a')
+        self.add_images('0', 'bb', 'd')
+        self.assertListEqual(self.ingestion_service.pending(), ['0', 'b', 'bb', 'c', 'd'])
+        self.assertListEqual([self.ingestion_service.next_filename() for i in range(6)], ['0', 'b', 'bb', 'c', 'd', None])
+
+    def test_taken_and_released(self):
+        self.add_images('a', 'b')
+        self.assertEqual(self.ingestion_service.next_filename(), 'a')
+        self.assertEqual(self.ingestion_service.next_filename(), 'b') # a is still in directory but taken
+        self.ingestion_service.release('a')
+        self.assertEqual(self.ingestion_service.next_filename(), 'a')
+        os.remove(os.path.join(self.images, 'a'))
+        self.ingestion_service.done('a')
+        self.assertIsNone(self.ingestion_service.next_filename())
+
+    def test_removed_by_others(self):
+        self.add_images('a', 'b', 'c')
+        self.assertEqual(len(self.ingestion_service.pending()), 3)
+        os.remove(os.path.join(self.images, 'b'))
+        self.assertListEqual(self.ingestion_service.pending(), ['a', 'c'])
+
+    def test_config_reload(self):
+        self.add_images('a')
+        self.assertEqual(self.ingestion_service.directory(), self.images)
+        other = self.set_images_directory('other')
+        os.utime(self.config_path, (0, 0)) # mtime surely differs
+        self.add_images('x', directory=other)
+        self.assertEqual(self.ingestion_service.directory(), other)
+        self.assertListEqual(self.ingestion_service.pending(), ['x'])
+
+    def test_missing_directory(self):
+        shutil.rmtree(self.images)
+        self.assertIsNone(self.ingestion_service.next_filename())
+
+    def test_partially_written(self):
+        self.ingestion_service.settle_time = 0.2
+        path = os.path.join(self.images, 'a')
+        with open(path, 'wb') as f:
+            f.write(b'head')
+            f.flush()
+            self.assertIsNone(self.ingestion_service.next_filename())
+            time.sleep(0.25)
+            f.write(b'tail') # still written, waits again
+            f.flush()
+            self.assertIsNone(self.ingestion_service.next_filename())
+        self.assertListEqual(self.ingestion_service.pending(), [])
+        time.sleep(0.25)
+        self.assertEqual(self.ingestion_service.next_filename(), 'a')
+
+    def test_complete_notification(self):
+        self.ingestion_service.settle_time = 60
+        self.add_images('a', 'b')
+        self.assertIsNone(self.ingestion_service.next_filename())
+        self.ingestion_service._notified(added=os.path.join(self.images, 'b'), complete=True) # closed or moved in
+        self.assertEqual(self.ingestion_service.next_filename(), 'b')
+        self.assertIsNone(self.ingestion_service.next_filename())
+
+    def test_old_files_offered_at_once(self):
+        self.ingestion_service.settle_time = 60
+        self.add_images('b', 'a')
+        old = time.time() - 3600
+        for filename in ['a', 'b']:
+            os.utime(os.path.join(self.images, filename), (old, old)) # waiting before service started
+        self.add_images('c') # just written
+        self.assertEqual(self.ingestion_service.next_filename(), 'a')
+        self.assertListEqual(self.ingestion_service.pending(), ['b'])
+        self.assertListEqual(self.ingestion_service.settling(), ['c'])
+
+    def test_wait_for_settling(self):
+        self.ingestion_service.settle_time = 0.2
+        self.assertIsNone(self.ingestion_service.next_filename(wait=True)) # nothing to wait for
+        self.add_images('a')
+        started = time.time()
+        self.assertIsNone(self.ingestion_service.next_filename())
+        self.assertEqual(self.ingestion_service.next_filename(wait=True), 'a')
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        self.assertListEqual(self.ingestion_service.settling(), [])
@@ -0,0 +1,104 @@
+import sys
+import time
+import unittest
+from PyQt5.QtCore import QCoreApplication
+from controllers.inspection_worker import InspectionWorker
+from settings import *
+
+
+class FakeStorageService(object):
+    def __init__(self, filenames):
+        self.ingestion_service = list(filenames) # waiting files, worker only takes its len
+        self.given = []
+        self.released = []
+        self.archived = []
+        self.failed = []
+
+    def next_image_filename(self):
+        if not self.ingestion_service:
+            return None
+        self.given.append(self.ingestion_service.pop(0))
+        return self.given[-1]
+
+    def release_image(self, filename):
+        self.released.append(filename)
+
+    def read_image(self, filename, scale=1.0):
+        return None if filename == 'broken' else filename
+
+    def archive_image(self, filename):
+        self.archived.append(filename)
+
+    def fail_image(self, filename):
+        self.failed.append(filename)
+
+
+class FakeImageService(object):
+    def __init__(self, seconds=0):
+        self.seconds = seconds
+
+    def transform_image(self, image, settings, profiler):
+        return {OUT_IMAGE: COLOR_IMAGE, COLOR_IMAGE: image, BIN_IMAGE: None}
+
+    def compare(self, pattern, images, settings, workers, executor, profiler, scale=1.0):
+        time.sleep(self.seconds)
+        return images
+
+    def extract_defects(self, mask, panels, profiler):
+        return []
+
+    def mark_errors(self, images, color, profiler, scale=1.0):
+        return images
+
+
+class InspectionWorkerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+
+    def start_worker(self, filenames, seconds=0, ready_results=2):
+        self.storage_service = FakeStorageService(filenames)
+        self.worker = InspectionWorker(self.storage_service, FakeImageService(seconds), None, None, None, ready_results=ready_results, generation=7)
+        self.results, self.errors = [], []
+        self.worker.result.connect(self.results.append)
+        self.worker.error.connect(self.errors.append)
+        self.addCleanup(self.worker.wait)
+        self.addCleanup(self.worker.stop)
+        self.worker.start()
+
+    def process_events(self, until, timeout=5):
+        deadline = time.time() + timeout
+        while not until() and time.time() < deadline:
+            self.app.processEvents()
+            time.sleep(0.01)
+
+    def test_bounded_prefetch(self):
+        self.start_worker(['img{0}'.format(i) for i in range(20)])
+        self.process_events(lambda: len(self.results) == 2)
+        self.process_events(lambda: False, timeout=0.3)
+        self.assertListEqual(self.storage_service.given, ['img0', 'img1'])
+        self.worker.taken()
+        self.process_events(lambda: len(self.results) == 3)
+        self.assertListEqual([r.filename for r in self.results], ['img0', 'img1', 'img2'])
+        self.assertEqual(len(self.storage_service.given), 3)
+        self.assertTrue(all(r.generation == 7 for r in self.results))
+        self.assertListEqual(self.storage_service.archived, []) # archived by receiver when shown
+
+    def test_failed_image(self):
+        self.start_worker(['broken', 'img0', 'img1'], ready_results=1)
+        self.process_events(lambda: len(self.results) == 1)
+        self.assertEqual(len(self.errors), 1)
+        self.assertListEqual(self.storage_service.failed, ['broken'])
+        self.assertEqual(self.results[0].filename, 'img0')
+
+    def test_stop(self):
+        self.start_worker(['img{0}'.format(i) for i in range(20)], seconds=0.5)
+        time.sleep(0.2)
+        started = time.time()
+        self.worker.stop()
+        self.assertLess(time.time() - started, 0.1) # does not wait for compare
+        self.assertTrue(self.worker.wait(5000))
+        self.process_events(lambda: False, timeout=0.1)
+        self.assertListEqual(self.results, []) # finished while stopping, not emitted
+        self.assertListEqual(sorted(self.storage_service.released), sorted(self.storage_service.given))
@@ -0,0 +1,163 @@
+import unittest
+import time
+import threading
+import numpy as np
+import cv2
+from services.pipeline_service import PipelineService
+from services.image_service import ImageService
+from models.pattern import Pattern
+from models.settings import Settings
+from models.defects import DEFECT_DTYPE
+from image_processors.grid import Grid
+from image_processors.bgr_to_gray import BgrToGray
+from image_processors.otsu import OtsuBinarization
+from errors import RecognitionError
+from settings import *
+
+
+class FakeStorageService(object):
+    def __init__(self):
+        self.archived = []
+        self.failed = []
+        self.scales = []
+
+    def read_image(self, filename, scale=1.0):
+        self.scales.append(scale)
+        return None if filename == 'broken' else filename
+
+    def archive_image(self, filename):
+        self.archived.append(filename)
+
+    def fail_image(self, filename):
+        self.failed.append(filename)
+
+
+class ResizingStorageService(FakeStorageService):
+    ''' Every filename is the same frame '''
+    def __init__(self, frame):
+        super().__init__()
+        self.frame = frame
+
+    def read_image(self, filename, scale=1.0):
+        if scale == 1:
+            return self.frame
+        return cv2.resize(self.frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+class FakeImageService(object):
+    def __init__(self):
+        self.compared = []
+
+    def transform_image(self, image, settings, profiler):
+        return {OUT_IMAGE: COLOR_IMAGE, COLOR_IMAGE: image, BIN_IMAGE: None}
+
+    def compare(self, pattern, images, settings, workers, executor, profiler, scale=1.0):
+        time.sleep(0.01 if images[COLOR_IMAGE] == 'img0' else 0)
+        self.compared.append(images[COLOR_IMAGE])
+        self.pattern, self.scale = pattern, scale
+        return images
+
+    def extract_defects(self, mask, panels, profiler):
+        return []
+
+    def mark_errors(self, images, color, profiler, scale=1.0):
+        return images
+
+
+class PipelineServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_service = FakeStorageService()
+        self.image_service = FakeImageService()
+        self.pipeline = PipelineService(self.storage_service, self.image_service, None, None, None, queue_depths=1)
+
+    def test_ordered_output(self):
+        filenames = ['img{0}'.format(i) for i in range(10)]
+        results = list(self.pipeline.run(filenames))
+        self.assertListEqual([r.filename for r in results], filenames)
+        self.assertListEqual([r.images[COLOR_IMAGE] for r in results], filenames)
+        self.assertListEqual(self.storage_service.archived, filenames)
+
+    def test_failed_image(self):
+        results = list(self.pipeline.run(['img0', 'broken', 'img1']))
+        self.assertIsNotNone(results[1].error)
+        self.assertListEqual(self.image_service.compared, ['img0', 'img1'])
+        self.assertListEqual(self.storage_service.archived, ['img0', 'img1'])
+        self.assertListEqual(self.storage_service.failed, ['broken'])
+
+    def test_stop(self):
+        threads = threading.active_count()
+        for result in self.pipeline.run('img{0}'.format(i) for i in range(100)):
+            break
+        self.assertEqual(threading.active_count(), threads)
+        self.assertLess(len(self.image_service.compared), 10)
+
+    def test_failing_filenames(self):
+        def filenames():
+            yield 'img0'
+            raise IOError("directory is gone")
+        threads = threading.active_count()
+        results = []
+        with self.assertRaises(IOError):
+            for result in self.pipeline.run(filenames()):
+                results.append(result)
+        self.assertListEqual([r.filename for r in results], ['img0'])
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_recognized_pattern(self):
+        patterns = {'img0': 'pattern0', 'img1': None}
+        pipeline = PipelineService(self.storage_service, self.image_service, lambda images: patterns[images[COLOR_IMAGE]], None, None)
+        results = list(pipeline.run(['img0', 'img1']))
+        self.assertEqual(results[0].pattern, 'pattern0')
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, RecognitionError)
+        self.assertListEqual(self.image_service.compared, ['img0'])
+
+    def test_working_scale(self):
+        defects = np.zeros(1, DEFECT_DTYPE)
+        defects[0] = (10, 20, 5, 4, 12, 12.0, 21.5, 0)
+        self.image_service.extract_defects = lambda mask, panels, profiler: defects
+        settings = Settings('settings', [Grid(True, 10, 10, 4, 4, 200, 100, 1, 2)], working_scale=0.5)
+        pattern = Pattern('pattern', np.zeros((100, 200), np.uint8), [], np.zeros((0, 32), np.uint8))
+        pipeline = PipelineService(self.storage_service, self.image_service, pattern, settings, None)
+        self.assertEqual(pipeline.working_settings.selected_split().pcb_width, 100)
+        result = list(pipeline.run(['img0']))[0]
+        self.assertListEqual(self.storage_service.scales, [0.5])
+        self.assertIs(result.pattern, pattern)
+        self.assertTupleEqual(self.image_service.pattern.image.shape, (50, 100))
+        self.assertEqual(self.image_service.scale, 0.5)
+        self.assertListEqual([int(result.defects[0][name]) for name in ['x', 'y', 'width', 'height', 'area']], [20, 40, 10, 8, 48])
+        self.assertAlmostEqual(float(result.defects[0]['cx']), 24.5)
+        self.assertAlmostEqual(float(result.defects[0]['cy']), 43.5)
+
+    def test_working_scale_defects(self):
+        rng = np.random.RandomState(0)
+        pcb = np.full((300, 400), 30, np.uint8)
+        for _ in range(160):
+            x, y = rng.randint(0, 400), rng.randint(0, 300)
+            cv2.rectangle(pcb, (x, y), (x + rng.randint(10, 60), y + rng.randint(10, 60)), int(rng.randint(120, 256)), -1)
+        empty = [(40, 60), (200, 240), (120, 160)]
+        for y, x in empty:
+            pcb[y:y + 80, x:x + 80] = 30
+        frame = np.full((700, 920), 10, np.uint8)
+        panels = [(40, 40), (40, 480), (360, 40), (360, 480)]
+        for y, x in panels:
+            frame[y:y + 300, x:x + 400] = pcb
+        for (py, px), (y, x) in zip(panels, empty): # defects in three panels
+            frame[py + y + 25:py + y + 55, px + x + 25:px + x + 55] = 255
+        image_service = ImageService()
+        keypoints, descriptors = image_service.extract_key_points_and_descriptors(pcb, KEYPOINT_TILES)
+        pattern = Pattern('pattern', image_service.otsu_binarization(pcb), keypoints, descriptors, keypoint_tiles=KEYPOINT_TILES)
+        storage_service = ResizingStorageService(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+        for scale in [1.0, 0.75, 0.5]:
+            settings = Settings('settings', [BgrToGray(True), OtsuBinarization(True), Grid(True, 40, 40, 40, 20, 400, 300, 2, 2)], working_scale=scale)
+            np.random.seed(0)
+            result = list(PipelineService(storage_service, image_service, pattern, settings, (0, 0, 255)).run(['img0']))[0]
+            self.assertIsNone(result.error)
+            self.assertEqual(len(result.defects), 3, scale)
+            self.assertListEqual(sorted(result.defects['panel'].tolist()), [0, 1, 2])
+            for defect in result.defects: # in source pixels
+                py, px = panels[defect['panel']]
+                y, x = empty[defect['panel']]
+                self.assertLess(abs(defect['cx'] - (px + x + 39.5)), 3)
+                self.assertLess(abs(defect['cy'] - (py + y + 39.5)), 3)
@@ -0,0 +1,44 @@
+import unittest
+import threading
+import tracemalloc
+from profiler import Profiler
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_close_stops_tracing(self):
+        first, second = Profiler(), Profiler()
+        self.assertTrue(tracemalloc.is_tracing())
+        first.close()
+        self.assertTrue(tracemalloc.is_tracing()) # second still traces
+        second.close()
+        second.close()
+        self.assertFalse(tracemalloc.is_tracing())
+        with first.stage('after close'):
+            pass
+        self.assertEqual(first.record()['stages'][0]['peak'], 0)
+
+    def test_parallel_peaks(self):
+        ''' Stage entered in another thread must not reset peak of running stage '''
+        profiler = Profiler()
+        allocated, entered = threading.Event(), threading.Event()
+        def other():
+            allocated.wait()
+            with profiler.stage('other'):
+                entered.set()
+        thread = threading.Thread(target=other)
+        thread.start()
+        with profiler.stage('big'):
+            data = bytearray(10 * 1024 * 1024)
+            del data
+            allocated.set()
+            entered.wait()
+        thread.join()
+        profiler.close()
+        stages = dict((r['name'], r) for r in profiler.record()['stages'])
+        self.assertGreaterEqual(stages['big']['peak'], 10 * 1024 * 1024)
+        self.assertLess(stages['other']['peak'], 1024 * 1024)
+        self.assertGreaterEqual(stages['big']['process_cpu'], 0)
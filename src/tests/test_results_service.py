@@ -0,0 +1,60 @@
+import os
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from services.results_service import ResultsService
+from models.defects import DEFECT_DTYPE
+
+
+class ResultsServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def defects(self, areas):
+        defects = np.zeros(len(areas), DEFECT_DTYPE)
+        defects['area'] = areas
+        defects['panel'] = np.arange(len(areas))
+        return defects
+
+    def test_append_and_query(self):
+        with ResultsService(self.directory, chunk_rows=2) as store:
+            self.assertEqual(store.append('a.png', self.defects([10, 200]), 'pcb'), 0)
+            self.assertEqual(store.append('b.png', self.defects([]), 'pcb'), 1)
+            self.assertEqual(store.append('c.png', self.defects([300, 5, 400]), 'pcb'), 2)
+            self.assertEqual(store.count('defects'), 5)
+            self.assertEqual(store.count('images'), 2) # c.png waits for next chunk
+        self.assertEqual(len(list(store.chunks('defects'))), 2)
+        self.assertEqual(len(list(store.chunks('images'))), 2)
+
+        store = ResultsService(self.directory, chunk_rows=2)
+        big = store.query('defects', ['image', 'area'], lambda c: c['area'] > 100)
+        self.assertListEqual(big['image'].tolist(), [0, 2, 2])
+        self.assertListEqual(big['area'].tolist(), [200, 300, 400])
+        images = store.query('images')
+        self.assertListEqual(images['filename'].tolist(), [b'a.png', b'b.png', b'c.png'])
+        self.assertListEqual(images['defects'].tolist(), [2, 0, 3])
+        self.assertEqual(store.count('defects', lambda c: c['panel'] == 0), 2)
+
+        self.assertEqual(store.append('d.png', self.defects([1])), 3)
+        self.assertEqual(store.count('images'), 3) # buffered until flush
+        store.close()
+        self.assertEqual(store.count('images'), 4)
+
+    def test_stale_temporary_chunk(self):
+        with ResultsService(self.directory) as store:
+            store.append('a.png', self.defects([10]))
+        stale = os.path.join(self.directory, 'images', '.00000001') # writer crashed before rename
+        os.makedirs(stale)
+        open(os.path.join(stale, 'image.npy'), 'w').close()
+        store = ResultsService(self.directory)
+        self.assertFalse(os.path.exists(stale))
+        os.makedirs(stale) # left while store is open
+        store.append('b.png', self.defects([20]))
+        store.close()
+        self.assertListEqual(store.query('images')['filename'].tolist(), [b'a.png', b'b.png'])
+        self.assertListEqual(sorted(os.listdir(os.path.join(self.directory, 'images'))), ['00000000', '00000001'])
@@ -1,5 +1,9 @@
 #!/usr/bin/env python3.4
 import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
 from services.storage_service import StorageService
 from models.pattern import Pattern
 from models.settings import Settings
@@ -30,6 +34,39 @@ class StorageServiceTest(unittest.TestCase):
         self.storage_service.save_pattern(self.pattern, overwrite=True) 
         pattern = self.storage_service.load_pattern(self.pattern_name)
         self.assertEqual(self.pattern, pattern)
+        self.assertTupleEqual(pattern.keypoint_tiles, (1, 1))
+
+    def test_pattern_index(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patterns_dir = os.path.join(directory, 'patterns') # not created yet
+        with mock.patch('services.storage_service.PATTERNS_DIR', patterns_dir):
+            index = self.storage_service.pattern_index()
+            self.assertEqual(len(index), 0)
+            self.assertIs(self.storage_service.pattern_index(), index)
+            pattern = self.create_pattern('test_pattern_index')
+            self.storage_service.save_pattern(pattern, overwrite=True)
+            self.assertListEqual(os.listdir(patterns_dir), ['test_pattern_index'])
+        self.assertIn('test_pattern_index', index.names)
+        labels, distances = index.search(np.asarray(pattern.descriptors, np.uint8), 1)
+        self.assertListEqual([index.names[label] for label in labels[:, 0]], ['test_pattern_index'] * 2)
+        np.testing.assert_equal(distances, 0)
+
+    def test_legacy_pattern(self):
+        self.storage_service.save_pattern(self.pattern, overwrite=True, bundle=False)
+        pattern = self.storage_service.load_pattern(self.pattern_name)
+        self.assertEqual(self.pattern, pattern)
+        self.assertTupleEqual(pattern.keypoint_tiles, (1, 1))
+
+    def test_pattern_bundle(self):
+        self.pattern.keypoint_tiles = (2, 3)
+        self.storage_service.save_pattern(self.pattern, overwrite=True)
+        pattern = self.storage_service.load_pattern(self.pattern_name)
+        self.assertTupleEqual(pattern.keypoint_tiles, (2, 3))
+        self.assertIsInstance(pattern.descriptors, np.memmap)
+        np.testing.assert_equal(pattern.keypoint_array, self.pattern.keypoint_array)
+        np.testing.assert_equal(pattern.points(), [[5, 5], [2, 2]])
+        self.assertEqual(pattern.keypoints[1].octave, 1)
 
 
     def test_settings(self):
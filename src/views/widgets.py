@@ -1,8 +1,9 @@
 import cv2
+import numpy as np
 from functools import partial
-from PyQt5 import QtCore
-from PyQt5.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QGridLayout, QToolBox, QFrame, QGroupBox, QGraphicsView, QGraphicsScene, QLabel, QSpinBox, QPushButton, QLineEdit, QMessageBox
-from PyQt5.QtGui import QPen, QColor, QPainter, QImage, QPixmap
+from PyQt5 import QtCore, sip
+from PyQt5.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QGridLayout, QToolBox, QFrame, QGroupBox, QGraphicsView, QGraphicsScene, QLabel, QSpinBox, QDoubleSpinBox, QPushButton, QLineEdit, QMessageBox, QCheckBox
+from PyQt5.QtGui import QPen, QColor, QPainter, QImage, QPixmap, QTransform
 
 from image_processors import avaliable_image_processes
 from image_processors.abc.image_process import ImageProcess, TYPES
@@ -11,25 +12,117 @@ from services.image_service import ImageService
 from services.storage_service import StorageService
 from models.settings import *
 from decorators import wait_cursor
-from matplotlib import pyplot as plt
+from stage_cache import StageCache
 
-class MainWidget(QGraphicsView):
-    def __init__(self, parent):
+def cv2_image_to_pixmap(image):
+    ''' BGR or gray image wrapped in QImage without conversion, rows may be a view into larger image '''
+    if image.strides[-1] != image.itemsize or (image.ndim == 3 and image.strides[1] != 3):
+        image = np.ascontiguousarray(image)
+    height, width = image.shape[:2]
+    image_format = QImage.Format_Grayscale8 if image.ndim == 2 else QImage.Format_BGR888
+    qimage = QImage(sip.voidptr(image.ctypes.data), width, height, image.strides[0], image_format)
+    return QPixmap.fromImage(qimage) # pixmap keeps its own copy, image may be released
+
+
+class ImageView(QGraphicsView):
+    '''
+    Shows cv2 image fitted in view, scene coordinates are pixels of the image.
+    Only pyramid level about the size of the viewport is uploaded to Qt, zooming in with mouse wheel
+    adds tiles of finer levels covering the visible part of the image.
+    '''
+    def __init__(self):
         super().__init__()
-        self.parent = parent
         self.scene = QGraphicsScene(self)
-
         self.setScene(self.scene)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.display_pyramid = []
+        self.overview_level = 0
+        self._tiles = {} # (level, column, row) -> pixmap item
+        self._fitted = True
+
+    def show_image(self, image):
+        self.display_pyramid = [image]
+        self.scene.clear()
+        self._tiles = {}
+        self.scene.setSceneRect(0, 0, image.shape[1], image.shape[0])
+        self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
+        self._fitted = True
+        self.overview_level = self._level(self.transform().m11())
+        self._add_level_item(self.overview_level, self._display_level(self.overview_level), 0, 0, z=0)
+
+    def _display_level(self, level):
+        while len(self.display_pyramid) <= level:
+            self.display_pyramid.append(cv2.pyrDown(self.display_pyramid[-1]))
+        return self.display_pyramid[level]
+
+    def _level(self, view_scale):
+        ''' Coarsest pyramid level with at least one image pixel for every screen pixel at view_scale '''
+        image = self.display_pyramid[0]
+        level = int(np.floor(np.log2(1 / view_scale))) if view_scale < 1 else 0
+        return max(min(level, int(np.log2(max(min(image.shape[:2]), 1)))), 0)
+
+    def _add_level_item(self, level, image, x, y, z):
+        ''' Pixmap of image, part of level starting at (x, y) level pixels, placed over the same part of scene '''
+        level_image = self._display_level(level)
+        fx = self.display_pyramid[0].shape[1] / level_image.shape[1]
+        fy = self.display_pyramid[0].shape[0] / level_image.shape[0]
+        item = self.scene.addPixmap(cv2_image_to_pixmap(image))
+        item.setTransform(QTransform.fromScale(fx, fy))
+        item.setPos(x * fx, y * fy)
+        item.setZValue(z)
+        return item
+
+    def _update_tiles(self):
+        ''' Adds tiles of level needed by current zoom in visible part of scene, removes all others '''
+        if not self.display_pyramid:
+            return
+        level = self._level(self.transform().m11())
+        wanted = set()
+        if level < self.overview_level:
+            level_image = self._display_level(level)
+            fx = self.display_pyramid[0].shape[1] / level_image.shape[1]
+            fy = self.display_pyramid[0].shape[0] / level_image.shape[0]
+            visible = self.mapToScene(self.viewport().rect()).boundingRect().intersected(self.scene.sceneRect())
+            size = DISPLAY_TILE_SIZE
+            for row in range(int(visible.top() / fy) // size, int(np.ceil(visible.bottom() / fy)) // size + 1):
+                for col in range(int(visible.left() / fx) // size, int(np.ceil(visible.right() / fx)) // size + 1):
+                    y, x = row * size, col * size
+                    if y >= level_image.shape[0] or x >= level_image.shape[1]:
+                        continue
+                    wanted.add((level, col, row))
+                    if (level, col, row) not in self._tiles:
+                        tile = level_image[y:y + size, x:x + size]
+                        self._tiles[(level, col, row)] = self._add_level_item(level, tile, x, y, z=1)
+        for key in list(self._tiles):
+            if key not in wanted:
+                self.scene.removeItem(self._tiles.pop(key))
+
+    def wheelEvent(self, event):
+        if not self.display_pyramid:
+            return
+        factor = DISPLAY_ZOOM_STEP if event.angleDelta().y() > 0 else 1 / DISPLAY_ZOOM_STEP
+        self.scale(factor, factor)
+        self._fitted = False
+        if self.mapToScene(self.viewport().rect()).boundingRect().contains(self.scene.sceneRect()):
+            self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio) # not smaller than fitted
+            self._fitted = True
+        self._update_tiles()
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self._update_tiles()
 
-    def _cv2_image_to_pixmap(self):
-        if self.cv2_out_image == COLOR_IMAGE:
-            cv2_image = cv2.cvtColor(self.cv2_image, cv2.COLOR_BGR2RGB)
-        elif self.cv2_out_image == GRAY_IMAGE:
-            cv2_image = cv2.cvtColor(self.cv2_image, cv2.COLOR_GRAY2RGB)
-        elif self.cv2_out_image == BIN_IMAGE:
-            cv2_image = cv2.cvtColor(self.cv2_image, cv2.COLOR_GRAY2RGB)
-        height, width, chanels = cv2_image.shape
-        return QPixmap.fromImage(QImage(cv2_image, width, height, width * chanels, QImage.Format_RGB888))
+    def resizeEvent(self, event):
+        if self._fitted:
+            self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
+        self._update_tiles()
+
+
+class MainWidget(ImageView):
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
 
     def setImage(self, images):
         self.cv2_out_image = images[OUT_IMAGE]
@@ -37,13 +130,7 @@ class MainWidget(QGraphicsView):
         self.update_view()
 
     def update_view(self):
-        self.scene.clear()
-        self.scene.setSceneRect(0, 0, self.cv2_image.shape[1], self.cv2_image.shape[0])
-        self.scene.addPixmap(self._cv2_image_to_pixmap())
-        self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
-
-    def resizeEvent(self, event):
-        self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
+        self.show_image(self.cv2_image)
 
 
 class ParametersWidget(QWidget):
@@ -56,7 +143,7 @@ class ParametersWidget(QWidget):
         self.parent = parent
         self.model = model
         
-        self.storage_service = StorageService()
+        self.storage_service = parent.storage_service # saved patterns reach parent's pattern index
         self.image_service = ImageService()
         self.image_widget = ImageWidget(self)
         self.model_box = self._create_model_box()
@@ -72,6 +159,7 @@ class ParametersWidget(QWidget):
         self.image_widget.setImage(image)
 
     def draw(self, image):
+        ''' Image to show, BGR or gray image with drawings over it, image itself must not be changed '''
         raise NotImplementedError("draw function must be implemented")
 
 
@@ -138,6 +226,22 @@ class ParametersWidget(QWidget):
         buttons_widget = QWidget()
         buttons_hbox_layout = QHBoxLayout()
         buttons_widget.setLayout(buttons_hbox_layout)
+        proxy_check_box = QCheckBox("Proxy preview")
+        proxy_check_box.setToolTip("Preview on image halved given number of times, parameters in pixels are scaled to match")
+        proxy_check_box.setChecked(PREVIEW_PROXY_LEVEL > 0)
+        proxy_check_box.toggled[bool].connect(self._proxy_toggled_handler)
+        self.proxy_level_spin_box = QSpinBox()
+        self.proxy_level_spin_box.setRange(1, PREVIEW_MAX_PROXY_LEVEL)
+        self.proxy_level_spin_box.setValue(max(PREVIEW_PROXY_LEVEL, 1))
+        self.proxy_level_spin_box.setEnabled(PREVIEW_PROXY_LEVEL > 0)
+        self.proxy_level_spin_box.valueChanged[int].connect(self._proxy_level_changed_handler)
+        full_resolution_button = QPushButton("Full resolution")
+        full_resolution_button.setToolTip("Transform and show image in full resolution once")
+        full_resolution_button.clicked.connect(self._full_resolution_clicked_handler)
+        buttons_hbox_layout.addWidget(proxy_check_box)
+        buttons_hbox_layout.addWidget(self.proxy_level_spin_box)
+        buttons_hbox_layout.addWidget(full_resolution_button)
+
         cancel_button = QPushButton("Cancel")
         cancel_button.clicked.connect(self._cancel_clicked_handler)
         self.save_button = QPushButton("Save")
@@ -153,6 +257,16 @@ class ParametersWidget(QWidget):
         #with wait_cursor():
         self.image_widget.update_view()
 
+    def _proxy_toggled_handler(self, checked):
+        self.proxy_level_spin_box.setEnabled(checked)
+        self.image_widget.set_proxy_level(self.proxy_level_spin_box.value() if checked else 0)
+
+    def _proxy_level_changed_handler(self, value):
+        self.image_widget.set_proxy_level(value)
+
+    def _full_resolution_clicked_handler(self):
+        self.image_widget.update_view(full_resolution=True)
+
 
 
 
@@ -165,8 +279,27 @@ class SettingsWidget(ParametersWidget):
         height, width = image.shape[:2]
         selected_split = self.model.selected_split()
         if selected_split:
-            for line in selected_split.lines(image.shape[0], image.shape[1]):
-                cv2.line(image, line[0], line[1], (255, 0, 0), 20)
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+            scale = self.image_widget.scale
+            for line in selected_split.scaled(scale).lines(image.shape[0], image.shape[1]):
+                cv2.line(image, line[0], line[1], (0, 0, 255), max(int(20 * scale), 1))
+        return image
+
+    def _create_name_widget(self):
+        name_widget = super()._create_name_widget()
+        working_scale_label = QLabel("Working scale")
+        working_scale_label.setToolTip("Images are inspected resized by this scale, parameters stay in pixels of source image")
+        working_scale_spin_box = QDoubleSpinBox()
+        working_scale_spin_box.setRange(0.05, 1)
+        working_scale_spin_box.setSingleStep(0.05)
+        working_scale_spin_box.setValue(self.model.working_scale)
+        working_scale_spin_box.valueChanged[float].connect(self._working_scale_value_changed_handler)
+        name_widget.layout().addWidget(working_scale_label)
+        name_widget.layout().addWidget(working_scale_spin_box)
+        return name_widget
+
+    def _working_scale_value_changed_handler(self, value):
+        self.model.working_scale = value
 
     def _save_clicked_handler(self):
         self.storage_service.save_settings(self.model, overwrite=True)
@@ -181,57 +314,58 @@ class PatternWidget(ParametersWidget):
         super().__init__(parent, model)
     
     def draw(self, image):
-        pass
+        return image
 
     def _save_clicked_handler(self):
-        images = self.transform_image()
+        images = self.image_widget.transform_image(full_resolution=True)
         if images:
-            self.model.keypoints, self.model.descriptors = self.image_service.extract_key_points_and_descriptors(images[GRAY_IMAGE])
+            self.model.keypoints, self.model.descriptors = self.image_service.extract_key_points_and_descriptors(images[GRAY_IMAGE], KEYPOINT_TILES)
             self.model.image = images[BIN_IMAGE]
+            self.model.keypoint_tiles = KEYPOINT_TILES
             self.storage_service.save_pattern(self.model, overwrite=True)
             self.parent.pattern_finished(self.model.name)
 
     def _cancel_clicked_handler(self):
         self.parent.pattern_finished(None)
 
-class ImageWidget(QGraphicsView):
+class ImageWidget(ImageView):
     def __init__(self, parent):
         super().__init__()
-        self.scene = QGraphicsScene(self)
         self.parent = parent
-
-        self.setScene(self.scene)
+        self.stage_cache = StageCache()
+        self.cv2_image_orig = None
+        self.proxy_level = PREVIEW_PROXY_LEVEL
+        self.scale = 1.0 # size of shown image relative to cv2_image_orig
 
     def setImage(self, cv2_image):
         self.cv2_image_orig = cv2_image
-        self.transform_image()
+        self.pyramid = [cv2_image]
+        self.stage_cache.clear() # outputs of previous image are not needed again
         self.update_view()
 
-    def update_view(self, transform=True):
-        if transform:
-            self.transform_image()
-        self.scene.clear()
-        self.scene.setSceneRect(0, 0, self.cv2_image.shape[1], self.cv2_image.shape[0])
-        self.scene.addPixmap(self._cv2_image_to_pixmap())
-        self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
+    def set_proxy_level(self, level):
+        self.proxy_level = level
+        if self.cv2_image_orig is not None:
+            self.update_view()
 
-    def _cv2_image_to_pixmap(self):
-        if self.cv2_out_image == COLOR_IMAGE:
-            cv2_image = cv2.cvtColor(self.cv2_image, cv2.COLOR_BGR2RGB)
-        elif self.cv2_out_image == GRAY_IMAGE:
-            cv2_image = cv2.cvtColor(self.cv2_image, cv2.COLOR_GRAY2RGB)
-        elif self.cv2_out_image == BIN_IMAGE:
-            cv2_image = cv2.cvtColor(self.cv2_image, cv2.COLOR_GRAY2RGB)
-        self.parent.draw(cv2_image)
-        height, width, chanels = cv2_image.shape
-        return QPixmap.fromImage(QImage(cv2_image, width, height, width * chanels, QImage.Format_RGB888))
+    def update_view(self, transform=True, full_resolution=False):
+        if transform:
+            self.transform_image(full_resolution)
+        self.show_image(self.parent.draw(self.cv2_image))
 
 
-    def transform_image(self):
+    def transform_image(self, full_resolution=False):
+        '''
+        Transforms image halved proxy_level times with model scaled to match,
+        full_resolution transforms cv2_image_orig with model as it is.
+        '''
         images = {}
         try:
             with wait_cursor():
-                images = self.parent.image_service.transform_image(self.cv2_image_orig, self.parent.model)
+                image = self._pyramid_level(0 if full_resolution else self.proxy_level)
+                scale = image.shape[1] / self.cv2_image_orig.shape[1]
+                images = self.parent.image_service.transform_image(image, self.parent.model.scaled(scale), cache=self.stage_cache)
+                self.scale = scale
             self.cv2_out_image = images[OUT_IMAGE]
             self.cv2_image = images[self.cv2_out_image]
         except TransformationError as e:
@@ -239,6 +373,8 @@ class ImageWidget(QGraphicsView):
             message.exec_()
         return images
 
-    def resizeEvent(self, event):
-        self.fitInView(self.scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
-
+    def _pyramid_level(self, level):
+        ''' Levels are kept, so stage cache sees the same source image '''
+        while len(self.pyramid) <= level:
+            self.pyramid.append(self.parent.image_service.pyramid_down(self.pyramid[-1]))
+        return self.pyramid[level]